@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import random
+import timeit
+
+from datetime import datetime, timedelta
+
+import hintlib.sample
+
+import metric_relay.influxdb as influxdb
+
+
+def make_batches(nbatches, npaths):
+    paths = [
+        hintlib.sample.SensorPath(
+            module="sensor-{}".format(i % 4),
+            part="bme280",
+            instance=str(i),
+        )
+        for i in range(npaths)
+    ]
+    t0 = datetime(2020, 1, 1)
+    return [
+        hintlib.sample.SampleBatch(
+            timestamp=t0 + timedelta(milliseconds=i * 137),
+            bare_path=paths[i % npaths],
+            samples={
+                "temperature": random.uniform(-20, 40),
+                "pressure": random.uniform(900, 1100),
+                "humidity": random.uniform(0, 100),
+                "count": i,
+            },
+        )
+        for i in range(nbatches)
+    ]
+
+
+def convert_reference(batches):
+    # Sink._convert_samples, which was used before LineProtocolEncoder
+    for batch in batches:
+        tags = [
+            ("module", batch.bare_path.module)
+        ]
+        if batch.bare_path.instance is not None:
+            tags.append(
+                ("instance", batch.bare_path.instance),
+            )
+
+        samples = dict(batch.samples)
+        if None in samples:
+            if len(samples) > 1:
+                raise ValueError("malformed sample batch")
+            samples["value"] = samples.pop(None)
+
+        yield influxdb.InfluxDBSample(
+            measurement=batch.bare_path.part,
+            tags=tuple(tags),
+            fields=tuple(samples.items()),
+            timestamp=batch.timestamp,
+            ns_part=0,
+        )
+
+
+def encode_reference(batches, precision):
+    # the encoding path of the sink before LineProtocolEncoder
+    return b"".join(
+        sample.encode(precision)
+        for sample in convert_reference(batches)
+    )
+
+
+def encode_fast(batches, precision):
+    return bytes(
+        influxdb.LineProtocolEncoder(precision).encode_batches(batches)
+    )
+
+
+async def _collect(chunks):
+    return b"".join([chunk async for chunk in chunks])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the InfluxDB line protocol encoders",
+    )
+    parser.add_argument("-n", "--batches", type=int, default=10000)
+    parser.add_argument("-p", "--paths", type=int, default=32)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument(
+        "--precision",
+        type=influxdb.Precision,
+        default=influxdb.Precision.MILLISECONDS,
+    )
+    args = parser.parse_args()
+
+    batches = make_batches(args.batches, args.paths)
+
+    reference = encode_reference(batches, args.precision)
+    assert encode_fast(batches, args.precision) == reference
+    assert asyncio.get_event_loop().run_until_complete(_collect(
+        influxdb._batch_encoder(
+            batches,
+            influxdb.LineProtocolEncoder(args.precision),
+            1000,
+        )
+    )) == reference
+
+    for name, func in [("reference", encode_reference),
+                       ("encoder", encode_fast)]:
+        best = min(timeit.repeat(
+            lambda: func(batches, args.precision),
+            number=1,
+            repeat=args.repeat,
+        ))
+        print("{:>10s}: {:8.1f} ms ({:.2f} us/batch)".format(
+            name,
+            best * 1e3,
+            best * 1e6 / len(batches),
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import argparse
+import math
+import random
+import struct
+import timeit
+
+import metric_relay.sbx.stream as stream
+
+
+def decompress_reference(average, packet):
+    # the bit-by-bit decoder which was used before the memoryview decoder
+    def to_sint(v):
+        return struct.unpack("<h", struct.pack("<H", v))[0]
+
+    values = [to_sint(average)]
+
+    remaining_payload_size = len(packet)
+
+    bitmap = []
+    while remaining_payload_size > 0:
+        remaining_payload_size -= 1
+        next_bitmap_part = packet[0]
+        packet = packet[1:]
+
+        for i in range(7, -1, -1):
+            bit = (next_bitmap_part & (1 << i)) >> i
+            bitmap.append(bit)
+            if bit:
+                remaining_payload_size -= 1
+            else:
+                remaining_payload_size -= 2
+            if remaining_payload_size <= 0:
+                break
+
+    for compressed in bitmap:
+        if compressed:
+            raw, = struct.unpack("<B", packet[:1])
+            packet = packet[1:]
+        else:
+            raw, = struct.unpack("<H", packet[:2])
+            packet = packet[2:]
+        value = (raw + average) % 65536
+        values.append(to_sint(value))
+
+    return values
+
+
+def compress(samples, max_size):
+    """
+    Encode as many of `samples` as fit into `max_size` bytes in the format
+    understood by :func:`stream.decompress`.
+    """
+    average = (round(sum(samples) / len(samples))) & 0xffff
+    bitmap = []
+    payload = bytearray()
+    for sample in samples:
+        delta = (sample - average) & 0xffff
+        size = 1 if delta < 256 else 2
+        nbitmap = (len(bitmap) + 1 + 7) // 8
+        if nbitmap + len(payload) + size > max_size:
+            break
+        bitmap.append(size == 1)
+        if size == 1:
+            payload.append(delta)
+        else:
+            payload += struct.pack("<H", delta)
+
+    bitmap_bytes = bytearray((len(bitmap) + 7) // 8)
+    for i, bit in enumerate(bitmap):
+        if bit:
+            bitmap_bytes[i // 8] |= 0x80 >> (i % 8)
+
+    return average, bytes(bitmap_bytes + payload)
+
+
+def make_accel_packets(npackets, packet_size):
+    # 1 g offset, slow vibration and sensor noise, in raw LSM303D units
+    packets = []
+    t = 0
+    for _ in range(npackets):
+        samples = [
+            round(
+                16384 +
+                100 * math.sin(2 * math.pi * (t + i) / 250) +
+                random.gauss(0, 40)
+            )
+            for i in range(packet_size)
+        ]
+        average, packet = compress(samples, packet_size)
+        packets.append((average, packet))
+        t += packet_size
+    return packets
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the SBX stream decoders",
+    )
+    parser.add_argument("-n", "--packets", type=int, default=2000)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument(
+        "-s", "--sizes",
+        type=lambda x: list(map(int, x.split(","))),
+        default=[32, 60, 78, 128, 256, 1024],
+        help="Comma separated packet sizes in bytes",
+    )
+    args = parser.parse_args()
+
+    decoders = [("reference", decompress_reference),
+                ("python", stream._decompress_python)]
+    if stream.numpy is not None:
+        decoders.append(("numpy", stream._decompress_numpy))
+
+    for size in args.sizes:
+        packets = make_accel_packets(args.packets, size)
+        for average, packet in packets:
+            expected = decompress_reference(average, packet)
+            assert list(stream.decompress(average, packet)) == expected
+
+        nsamples = sum(
+            len(decompress_reference(average, packet))
+            for average, packet in packets
+        )
+
+        for name, decoder in decoders:
+            best = min(timeit.repeat(
+                lambda: [
+                    decoder(average, memoryview(packet))
+                    for average, packet in packets
+                ],
+                number=1,
+                repeat=args.repeat,
+            ))
+            print("{:5d} B {:>10s}: {:8.2f} us/packet {:8.3f} us/sample"
+                  .format(
+                      size,
+                      name,
+                      best * 1e6 / len(packets),
+                      best * 1e6 / nsamples,
+                  ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import timeit
+
+from datetime import datetime, timedelta
+
+import metric_relay.sbx.source as source
+import metric_relay.sbx.wireformat as wireformat
+
+
+T0 = datetime(2020, 1, 1)
+
+
+def map_to_rtc(timestamp):
+    return T0 + timedelta(milliseconds=timestamp)
+
+
+class RTCifier:
+    map_to_rtc = staticmethod(map_to_rtc)
+
+
+def make_messages(nmessages):
+    ds18b20_ids = [bytes(random.getrandbits(8) for _ in range(8))
+                   for _ in range(4)]
+    messages = []
+    uptime = 0
+    for i in range(nmessages):
+        uptime += random.randint(100, 1000)
+        kind = i % 4
+        if kind == 0:
+            messages.append(wireformat.DS18B20Message(
+                uptime,
+                [(id_, random.uniform(-20, 40)) for id_ in ds18b20_ids],
+            ))
+        elif kind == 1:
+            messages.append(wireformat.NoiseMessage([
+                (uptime + j * 10,
+                 random.random(),
+                 random.randint(-2**15, 0),
+                 random.randint(0, 2**15-1))
+                for j in range(4)
+            ]))
+        elif kind == 2:
+            messages.append(wireformat.LightMessage([
+                (uptime + j * 10,
+                 tuple(random.randint(0, 2**16-1) for _ in range(4)))
+                for j in range(4)
+            ]))
+        else:
+            messages.append(wireformat.ESPStatusMessage.from_buf(
+                T0 + timedelta(milliseconds=uptime),
+                os.urandom(wireformat.ESPStatusMessage._v1.size),
+            ))
+    return messages
+
+
+def batches_reference(messages, rewriter):
+    # the chain which SNURLSBXSource used before SampleBatcher
+    return [
+        batch
+        for obj in messages
+        for batch in source.batch_samples(
+            source.rtcify_samples(
+                map(
+                    rewriter.rewrite,
+                    source.deenumify_samples(obj.get_samples())
+                ),
+                RTCifier,
+            )
+        )
+    ]
+
+
+def batches_fused(messages, batcher):
+    return [
+        batch
+        for obj in messages
+        for batch in batcher.batches(obj.get_sample_groups(), map_to_rtc)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the SBX sample batching paths",
+    )
+    parser.add_argument("-n", "--messages", type=int, default=10000)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+    rewriter = source.InstanceRewriter([
+        {"rewrite": "instance", "part": "tcs3200", "instance": "0",
+         "new_instance": "window"},
+    ])
+    batcher = source.SampleBatcher(rewriter.rewrite_path)
+
+    reference = batches_reference(messages, rewriter)
+    assert batches_fused(messages, batcher) == reference
+
+    for name, func in [
+            ("reference", lambda: batches_reference(messages, rewriter)),
+            ("fused", lambda: batches_fused(messages, batcher))]:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print("{:>10s}: {:8.1f} ms ({:.2f} us/message, {:.2f} us/batch)"
+              .format(
+                  name,
+                  best * 1e3,
+                  best * 1e6 / len(messages),
+                  best * 1e6 / len(reference),
+              ))
+
+
+if __name__ == "__main__":
+    main()
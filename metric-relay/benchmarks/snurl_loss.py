@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Push frames through a pair of SNURL endpoints connected by an in-memory
+link with packet loss (using the ``rx_loss_emulation`` of the endpoints)
+and reordering.
+
+The endpoints using the current receive path are compared against
+endpoints using the linear range set and reorder buffer which were used
+before. Both must deliver the same frames in the same order.
+"""
+import argparse
+import heapq
+import logging
+import random
+import socket
+import time
+
+import metric_relay.snurl as snurl
+
+
+def _sn(value):
+    return snurl.SerialNumber(snurl.Protocol.SERIAL_BITS, value)
+
+
+class ReferenceSerialNumberRangeSet:
+    # the linear range set which was used before the bisect based one,
+    # with the integer interface used by the protocol
+    def __init__(self):
+        self._ranges = []
+
+    def add(self, sn):
+        sn = _sn(sn)
+        for i, (start, end) in enumerate(self._ranges):
+            if start <= sn <= end:
+                return
+
+            if end + 1 == sn:
+                if i+1 < len(self._ranges):
+                    next_start, next_end = self._ranges[i+1]
+                    if next_start == sn + 1:
+                        self._ranges[i] = start, next_end
+                        del self._ranges[i+1]
+                        return
+
+                self._ranges[i] = start, sn
+                return
+
+            if start == sn + 1:
+                self._ranges[i] = sn, end
+                return
+
+            # the original appended unconditionally, leaving the ranges
+            # unsorted and the DACKs of both implementations different
+            if sn < start:
+                self._ranges.insert(i, (sn, sn))
+                return
+
+        self._ranges.append((sn, sn))
+
+    def discard_up_to(self, sn):
+        sn = _sn(sn)
+        ndiscarded = 0
+        while self._ranges and self._ranges[0][0] <= sn:
+            start, end = self._ranges[0]
+            if end <= sn:
+                ndiscarded += end - start + 1
+                del self._ranges[0]
+                continue
+            ndiscarded += sn - start + 1
+            self._ranges[0] = sn + 1, end
+        return ndiscarded
+
+    def iter_raw_ranges(self):
+        for start, end in self._ranges:
+            yield start.to_int(), end.to_int()
+
+    def clear(self):
+        self._ranges.clear()
+
+    def __contains__(self, item):
+        item = _sn(item)
+        for start, end in self._ranges:
+            if item >= start and item <= end:
+                return True
+        return False
+
+    @property
+    def first_raw_range(self):
+        if not self._ranges:
+            return None
+        start, end = self._ranges[0]
+        return start.to_int(), end.to_int()
+
+
+class ReferenceProtocol(snurl.Protocol):
+    # the receive path with the sorted-list reorder buffer
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._rx_out_of_order = ReferenceSerialNumberRangeSet()
+
+    def _flush_rx_buffer(self):
+        for _, payload in self._rx_buffer:
+            self.on_data_received(payload)
+        self._rx_buffer.clear()
+
+    def _handle_data_entry(self, sn, payload):
+        if not self._mark_received_locally(sn):
+            return
+
+        sn = _sn(sn)
+        for i, (recvd_sn, _) in enumerate(self._rx_buffer):
+            if recvd_sn == sn:
+                break
+            if recvd_sn > sn:
+                self._rx_buffer.insert(i, (sn, payload))
+                break
+        else:
+            self._rx_buffer.append((sn, payload))
+
+    def _handle_data(self, remainder, valid_connection, **kwargs):
+        if not valid_connection:
+            return
+
+        first_sn = None
+        while remainder:
+            sn, length = snurl.data_entry_header_fmt.unpack_from(remainder)
+            remainder = remainder[snurl.data_entry_header_fmt.size:]
+            if first_sn is None:
+                first_sn = sn
+
+            payload = remainder[:length]
+            remainder = remainder[length:]
+            self._handle_data_entry(sn, payload)
+
+        max_consecutive_sn = _sn(self._rx_max_consecutive_sn)
+        delete_up_to = 0
+        for i, (recvd_sn, payload) in enumerate(self._rx_buffer):
+            delete_up_to = i
+            if recvd_sn > max_consecutive_sn:
+                break
+            self.on_data_received(payload)
+        else:
+            delete_up_to = len(self._rx_buffer)
+        del self._rx_buffer[:delete_up_to]
+
+        self._rx_last_sn = first_sn
+        self._emit_ack()
+
+
+class Link:
+    """
+    In-memory datagram link between two endpoints, which delays each
+    datagram by a random number of ticks.
+    """
+
+    def __init__(self, max_delay):
+        super().__init__()
+        self.max_delay = max_delay
+        self.now = 0
+        self._queue = []
+        self._ctr = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    @property
+    def pending(self):
+        return len(self._queue)
+
+    def close(self):
+        self._sock.close()
+
+    def attach(self, protocol, peer_addr, addr):
+        link = self
+
+        class Transport:
+            def get_extra_info(self, name):
+                return link._sock if name == "socket" else None
+
+            def sendto(self, packet, dest):
+                link._ctr += 1
+                heapq.heappush(link._queue, (
+                    link.now + random.randint(0, link.max_delay),
+                    link._ctr,
+                    peer_addr,
+                    addr,
+                    packet,
+                ))
+
+        protocol.connection_made(Transport())
+
+    def run_until(self, t, endpoints):
+        while self._queue and self._queue[0][0] <= t:
+            _, _, dest, src, packet = heapq.heappop(self._queue)
+            endpoints[dest].datagram_received(packet, src)
+        self.now = t
+        # there is no event loop to run the retransmission timers
+        for protocol in endpoints.values():
+            protocol._retransmit_timeout()
+
+
+def run(protocol_cls, args):
+    random.seed(args.seed)
+    link = Link(args.reorder)
+    logger = logging.getLogger("snurl")
+    sender = protocol_cls(2, tx_max_buffer_size=args.buffer_size,
+                          rx_loss_emulation=args.loss, logger=logger)
+    receiver = protocol_cls(1, tx_max_buffer_size=args.buffer_size,
+                            rx_loss_emulation=args.loss, logger=logger)
+    link.attach(sender, "receiver", "sender")
+    link.attach(receiver, "sender", "receiver")
+    for protocol in (sender, receiver):
+        # one tick per frame on the simulated link
+        protocol._clock = lambda: link.now / args.rate
+    endpoints = {"sender": sender, "receiver": receiver}
+
+    # handshake first, otherwise every datagram still in flight with the
+    # initial connection id makes the receiver resync
+    t = 0
+    while not (sender.synchronized.is_set() and
+               receiver.synchronized.is_set()):
+        sender.send_frame(b"")
+        t += args.reorder + 1
+        link.run_until(t, endpoints)
+
+    if args.ack_loss is not None:
+        sender._rx_loss_emulation = args.ack_loss
+
+    received = []
+    receiver.on_data_received.connect(received.append)
+
+    padding = bytes(args.payload_size - 4)
+    t_start = time.process_time()
+    for i in range(args.frames):
+        sender.send_frame(i.to_bytes(4, "little") + padding)
+        link.run_until(t + i, endpoints)
+    t += args.frames
+    # let the retransmissions finish
+    drain_until = t + args.reorder + 10 * args.rate
+    while t < drain_until and (sender.tx_buffer_size or link.pending):
+        t += 1
+        link.run_until(t, endpoints)
+    elapsed = time.process_time() - t_start
+
+    link.close()
+    return elapsed, received, sender, receiver
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("-n", "--frames", type=int, default=5000)
+    parser.add_argument("--loss", type=float, default=0.2,
+                        help="Datagram loss probability per endpoint")
+    parser.add_argument("--ack-loss", type=float, default=None,
+                        help="Loss probability of the acknowledgements "
+                        "after the handshake (default: same as --loss). "
+                        "With 1, the sender only frees its buffer by "
+                        "dropping, which isolates the receive path.")
+    parser.add_argument("--reorder", type=int, default=64,
+                        help="Maximum delay of a datagram in frames")
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="Simulated frame rate in frames per second, "
+                        "which sets the time scale for the retransmission "
+                        "timers")
+    parser.add_argument("--buffer-size", type=int, default=1024,
+                        help="Transmit buffer size of the endpoints")
+    parser.add_argument("--payload-size", type=int, default=4,
+                        help="Frame payload size in bytes (at least 4)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.getLogger("snurl").setLevel(logging.WARNING)
+
+    results = {}
+    for name, cls in [("reference", ReferenceProtocol),
+                      ("current", snurl.Protocol)]:
+        elapsed, received, sender, receiver = run(cls, args)
+        results[name] = received
+        print("{:>10s}: {:8.1f} ms ({:.2f} us/frame)  delivered {}/{}  "
+              "retransmissions {} ({:.2f}/frame)  srtt {}".format(
+                  name,
+                  elapsed * 1e3,
+                  elapsed * 1e6 / args.frames,
+                  len(received),
+                  args.frames,
+                  sender.tx_retransmit_count,
+                  sender.tx_retransmit_ratio,
+                  sender.srtt,
+              ))
+
+    assert results["current"] == results["reference"]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Run a SNURL sender and receiver over loopback and sweep the payload size,
+send rate, loss probability and reorder probability.
+
+Loss and reordering are emulated by the endpoints (``rx_loss_emulation``
+and ``rx_reorder_emulation``), on both the data and the acknowledgement
+direction. For each point of the sweep, one JSON object is written per
+line with the goodput, the retransmissions, the frames the receiver gave
+up on, the p50/p99 delivery latency and the CPU time per datagram.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import struct
+import sys
+import time
+
+import metric_relay.snurl as snurl
+
+
+payload_header_fmt = struct.Struct("<Id")
+# the frame length is a single byte in the data entry header
+MAX_PAYLOAD_SIZE = 255
+
+
+def _float_list(s):
+    return [float(v) for v in s.split(",")]
+
+
+def _int_list(s):
+    return [int(v) for v in s.split(",")]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * p))]
+
+
+async def _create_endpoint(loop, args, protocol_factory):
+    if args.batched:
+        return await snurl.create_batched_endpoint(
+            loop,
+            protocol_factory,
+            ("127.0.0.1", 0),
+        )
+    return await loop.create_datagram_endpoint(
+        protocol_factory,
+        local_addr=("127.0.0.1", 0),
+    )
+
+
+async def run_point(loop, args, payload_size, rate, loss, reorder):
+    logger = logging.getLogger("snurl")
+
+    rx_transport, receiver = await _create_endpoint(
+        loop, args,
+        lambda: snurl.Protocol(
+            0,
+            rx_loss_emulation=loss,
+            rx_reorder_emulation=reorder,
+            logger=logger,
+        ),
+    )
+    _, rx_port = rx_transport.get_extra_info("sockname")[:2]
+    tx_transport, sender = await _create_endpoint(
+        loop, args,
+        lambda: snurl.Protocol(
+            rx_port,
+            dest_host="127.0.0.1",
+            tx_max_buffer_size=args.buffer_size,
+            rx_loss_emulation=loss,
+            rx_reorder_emulation=reorder,
+            logger=logger,
+        ),
+    )
+
+    try:
+        while not (sender.synchronized.is_set() and
+                   receiver.synchronized.is_set()):
+            sender.send_frame(b"")
+            await asyncio.sleep(0.01)
+
+        latencies = []
+        delivered = set()
+
+        def data_received(payload):
+            if len(payload) < payload_header_fmt.size:
+                # handshake frame
+                return
+            ctr, t_sent = payload_header_fmt.unpack_from(payload)
+            if ctr in delivered:
+                return
+            delivered.add(ctr)
+            latencies.append(time.monotonic() - t_sent)
+
+        receiver.on_data_received.connect(data_received)
+
+        base = {}
+        for name, protocol in [("sender", sender), ("receiver", receiver)]:
+            base[name] = (protocol.tx_datagrams, protocol.rx_datagrams,
+                          protocol.tx_retransmit_count,
+                          protocol.rx_given_up_count,
+                          protocol.tx_dropped)
+
+        padding = bytes(payload_size - payload_header_fmt.size)
+        interval = 1 / rate
+        cpu_start = time.process_time()
+        t_start = loop.time()
+        for i in range(args.count):
+            deadline = t_start + i * interval
+            now = loop.time()
+            if deadline > now:
+                await asyncio.sleep(deadline - now)
+            sender.send_frame(
+                payload_header_fmt.pack(i, time.monotonic()) + padding
+            )
+
+        drain_until = loop.time() + args.drain
+        while sender.tx_buffer_size and loop.time() < drain_until:
+            await asyncio.sleep(0.01)
+        # let the last acknowledgements and held back datagrams arrive
+        await asyncio.sleep(snurl.Protocol.REORDER_HOLD_TIME * 2)
+        elapsed = loop.time() - t_start
+        cpu = time.process_time() - cpu_start
+    finally:
+        tx_transport.close()
+        rx_transport.close()
+
+    tx_datagrams = sum(
+        protocol.tx_datagrams - base[name][0]
+        for name, protocol in [("sender", sender), ("receiver", receiver)]
+    )
+    latencies.sort()
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    return {
+        "payload_size": payload_size,
+        "rate": rate,
+        "loss": loss,
+        "reorder": reorder,
+        "batched": args.batched,
+        "frames": args.count,
+        "delivered": len(delivered),
+        "goodput_ratio": len(delivered) / args.count,
+        "goodput_bytes_per_s": len(delivered) * payload_size / elapsed,
+        "tx_datagrams": sender.tx_datagrams - base["sender"][0],
+        "rx_datagrams": receiver.rx_datagrams - base["receiver"][1],
+        "ack_datagrams": receiver.tx_datagrams - base["receiver"][0],
+        "retransmits": sender.tx_retransmit_count - base["sender"][2],
+        "dropped": sender.tx_dropped - base["sender"][4],
+        "given_up": receiver.rx_given_up_count - base["receiver"][3],
+        "latency_p50_ms": p50 * 1e3 if p50 is not None else None,
+        "latency_p99_ms": p99 * 1e3 if p99 is not None else None,
+        "cpu_us_per_datagram": (cpu * 1e6 / tx_datagrams
+                                if tx_datagrams else None),
+        "elapsed_s": elapsed,
+    }
+
+
+async def amain(loop, args, output):
+    for payload_size, rate, loss, reorder in itertools.product(
+            args.payload_sizes, args.rates, args.losses, args.reorders):
+        result = await run_point(loop, args,
+                                 payload_size, rate, loss, reorder)
+        print(json.dumps(result), file=output, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("-n", "--count", type=int, default=2000,
+                        help="Number of frames per point")
+    parser.add_argument("--payload-sizes", type=_int_list, default=[16, 255],
+                        help="Comma separated frame payload sizes in bytes "
+                        "({} to {})".format(payload_header_fmt.size,
+                                            MAX_PAYLOAD_SIZE))
+    parser.add_argument("--rates", type=_float_list, default=[1000, 10000],
+                        help="Comma separated send rates in frames per "
+                        "second")
+    parser.add_argument("--losses", type=_float_list, default=[0, 0.05],
+                        help="Comma separated loss probabilities")
+    parser.add_argument("--reorders", type=_float_list, default=[0, 0.05],
+                        help="Comma separated reorder probabilities")
+    parser.add_argument("--buffer-size", type=int, default=64,
+                        help="Transmit buffer size of the sender")
+    parser.add_argument("--drain", type=float, default=2,
+                        help="Maximum time in seconds to wait for the "
+                        "retransmissions after the last frame")
+    parser.add_argument("--batched", action="store_true", default=False,
+                        help="Receive datagrams in bursts and coalesce "
+                        "their ACKs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", type=argparse.FileType("w"),
+                        default=sys.stdout,
+                        help="File to write the JSON lines to")
+    args = parser.parse_args()
+
+    if not all(payload_header_fmt.size <= size <= MAX_PAYLOAD_SIZE
+               for size in args.payload_sizes):
+        parser.error("payload sizes must be between {} and {}".format(
+            payload_header_fmt.size, MAX_PAYLOAD_SIZE,
+        ))
+
+    logging.getLogger("snurl").setLevel(logging.WARNING)
+    random.seed(args.seed)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(amain(loop, args, args.output))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Replay a trace of stream status messages through the clock alignment.
+
+The trace is a CSV file with the columns ``seq`` (16 bit sequence number of
+the reference sample), ``rtc`` (ISO 8601 timestamp of the reference sample)
+and ``period`` (sampling period in microseconds), one row per status
+message. If the trace has a ``true_rtc`` column, the estimates are compared
+against it.
+
+Without a trace, a synthetic trace of a drifting sample clock with jittery
+RTC timestamps is generated.
+"""
+import argparse
+import csv
+import functools
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta
+
+from hintlib import timeline
+
+import metric_relay.sbx.stream as stream
+
+
+class ReferenceAlignment:
+    # the O(n) alignment which Buffer.align used before ClockAlignment
+    def __init__(self, period):
+        self.period = period
+        self.data = []
+
+    def add(self, offset, rtc):
+        if len(self.data) > 999:
+            del self.data[0]
+
+        for i in range(len(self.data)):
+            old_seq_abs, old_rtc = self.data[i]
+            self.data[i] = (old_seq_abs - offset, old_rtc)
+
+        self.data.append((0, rtc))
+
+        self.t0 = rtc + sum(
+            (
+                (old_rtc - old_seq_abs * self.period) - rtc
+                for old_seq_abs, old_rtc in self.data
+            ),
+            timedelta(0)
+        ) / len(self.data)
+
+
+def read_trace(f):
+    for row in csv.DictReader(f):
+        true_rtc = row.get("true_rtc")
+        yield (
+            int(row["seq"]),
+            datetime.fromisoformat(row["rtc"]),
+            timedelta(microseconds=int(row["period"])),
+            datetime.fromisoformat(true_rtc) if true_rtc else None,
+        )
+
+
+def synthesize_trace(nmessages, period_us, drift_ppm, jitter_ms):
+    t0 = datetime(2020, 1, 1)
+    period = timedelta(microseconds=period_us)
+    seq = 0
+    for _ in range(nmessages):
+        seq += random.randint(900, 1100)
+        true_rtc = t0 + seq * period * (1 + drift_ppm * 1e-6)
+        rtc = true_rtc + timedelta(
+            milliseconds=random.gauss(0, jitter_ms),
+        )
+        yield seq % 2**16, rtc, period, true_rtc
+
+
+def replay(trace, estimator_factory):
+    tl = timeline.Timeline(2**16, 2**15)
+    estimator = None
+    period = None
+    result = []
+    for seq_rel, rtc, new_period, true_rtc in trace:
+        if new_period != period:
+            tl.reset(0)
+            estimator = estimator_factory(new_period)
+            period = new_period
+        offset = tl.feed_and_transform(seq_rel)
+        tl.reset(seq_rel)
+        estimator.add(offset, rtc)
+        result.append((estimator.t0, true_rtc))
+    return result
+
+
+def error_stats(estimates):
+    errors = sorted(
+        abs((t0 - true_rtc).total_seconds())
+        for t0, true_rtc in estimates
+        if true_rtc is not None
+    )
+    if not errors:
+        return None
+    return (
+        errors[len(errors) // 2],
+        errors[min(len(errors) - 1, int(len(errors) * 0.99))],
+        errors[-1],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("trace", nargs="?", type=argparse.FileType("r"))
+    parser.add_argument("-n", "--messages", type=int, default=5000)
+    parser.add_argument("--period", type=int, default=10000,
+                        help="Synthetic sample period in microseconds")
+    parser.add_argument("--drift", type=float, default=30,
+                        help="Synthetic sample clock drift in ppm")
+    parser.add_argument("--jitter", type=float, default=20,
+                        help="Synthetic RTC jitter in milliseconds")
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        trace = list(read_trace(args.trace))
+    else:
+        trace = list(synthesize_trace(args.messages, args.period,
+                                      args.drift, args.jitter))
+
+    results = {}
+    for name, factory in [
+            ("reference", ReferenceAlignment),
+            ("incremental", stream.ClockAlignment),
+            ("fit-drift", functools.partial(stream.ClockAlignment,
+                                            fit_drift=True))]:
+        t_start = time.perf_counter()
+        results[name] = replay(trace, factory)
+        elapsed = time.perf_counter() - t_start
+        stats = error_stats(results[name])
+        print("{:>12s}: {:8.2f} us/message".format(
+            name,
+            elapsed * 1e6 / len(trace),
+        ), end="")
+        if stats is not None:
+            print("  error p50/p99/max: {}".format("/".join(
+                "{:.3f}ms".format(v * 1e3) for v in stats
+            )), end="")
+        print()
+
+    mismatches = sum(
+        a != b
+        for (a, _), (b, _) in zip(results["reference"],
+                                  results["incremental"])
+    )
+    print("estimates differing from reference: {}".format(mismatches))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,14 @@ import argparse
 import asyncio
 import logging
 import sys
+import urllib.parse
 
 import toml
 
 import metric_relay.config
 import metric_relay.daemon
+import metric_relay.interface
+import metric_relay.rewrite
 
 
 async def amain(config_dict, logger_base):
@@ -37,14 +40,45 @@ async def amain(config_dict, logger_base):
         )
 
     routes = []
-    for route in config.batch_routes:
-        routes.append(
-            metric_relay.daemon.Route(
-                from_=sources[route.from_],
-                to=sinks[route.to],
-                persistent=route.persistent,
+    for data_class, route_cfgs in [
+            (metric_relay.interface.DataClass.SAMPLE_BATCH,
+             config.batch_routes),
+            (metric_relay.interface.DataClass.STREAM,
+             config.stream_routes)]:
+        for route in route_cfgs:
+            if route.persistent:
+                queue_directory = (
+                    config.state_directory / "queues" / "{}-{}-{}".format(
+                        data_class.value,
+                        urllib.parse.quote(route.from_, safe=""),
+                        urllib.parse.quote(route.to, safe=""),
+                    )
+                )
+            else:
+                queue_directory = None
+
+            if route.rewrite:
+                rewriter = metric_relay.rewrite.Rewriter(
+                    stage.instantiate() for stage in route.rewrite
+                )
+            else:
+                rewriter = None
+
+            routes.append(
+                metric_relay.daemon.Route(
+                    from_=sources[route.from_],
+                    to=sinks[route.to],
+                    data_class=data_class,
+                    persistent=route.persistent,
+                    queue_directory=queue_directory,
+                    max_depth=route.queue.max_depth,
+                    overflow_policy=route.queue.overflow_policy,
+                    max_batch_size=route.queue.max_batch_size,
+                    linger=route.queue.linger,
+                    filter_=route.filter_.instantiate(),
+                    rewriter=rewriter,
+                )
             )
-        )
 
     daemon = metric_relay.daemon.MetricRelay(
         logger=logging.getLogger("metric_relay").getChild("daemon"),
@@ -3,14 +3,18 @@ import enum
 import importlib
 import logging
 import logging.config
+import numbers
+import pathlib
 import typing
 
 import toml
 
 import schema
 
+import metric_relay.filters
 import metric_relay.interface
 import metric_relay.queue
+import metric_relay.rewrite
 
 
 class RouteFilterPolicy(enum.Enum):
@@ -18,6 +22,36 @@ class RouteFilterPolicy(enum.Enum):
     ACCEPT = 'accept'
 
 
+_QUEUE_SCHEMA = schema.Schema({
+    schema.Optional("max_depth", default=None): schema.And(
+        int,
+        lambda x: x > 0,
+    ),
+    schema.Optional(
+        "overflow",
+        default=metric_relay.queue.OverflowPolicy.DROP_OLD,
+    ): schema.Use(metric_relay.queue.OverflowPolicy),
+    schema.Optional("persistent", default=False): bool,
+    schema.Optional("max_batch_size", default=1000): schema.And(
+        int,
+        lambda x: x > 0,
+    ),
+    schema.Optional("linger", default=0.0): schema.And(
+        numbers.Real,
+        lambda x: x >= 0,
+    ),
+})
+
+
+_FILTER_SCHEMA = schema.Schema({
+    "policy": schema.Use(RouteFilterPolicy),
+    schema.Optional("rules", default=[]): [{
+        "type": str,
+        schema.Optional(str): object,
+    }]
+})
+
+
 BASE_SCHEMA = schema.Schema({
     schema.Optional("logging", default={}): {
         schema.Optional("config", default=None): schema.Or(
@@ -29,6 +63,7 @@ BASE_SCHEMA = schema.Schema({
             schema.Or("ERROR", "WARNING", "INFO", "DEBUG"),
         ),
     },
+    schema.Optional("state_directory", default=None): str,
     "transports": {
         str: {
             "class": str,
@@ -52,33 +87,19 @@ BASE_SCHEMA = schema.Schema({
     "batch_routes": [{
         "from": str,
         "to": str,
-        schema.Optional("queue"): {
-            "max_depth": int,
-            schema.Optional(
-                "overflow",
-                default=metric_relay.queue.OverflowPolicy.REJECT,
-            ): lambda x: metric_relay.queue.OverflowPolicy,
-            "persistent": bool,
-        },
-        schema.Optional("filter"): {
-            "policy": RouteFilterPolicy,
-            schema.Optional("rules"): [{
-                "type": str,
-                str: object,
-            }]
-        },
+        schema.Optional("queue"): _QUEUE_SCHEMA,
+        schema.Optional("filter"): _FILTER_SCHEMA,
+        schema.Optional("rewrite", default=[]): [{
+            "type": str,
+            schema.Optional(str): object,
+        }],
         schema.Optional("persistent", default=False): bool,
     }],
     "stream_routes": [{
         "from": str,
         "to": str,
-        schema.Optional("filter"): {
-            "policy": schema.Or("drop", "accept"),
-            schema.Optional("rules"): [{
-                "type": str,
-                str: object,
-            }]
-        },
+        schema.Optional("queue"): _QUEUE_SCHEMA,
+        schema.Optional("filter"): _FILTER_SCHEMA,
         schema.Optional("persistent", default=False): bool,
     }]
 })
@@ -181,24 +202,53 @@ class RouteFilterRule:
     type_: type
     extra_config: object
 
+    def instantiate(self):
+        return self.type_(config=self.extra_config)
+
 
 @dataclasses.dataclass
 class RouteFilterConfig:
     policy: RouteFilterPolicy
     rules: typing.List[RouteFilterRule]
 
+    def instantiate(self) -> metric_relay.filters.Filter:
+        return metric_relay.filters.Filter(
+            [rule.instantiate() for rule in self.rules],
+            accept_by_default=self.policy == RouteFilterPolicy.ACCEPT,
+        )
+
+
+@dataclasses.dataclass
+class RouteRewriteStage:
+    type_: type
+    extra_config: object
+
+    def instantiate(self) -> metric_relay.rewrite.Stage:
+        return self.type_(config=self.extra_config)
+
+
+@dataclasses.dataclass
+class QueueConfig:
+    max_depth: typing.Optional[int]
+    overflow_policy: metric_relay.queue.OverflowPolicy
+    max_batch_size: int
+    linger: float
+
 
 @dataclasses.dataclass
 class RouteConfig:
     from_: str
     to: str
     persistent: bool
+    queue: QueueConfig
     filter_: RouteFilterConfig
+    rewrite: typing.List[RouteRewriteStage]
 
 
 @dataclasses.dataclass
 class Config:
     logging: LoggingConfig
+    state_directory: typing.Optional[pathlib.Path]
     transports: typing.Mapping[str, TransportConfig]
     sources: typing.Mapping[str, SourceConfig]
     sinks: typing.Mapping[str, SinkConfig]
@@ -388,6 +438,77 @@ def _compile_sources(
     return sources
 
 
+def _compile_typed_items(
+        items_cfg: typing.Iterable[typing.Mapping],
+        types: typing.Mapping[str, type],
+        description: str,
+        ) -> typing.List[typing.Tuple[type, object]]:
+    items = []
+    for i, item_cfg in enumerate(items_cfg):
+        type_name = item_cfg["type"]
+        try:
+            class_ = types[type_name]
+        except KeyError:
+            raise ConfigError(
+                f"{description} {i} has unknown type {type_name!r}"
+            )
+
+        item_schema = class_.get_config_schema()
+        extra_cfg = dict(item_cfg)
+        del extra_cfg["type"]
+
+        try:
+            extra_cfg = item_schema.validate(extra_cfg)
+            compiled_extra_cfg = class_.compile_config(extra_cfg)
+        except (ConfigError, schema.SchemaError) as exc:
+            raise ConfigError(
+                f"{description} {i} has invalid configuration: {exc}"
+            )
+
+        items.append((class_, compiled_extra_cfg))
+
+    return items
+
+
+def _compile_filter(
+        filter_cfg: typing.Optional[typing.Mapping],
+        route_name: str,
+        ) -> RouteFilterConfig:
+    if filter_cfg is None:
+        return RouteFilterConfig(
+            policy=RouteFilterPolicy.ACCEPT,
+            rules=[],
+        )
+
+    rules = [
+        RouteFilterRule(type_=class_, extra_config=extra_config)
+        for class_, extra_config in _compile_typed_items(
+            filter_cfg["rules"],
+            metric_relay.filters.RULE_TYPES,
+            f"filter rule of {route_name}",
+        )
+    ]
+
+    return RouteFilterConfig(
+        policy=filter_cfg["policy"],
+        rules=rules,
+    )
+
+
+def _compile_rewrite(
+        rewrite_cfg: typing.Iterable[typing.Mapping],
+        route_name: str,
+        ) -> typing.List[RouteRewriteStage]:
+    return [
+        RouteRewriteStage(type_=class_, extra_config=extra_config)
+        for class_, extra_config in _compile_typed_items(
+            rewrite_cfg,
+            metric_relay.rewrite.STAGE_TYPES,
+            f"rewrite stage of {route_name}",
+        )
+    ]
+
+
 def _compile_routes(
         routes_cfg: typing.Mapping,
         sources: typing.Mapping[str, SourceConfig],
@@ -430,15 +551,28 @@ def _compile_routes(
                 f"{data_class}"
             )
 
+        # defaults are not validated by schema, so we do that here
+        queue_cfg = _QUEUE_SCHEMA.validate(cfg.get("queue", {}))
+
         routes.append(
             RouteConfig(
                 from_=source_name,
                 to=sink_name,
-                persistent=cfg["persistent"],
-                filter_=RouteFilterConfig(
-                    policy=RouteFilterPolicy.ACCEPT,
-                    rules=[],
-                )
+                persistent=cfg["persistent"] or queue_cfg["persistent"],
+                queue=QueueConfig(
+                    max_depth=queue_cfg["max_depth"],
+                    overflow_policy=queue_cfg["overflow"],
+                    max_batch_size=queue_cfg["max_batch_size"],
+                    linger=queue_cfg["linger"],
+                ),
+                filter_=_compile_filter(
+                    cfg.get("filter"),
+                    f"route from {source_name!r} to {sink_name!r}",
+                ),
+                rewrite=_compile_rewrite(
+                    cfg.get("rewrite", []),
+                    f"route from {source_name!r} to {sink_name!r}",
+                ),
             )
         )
 
@@ -470,8 +604,20 @@ def compile_config(root_cfg: typing.Mapping):
         metric_relay.interface.DataClass.STREAM,
     )
 
+    if root_cfg["state_directory"] is not None:
+        state_directory = pathlib.Path(root_cfg["state_directory"])
+    else:
+        state_directory = None
+
+    if state_directory is None and any(
+            route.persistent for route in batch_routes + stream_routes):
+        raise ConfigError(
+            "persistent routes require state_directory to be set"
+        )
+
     return Config(
         logging=logging_config,
+        state_directory=state_directory,
         transports=transports,
         sinks=sinks,
         sources=sources,
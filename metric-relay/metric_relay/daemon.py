@@ -1,37 +1,108 @@
 import asyncio
 import dataclasses
 import logging
+import pathlib
 import signal
 import typing
 
 import hintlib.services
 
-from . import interface, queue
+from . import filters, interface, queue, rewrite
 
 
 @dataclasses.dataclass
 class Route:
     from_: interface.Source
     to: interface.Sink
+    data_class: interface.DataClass
     persistent: bool
+    queue_directory: typing.Optional[pathlib.Path] = None
+    max_depth: typing.Optional[int] = None
+    overflow_policy: queue.OverflowPolicy = queue.OverflowPolicy.DROP_OLD
+    max_batch_size: int = 1000
+    linger: float = 0
+    filter_: typing.Optional[filters.Filter] = None
+    rewriter: typing.Optional[rewrite.Rewriter] = None
 
 
-def fanout(logger, sinks):
-    async def fanout_impl(data: interface.DataChunk):
-        try:
-            await asyncio.gather(*(
-                sink(data)
-                for sink in sinks
-            ))
-        except Exception as exc:
-            logger.error("failed to fanout sample to some or all sinks",
-                         exc_info=True)
-            raise
+def _countdown(n, cb):
+    """
+    Return a callable which calls `cb` on its `n`-th call.
+    """
+    remaining = n
+
+    def countdown_impl():
+        nonlocal remaining
+        remaining -= 1
+        if remaining == 0:
+            cb()
+
+    return countdown_impl
+
+
+def fanout(logger, sinks_by_class):
+    """
+    Create an `on_data` handler which passes data to all sinks registered
+    for its data class.
+
+    The sinks must be non-blocking callables (such as
+    :meth:`.queue.Queue.push_nowait`). Each sink is called independently: an
+    error or a full queue in one route only affects that route, and the
+    source is never blocked by the sinks.
+
+    If a `done_cb` is given, it is called once all sinks are done with the
+    data (see :meth:`.queue.Queue.push_nowait`).
+    """
+    async def fanout_impl(data: interface.DataChunk,
+                          done_cb: typing.Optional[typing.Callable] = None):
+        sinks = sinks_by_class.get(data.class_, [])
+        if done_cb is not None:
+            # one extra call so that done_cb is not called before the data
+            # has been passed to all sinks
+            done_cb = _countdown(len(sinks) + 1, done_cb)
+        for sink in sinks:
+            try:
+                sink(data, done_cb)
+            except asyncio.QueueFull:
+                # already accounted for by the queue
+                if done_cb is not None:
+                    done_cb()
+            except Exception:
+                logger.error("failed to fanout data to sink %r", sink,
+                             exc_info=True)
+                if done_cb is not None:
+                    done_cb()
+        if done_cb is not None:
+            done_cb()
 
     return fanout_impl
 
 
+def transformed(transforms, sink):
+    """
+    Apply a sequence of transforms (such as a :class:`.filters.Filter` or a
+    :class:`.rewrite.Rewriter`) to data before passing it to `sink`.
+    """
+    def transformed_impl(data: interface.DataChunk,
+                         done_cb: typing.Optional[typing.Callable] = None):
+        for transform in transforms:
+            data = transform.apply(data)
+            if data is None:
+                if done_cb is not None:
+                    done_cb()
+                return
+        sink(data, done_cb)
+
+    return transformed_impl
+
+
 class MetricRelay:
+    DEFAULT_EPHEMERAL_MAX_DEPTH = 16
+    DEFAULT_PERSISTENT_MAX_DEPTH = 4096
+    #: Time in seconds which the queues get on shutdown to pass the data
+    #: they hold in memory to their sinks.
+    SHUTDOWN_DRAIN_TIMEOUT = 5
+
     def __init__(
             self,
             *,
@@ -40,45 +111,138 @@ class MetricRelay:
             sinks: typing.List[interface.Sink],
             routes: typing.List[Route],
             logger: logging.Logger,
+            metrics_interval: typing.Optional[float] = 60,
             ):
         super().__init__()
         self._transports = transports
         self._sources = sources
         self._sinks = sinks
         self._logger = logger
+        self._metrics_interval = metrics_interval
         self._queues = []
+        # rewriters with held back data and the queues they feed
+        self._rewriters = []
 
         routes_by_source = {}
         for route in routes:
             routes_by_source.setdefault(route.from_, []).append(route)
 
         for source, routes in routes_by_source.items():
-            queues = [
-                queue.EphemeralQueue(
-                    logger=route.to.logger.getChild("input-queue"),
-                    max_depth=16,
-                    sink=route.to.submit,
-                    overflow_policy=queue.OverflowPolicy.DROP_OLD,
-                )
-                for route in routes
-            ]
-            self._queues.extend(queues)
-            sinks = [q.push for q in queues]
-            fanout_instance = fanout(logger.getChild("fanout"), sinks)
+            sinks_by_class = {}
+            for route in routes:
+                q = self._make_queue(route)
+                self._queues.append(q)
+                sink = q.push_nowait
+                transforms = [
+                    transform
+                    for transform in [route.filter_, route.rewriter]
+                    if transform is not None
+                ]
+                if route.rewriter is not None:
+                    self._rewriters.append((route.rewriter, q))
+                if transforms:
+                    sink = transformed(transforms, sink)
+                sinks_by_class.setdefault(route.data_class, []).append(sink)
+            fanout_instance = fanout(logger.getChild("fanout"),
+                                     sinks_by_class)
             source.on_data = fanout_instance
 
+    def _make_queue(self, route: Route) -> queue.Queue:
+        logger = route.to.logger.getChild("input-queue")
+        if route.persistent:
+            return queue.PersistentQueue(
+                directory=route.queue_directory,
+                logger=logger,
+                max_depth=(route.max_depth or
+                           self.DEFAULT_PERSISTENT_MAX_DEPTH),
+                sink=route.to.submit,
+                overflow_policy=route.overflow_policy,
+                max_batch_size=route.max_batch_size,
+                linger=route.linger,
+            )
+
+        return queue.EphemeralQueue(
+            logger=logger,
+            max_depth=route.max_depth or self.DEFAULT_EPHEMERAL_MAX_DEPTH,
+            sink=route.to.submit,
+            overflow_policy=route.overflow_policy,
+            max_batch_size=route.max_batch_size,
+            linger=route.linger,
+        )
+
+    def _log_queue_metrics(self, q: queue.Queue):
+        metrics = q.metrics
+        enqueue_rate, dequeue_rate = metrics.rates()
+        percentiles = metrics.time_in_queue_percentiles((50, 90, 99))
+        q.logger.info(
+            "depth=%d enqueue=%.2f/s dequeue=%.2f/s retries=%d failed=%d "
+            "drops=%s time-in-queue p50/p90/p99=%s",
+            q.depth,
+            enqueue_rate,
+            dequeue_rate,
+            metrics.retries,
+            metrics.failed,
+            ",".join(
+                "{}:{}".format(policy.value, count)
+                for policy, count in metrics.drops.items()
+            ),
+            "/".join(
+                "-" if value is None else "{:.3f}s".format(value)
+                for value in percentiles.values()
+            ),
+        )
+
+    async def _report_metrics(self):
+        while True:
+            await asyncio.sleep(self._metrics_interval)
+            for q in self._queues:
+                self._log_queue_metrics(q)
+
+    def _flush_rewriters(self):
+        for rewriter, q in self._rewriters:
+            data = rewriter.flush()
+            if data is None:
+                continue
+            try:
+                q.push_nowait(data)
+            except asyncio.QueueFull:
+                pass
+
+    async def _drain_queues(self):
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(q.drain() for q in self._queues)),
+                self.SHUTDOWN_DRAIN_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            self._logger.warning(
+                "DATA LOSS: queues not drained within %d seconds",
+                self.SHUTDOWN_DRAIN_TIMEOUT,
+            )
+
+    @staticmethod
+    async def _stop_tasks(tasks):
+        for task in tasks:
+            task.stop()
+        await asyncio.gather(*(
+            task.wait_for_termination()
+            for task in tasks
+        ), return_exceptions=True)
+
     async def run(self):
+        source_tasks = []
+        for source in self._sources:
+            source_tasks.append(hintlib.services.RestartingTask(
+                source.run,
+                logger=source.logger.getChild("supervisor"),
+            ))
+
         tasks = []
         for transport in self._transports:
             tasks.append(hintlib.services.RestartingTask(
                 transport.run,
                 logger=transport.logger.getChild("supervisor"),
             ))
-        for source in self._sources:
-            tasks.append(hintlib.services.RestartingTask(
-                source.run,
-                logger=source.logger.getChild("supervisor"),
-            ))
         for sink in self._sinks:
             tasks.append(hintlib.services.RestartingTask(
                 sink.run,
@@ -89,17 +253,24 @@ class MetricRelay:
                 q.run,
                 logger=q.logger.getChild("supervisor"),
             ))
+        if self._metrics_interval is not None:
+            tasks.append(hintlib.services.RestartingTask(
+                self._report_metrics,
+                logger=self._logger.getChild("metrics"),
+            ))
 
         try:
-            for task in tasks:
+            for task in source_tasks + tasks:
                 task.start()
 
             while True:
                 await asyncio.sleep(3600)
         finally:
-            for task in tasks:
-                task.stop()
-            await asyncio.gather(*(
-                task.wait_for_termination()
-                for task in tasks
-            ), return_exceptions=True)
+            # stop the sources first, so that the data held back by the
+            # rewriters and the ephemeral queues still reaches the sinks
+            await self._stop_tasks(source_tasks)
+            self._flush_rewriters()
+            await self._drain_queues()
+            await self._stop_tasks(tasks)
+            for q in self._queues:
+                q.close()
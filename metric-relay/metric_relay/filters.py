@@ -0,0 +1,281 @@
+import dataclasses
+import itertools
+import numbers
+import typing
+
+import schema
+
+import hintlib.sample
+
+from . import interface
+
+
+ANY = object()
+
+
+_action = schema.And(str, schema.Use(str.lower), schema.Or("accept", "drop"))
+_instance = schema.Or(str, int)
+
+PATH_MATCH_SCHEMA = {
+    schema.Optional("module", default=ANY): str,
+    schema.Optional("part", default=ANY): str,
+    schema.Optional("instance", default=ANY): _instance,
+}
+
+_PATH_SCHEMA = {
+    **PATH_MATCH_SCHEMA,
+    "action": _action,
+}
+
+
+def path_matches(path, module, part, instance) -> bool:
+    """
+    Check whether the bare `path` matches the given `module`, `part` and
+    `instance`, any of which may be :data:`ANY`.
+    """
+    return (
+        (module is ANY or path.module == module) and
+        (part is ANY or path.part == part) and
+        (instance is ANY or path.instance == instance)
+    )
+
+
+@dataclasses.dataclass(frozen=True)
+class RuleConfig:
+    accept: bool
+    module: object
+    part: object
+    instance: object
+    subparts: typing.Optional[typing.FrozenSet[str]] = None
+    min_: typing.Optional[numbers.Real] = None
+    max_: typing.Optional[numbers.Real] = None
+
+
+class Rule:
+    """
+    A single filter rule.
+
+    A rule matches a sample if the bare path of its batch matches the
+    `module`, `part` and `instance` of the rule (:data:`ANY` matches
+    everything), its subpart is in `subparts` (unless that is :data:`None`)
+    and its value is within the closed interval given by `min_` and `max_`
+    (if any of those is not :data:`None`).
+    """
+
+    def __init__(self, *, config: RuleConfig):
+        super().__init__()
+        self.accept = config.accept
+        self.module = config.module
+        self.part = config.part
+        self.instance = config.instance
+        self.subparts = config.subparts
+        self.min_ = config.min_
+        self.max_ = config.max_
+
+    @classmethod
+    def get_config_schema(cls) -> schema.Schema:
+        return schema.Schema(_PATH_SCHEMA)
+
+    @classmethod
+    def compile_config(cls, cfg: typing.Mapping) -> RuleConfig:
+        return RuleConfig(
+            accept=cfg["action"] == "accept",
+            module=cfg["module"],
+            part=cfg["part"],
+            instance=cfg["instance"],
+            subparts=cfg.get("subparts"),
+            min_=cfg.get("min"),
+            max_=cfg.get("max"),
+        )
+
+    @property
+    def has_range(self) -> bool:
+        return self.min_ is not None or self.max_ is not None
+
+    @property
+    def unconditional(self) -> bool:
+        """
+        True if the rule matches all samples of a matching path.
+        """
+        return self.subparts is None and not self.has_range
+
+    def matches(self, subpart, value) -> bool:
+        """
+        Check whether the rule matches a sample of a matching path.
+
+        Pass :data:`None` as `value` if no value is known (e.g. for
+        streams); rules with a value range never match such samples.
+        """
+        if self.subparts is not None and subpart not in self.subparts:
+            return False
+        if not self.has_range:
+            return True
+        if not isinstance(value, numbers.Real):
+            return False
+        if self.min_ is not None and value < self.min_:
+            return False
+        if self.max_ is not None and value > self.max_:
+            return False
+        return True
+
+
+class PathRule(Rule):
+    pass
+
+
+class SubpartsRule(Rule):
+    @classmethod
+    def get_config_schema(cls) -> schema.Schema:
+        return schema.Schema({
+            **_PATH_SCHEMA,
+            "subparts": schema.And([str], schema.Use(frozenset)),
+        })
+
+
+class RangeRule(Rule):
+    @classmethod
+    def get_config_schema(cls) -> schema.Schema:
+        return schema.Schema({
+            **_PATH_SCHEMA,
+            schema.Optional("subparts"): schema.And(
+                [str],
+                schema.Use(frozenset),
+            ),
+            schema.Optional("min"): numbers.Real,
+            schema.Optional("max"): numbers.Real,
+        })
+
+
+RULE_TYPES = {
+    "path": PathRule,
+    "subparts": SubpartsRule,
+    "range": RangeRule,
+}
+
+
+class Filter:
+    """
+    Compiled set of filter rules.
+
+    :param rules: The rules, in order of precedence.
+    :param accept_by_default: Whether samples which are not matched by any
+                              rule are accepted.
+
+    For each sample, the first matching rule decides whether the sample is
+    accepted. Batches which have no samples left are dropped altogether.
+
+    The rules are indexed by the `(module, part, instance)` triple they
+    apply to, and the applicable rules for a bare path are resolved only
+    once. The cost per batch thus does not depend on the total number of
+    rules.
+    """
+
+    MAX_CACHE_SIZE = 4096
+
+    def __init__(self, rules: typing.Iterable[Rule],
+                 accept_by_default: bool):
+        super().__init__()
+        self._accept_by_default = accept_by_default
+        self._index = {}
+        for order, rule in enumerate(rules):
+            self._index.setdefault(
+                (rule.module, rule.part, rule.instance),
+                [],
+            ).append((order, rule))
+        self._cache = {}
+
+    def _rules_for(self, module, part, instance) -> typing.Sequence[Rule]:
+        key = (module, part, instance)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        candidates = []
+        for index_key in itertools.product((module, ANY),
+                                           (part, ANY),
+                                           (instance, ANY)):
+            candidates.extend(self._index.get(index_key, ()))
+        candidates.sort(key=lambda x: x[0])
+
+        rules = []
+        for _, rule in candidates:
+            rules.append(rule)
+            if rule.unconditional:
+                # no rule after this one can ever match
+                break
+        rules = tuple(rules)
+
+        if len(self._cache) >= self.MAX_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[key] = rules
+        return rules
+
+    def _accepts(self, rules, subpart, value) -> bool:
+        for rule in rules:
+            if rule.matches(subpart, value):
+                return rule.accept
+        return self._accept_by_default
+
+    def filter_batch(
+            self,
+            batch: hintlib.sample.SampleBatch,
+            ) -> typing.Optional[hintlib.sample.SampleBatch]:
+        path = batch.bare_path
+        rules = self._rules_for(path.module, path.part, path.instance)
+        if not rules:
+            return batch if self._accept_by_default else None
+        if rules[0].unconditional:
+            return batch if rules[0].accept else None
+
+        samples = {
+            subpart: value
+            for subpart, value in batch.samples.items()
+            if self._accepts(rules, subpart, value)
+        }
+        if not samples:
+            return None
+        if len(samples) == len(batch.samples):
+            return batch
+        return hintlib.sample.SampleBatch(
+            timestamp=batch.timestamp,
+            bare_path=batch.bare_path,
+            samples=samples,
+        )
+
+    def filter_stream_block(
+            self,
+            block: hintlib.sample.StreamBlock,
+            ) -> typing.Optional[hintlib.sample.StreamBlock]:
+        path = block.path
+        rules = self._rules_for(path.module, path.part, path.instance)
+        if self._accepts(rules, path.subpart, None):
+            return block
+        return None
+
+    def apply(
+            self,
+            data: interface.DataChunk,
+            ) -> typing.Optional[interface.DataChunk]:
+        """
+        Filter a data chunk.
+
+        :return: The filtered chunk or :data:`None` if nothing is left.
+        """
+        if data.class_ == interface.DataClass.STREAM:
+            if self.filter_stream_block(data.data) is None:
+                return None
+            return data
+
+        batches = []
+        changed = False
+        for batch in data.data:
+            filtered_batch = self.filter_batch(batch)
+            changed = changed or filtered_batch is not batch
+            if filtered_batch is not None:
+                batches.append(filtered_batch)
+        if not batches:
+            return None
+        if not changed:
+            return data
+        return interface.DataChunk.from_sample_batches(batches)
@@ -1,19 +1,28 @@
+import array
+import asyncio
 import base64
-import calendar
 import dataclasses
 import functools
 import enum
 import itertools
+import numbers
 import operator
 import re
+import sys
 import typing
+import zlib
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 import schema
 
 import aiohttp
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import hintlib.sample
 
 from . import interface
@@ -50,6 +59,19 @@ _TRANSPORT_SCHEMA = schema.Schema({
     "api_url": str,
     "api_version": "v1",
     schema.Optional("auth", default=None): _AUTH_SCHEMA,
+    schema.Optional("max_connections", default=4): schema.And(
+        int,
+        lambda x: x > 0,
+    ),
+    schema.Optional("keepalive_timeout", default=30.0): schema.And(
+        numbers.Real,
+        lambda x: x > 0,
+    ),
+    schema.Optional("gzip", default=False): bool,
+    schema.Optional("gzip_level", default=6): schema.And(
+        int,
+        lambda x: 1 <= x <= 9,
+    ),
 })
 
 
@@ -86,6 +108,10 @@ class AuthConfig:
 class TransportConfig:
     api_url: str
     auth: typing.Optional[AuthConfig]
+    max_connections: int
+    keepalive_timeout: float
+    gzip: bool
+    gzip_level: int
 
 
 @dataclasses.dataclass(frozen=True)
@@ -152,6 +178,76 @@ def _divround(v: int, divisor: int) -> int:
     return v
 
 
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_PRECISION_DIVISORS = {
+    Precision.NANOSECONDS: 1,
+    Precision.MICROSECONDS: 1000,
+    Precision.MILLISECONDS: 1000000,
+    Precision.SECONDS: 1000000000,
+}
+
+
+def _timedelta_ns(delta: timedelta) -> int:
+    return (
+        (delta.days * 86400 + delta.seconds) * 1000000 +
+        delta.microseconds
+    ) * 1000
+
+
+def _timestamp_ns(dt: datetime, ns_part: int = 0) -> int:
+    # naive datetimes are UTC
+    return _timedelta_ns(
+        dt - (_EPOCH if dt.tzinfo is None else _EPOCH_UTC)
+    ) + ns_part
+
+
+def _round_timestamp(full_timestamp: int, divisor: int) -> int:
+    if divisor == 1:
+        return full_timestamp
+    return _divround(full_timestamp, divisor)
+
+
+def _expand_timestamps(t0: int, period: int, count: int,
+                       divisor: int) -> typing.Sequence[int]:
+    """
+    Return the `count` timestamps ``t0 + i * period``, rounded to `divisor`.
+
+    All values are integer nanoseconds. NumPy is used if it is available.
+    """
+    if numpy is not None:
+        timestamps = numpy.arange(count, dtype=numpy.int64)
+        timestamps *= period
+        timestamps += t0
+        if divisor != 1:
+            # equivalent to _divround
+            timestamps += divisor // 2
+            timestamps //= divisor
+        return timestamps.tolist()
+
+    timestamps = range(t0, t0 + count * period, period) if period else \
+        [t0] * count
+    if divisor == 1:
+        return timestamps
+    return [_divround(timestamp, divisor) for timestamp in timestamps]
+
+
+def _stream_values(
+        data: typing.Union[typing.Sequence[numbers.Real],
+                           hintlib.sample.EncodedStreamData],
+        ) -> typing.Sequence[numbers.Real]:
+    if not isinstance(data, hintlib.sample.EncodedStreamData):
+        return data
+    if data.compressed:
+        raise ValueError("compressed stream data is not supported")
+    # stream data is stored little-endian
+    values = array.array(data.sample_type, data.data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
 def encode_timestamp(dt: datetime, ns_part: int,
                      precision: Precision) -> bytes:
     if precision == Precision.AUTO:
@@ -160,19 +256,10 @@ def encode_timestamp(dt: datetime, ns_part: int,
         raise ValueError(
             f"nanosecond part must be in 0..999, got {ns_part}"
         )
-    utc_seconds = calendar.timegm(dt.utctimetuple())
-    full_timestamp = (
-        (utc_seconds * 1000000 + dt.microsecond) * 1000 + ns_part
-    )
-
-    if precision == Precision.MICROSECONDS:
-        full_timestamp = _divround(full_timestamp, 1000)
-    elif precision == Precision.MILLISECONDS:
-        full_timestamp = _divround(full_timestamp, 1000000)
-    elif precision == Precision.SECONDS:
-        full_timestamp = _divround(full_timestamp, 1000000000)
-
-    return str(full_timestamp).encode("utf-8")
+    return str(_round_timestamp(
+        _timestamp_ns(dt, ns_part),
+        _PRECISION_DIVISORS[precision],
+    )).encode("ascii")
 
 
 def encode_tag_pair(t: typing.Tuple[str, str]) -> bytes:
@@ -209,6 +296,154 @@ class InfluxDBSample(typing.NamedTuple):
         return b" ".join(parts) + b"\n"
 
 
+class LineProtocolEncoder:
+    """
+    Encoder for sample batches to InfluxDB line protocol.
+
+    :param precision: The timestamp precision to encode for.
+
+    The sample batches are encoded directly, without intermediate
+    :class:`InfluxDBSample` objects. The escaped measurement and tags are
+    cached per bare path and the escaped field keys per subpart, so that the
+    escaping is only done once for each series.
+
+    The measurement is the part of the bare path, the module and the
+    instance (if not :data:`None`) are encoded as tags. A sample without a
+    subpart is encoded as field ``value``.
+    """
+
+    MAX_CACHE_SIZE = 4096
+
+    def __init__(self, precision: Precision):
+        super().__init__()
+        if precision == Precision.AUTO:
+            raise ValueError("auto precision not supported for encoding")
+        self._divisor = _PRECISION_DIVISORS[precision]
+        self._prefixes = {}
+        self._field_keys = {}
+
+    def _get_prefix(self, bare_path) -> bytes:
+        try:
+            return self._prefixes[bare_path]
+        except KeyError:
+            pass
+
+        parts = [
+            encode_measurement_name(bare_path.part),
+            b",module=",
+            encode_tag_part(bare_path.module),
+        ]
+        if bare_path.instance is not None:
+            parts.append(b",instance=")
+            parts.append(encode_tag_part(str(bare_path.instance)))
+        parts.append(b" ")
+        prefix = b"".join(parts)
+
+        if len(self._prefixes) >= self.MAX_CACHE_SIZE:
+            self._prefixes.clear()
+        self._prefixes[bare_path] = prefix
+        return prefix
+
+    def _get_field_key(self, key) -> bytes:
+        try:
+            return self._field_keys[key]
+        except KeyError:
+            pass
+
+        encoded = encode_field_key(
+            "value" if key is None else key
+        ) + b"="
+
+        if len(self._field_keys) >= self.MAX_CACHE_SIZE:
+            self._field_keys.clear()
+        self._field_keys[key] = encoded
+        return encoded
+
+    def encode_batch_into(self,
+                          buf: bytearray,
+                          batch: hintlib.sample.SampleBatch):
+        """
+        Append the line for `batch` to `buf`.
+        """
+        samples = batch.samples
+        if None in samples and len(samples) > 1:
+            raise ValueError("malformed sample batch")
+
+        buf += self._get_prefix(batch.bare_path)
+        first = True
+        for key, value in samples.items():
+            if not first:
+                buf += b","
+            first = False
+            buf += self._get_field_key(key)
+            value_type = type(value)
+            if value_type is float:
+                buf += repr(value).encode("ascii")
+            elif value_type is int:
+                buf += b"%di" % value
+            else:
+                buf += encode_field_value(value)
+        buf += b" %d\n" % _round_timestamp(
+            _timestamp_ns(batch.timestamp),
+            self._divisor,
+        )
+
+    def encode_batches(
+            self,
+            batches: typing.Iterable[hintlib.sample.SampleBatch],
+            ) -> bytearray:
+        """
+        Encode `batches` into a single buffer, one line per batch.
+        """
+        buf = bytearray()
+        for batch in batches:
+            self.encode_batch_into(buf, batch)
+        return buf
+
+    def encode_stream_block(
+            self,
+            block: hintlib.sample.StreamBlock,
+            chunk_size: int,
+            ) -> typing.Generator[bytes, None, None]:
+        """
+        Encode the samples of a stream block, one line per sample.
+
+        :param chunk_size: Maximum number of lines per chunk.
+        :return: Generator of encoded chunks.
+
+        The timestamp of the i-th sample is ``timestamp + i * period``. The
+        subpart of the stream path is used as field key.
+        """
+        path = block.path
+        values = _stream_values(block.data)
+        timestamps = _expand_timestamps(
+            _timestamp_ns(block.timestamp),
+            _timedelta_ns(block.period),
+            len(values),
+            self._divisor,
+        )
+
+        head = (
+            self._get_prefix(path.replace(subpart=None)) +
+            self._get_field_key(path.subpart)
+        ).replace(b"%", b"%%")
+        typecode = getattr(values, "typecode", None)
+        if typecode is not None:
+            # array.array or compatible, such as lazily loaded stream data
+            is_float = typecode in "fd"
+            values = values.tolist()
+        else:
+            is_float = any(type(value) is float for value in values)
+        line_format = head + (b"%r %d\n" if is_float else b"%di %d\n")
+
+        for start in range(0, len(values), chunk_size):
+            end = start + chunk_size
+            yield b"".join([
+                line_format % item
+                for item in zip(values[start:end], timestamps[start:end])
+            ])
+
+
 T = typing.TypeVar("T")
 
 
@@ -226,20 +461,31 @@ def batcher(
         yield map(operator.itemgetter(1), batch_items)
 
 
-async def _sample_encoder(
-        sample_batches: typing.AsyncIterable[
-            typing.Iterable[InfluxDBSample]],
-        precision: Precision):
-    async for samples in sample_batches:
-        yield b"".join(sample.encode(precision) for sample in samples)
+async def _batch_encoder(
+        batches: typing.Iterable[hintlib.sample.SampleBatch],
+        encoder: LineProtocolEncoder,
+        batch_size: int):
+    for group in batcher(batches, batch_size):
+        yield encoder.encode_batches(group)
 
 
-async def _async_batcher(
-        iterable: typing.Iterable[T],
-        batch_size: int,
-        ) -> typing.AsyncGenerator[typing.List[T], None]:
-    for batch in batcher(iterable, batch_size):
-        yield list(batch)
+async def _gzip_encoder(
+        chunks: typing.AsyncIterable[bytes],
+        level: int):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def _stream_encoder(
+        block: hintlib.sample.StreamBlock,
+        encoder: LineProtocolEncoder,
+        chunk_size: int):
+    for chunk in encoder.encode_stream_block(block, chunk_size):
+        yield chunk
 
 
 class InfluxDBError(Exception):
@@ -262,9 +508,23 @@ class InfluxDBNotFoundError(InfluxDBError):
 
 
 class HTTPAPITransport(interface.Transport):
+    """
+    Transport for the InfluxDB HTTP API.
+
+    The transport owns a single :class:`aiohttp.ClientSession` with a pool
+    of at most `max_connections` keep-alive connections, which is shared by
+    all sinks using the transport. The session exists while :meth:`run` is
+    running; writes wait for it to become available.
+
+    If `gzip` is enabled, the request bodies are compressed on the fly as
+    the line protocol is generated and sent with ``Content-Encoding: gzip``.
+    """
+
     def __init__(self, *, config: TransportConfig, **kwargs):
         super().__init__(config=config, **kwargs)
         self._cfg = config
+        self._session = None
+        self._session_ready = asyncio.Event()
 
     @classmethod
     def get_config_schema(cls) -> schema.Schema:
@@ -280,16 +540,40 @@ class HTTPAPITransport(interface.Transport):
         return TransportConfig(
             api_url=api_url,
             auth=auth,
+            max_connections=cfg["max_connections"],
+            keepalive_timeout=cfg["keepalive_timeout"],
+            gzip=cfg["gzip"],
+            gzip_level=cfg["gzip_level"],
         )
 
+    async def run(self):
+        connector = aiohttp.TCPConnector(
+            limit=self._cfg.max_connections,
+            keepalive_timeout=self._cfg.keepalive_timeout,
+        )
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self._session = session
+            self._session_ready.set()
+            try:
+                await super().run()
+            finally:
+                self._session_ready.clear()
+                self._session = None
+
     async def write(
             self,
-            session: aiohttp.ClientSession,
             database: str,
             retention_policy: typing.Optional[str],
             precision: Precision,
-            samples: typing.AsyncIterable[typing.Iterable[InfluxDBSample]],
+            lines: typing.AsyncIterable[bytes],
             auth: typing.Optional[AuthConfig] = None):
+        """
+        Write line protocol data to the database.
+
+        :param lines: Chunks of encoded line protocol, for example as
+                      generated by :meth:`LineProtocolEncoder.encode_batches`
+                      or :meth:`LineProtocolEncoder.encode_stream_block`.
+        """
         if auth is None:
             auth = self._cfg.auth
 
@@ -302,12 +586,16 @@ class HTTPAPITransport(interface.Transport):
         params["precision"] = precision.value
         if retention_policy is not None:
             params["rp"] = retention_policy
+        if self._cfg.gzip:
+            headers["Content-Encoding"] = "gzip"
+            lines = _gzip_encoder(lines, self._cfg.gzip_level)
 
-        async with session.post(
+        await self._session_ready.wait()
+        async with self._session.post(
                 write_url,
                 headers=headers,
                 params=params,
-                data=_sample_encoder(samples, precision)) as resp:
+                data=lines) as resp:
             if resp.status == 401 or resp.status == 403:
                 raise InfluxDBPermissionError(resp.status, resp.reason)
             elif resp.status == 400 or resp.status == 413:
@@ -322,6 +610,10 @@ class Sink(interface.Sink[SinkConfig]):
     def __init__(self, *, config: SinkConfig, **kwargs):
         super().__init__(config=config, **kwargs)
         self._cfg = config
+        self._precision = config.precision
+        if self._precision == Precision.AUTO:
+            self._precision = Precision.MILLISECONDS
+        self._encoder = LineProtocolEncoder(self._precision)
 
     @classmethod
     def get_config_schema(cls) -> schema.Schema:
@@ -342,7 +634,8 @@ class Sink(interface.Sink[SinkConfig]):
 
     @classmethod
     def accepts(cls, dataclass: interface.DataClass) -> bool:
-        return dataclass == interface.DataClass.SAMPLE_BATCH
+        return dataclass in (interface.DataClass.SAMPLE_BATCH,
+                             interface.DataClass.STREAM)
 
     @classmethod
     def supports_transport(cls,
@@ -350,49 +643,89 @@ class Sink(interface.Sink[SinkConfig]):
                            config: SinkConfig) -> bool:
         return issubclass(transport_class, HTTPAPITransport)
 
-    def _convert_samples(
+    async def _write(self, lines: typing.AsyncIterable[bytes]):
+        await self.transport.write(
+            self._cfg.database,
+            self._cfg.retention_policy,
+            self._precision,
+            lines,
+            self._cfg.auth,
+        )
+
+    async def _submit_batches(
             self,
-            sample_batches: typing.Sequence[hintlib.sample.SampleBatch],
-            ) -> typing.Generator[InfluxDBSample, None, None]:
-        for batch in sample_batches:
-            tags = [
-                ("module", batch.bare_path.module)
-            ]
-            if batch.bare_path.instance is not None:
-                tags.append(
-                    ("instance", batch.bare_path.instance),
+            batches: typing.Sequence[hintlib.sample.SampleBatch]):
+        try:
+            await self._write(_batch_encoder(batches, self._encoder, 1000))
+        except InfluxDBDataError as exc:
+            if len(batches) <= 1:
+                self.logger.error(
+                    "DATA LOSS: sample batch rejected by InfluxDB (%s): %r",
+                    exc, batches,
                 )
-
-            samples = dict(batch.samples)
-            if None in samples:
-                if len(samples) > 1:
-                    raise ValueError("malformed sample batch")
-                samples["value"] = samples.pop(None)
-
-            yield InfluxDBSample(
-                measurement=batch.bare_path.part,
-                tags=tuple(tags),
-                fields=tuple(samples.items()),
-                timestamp=batch.timestamp,
-                ns_part=0,
+                return
+            self.logger.warning(
+                "%d sample batches rejected by InfluxDB (%s), splitting",
+                len(batches), exc,
+            )
+            mid = len(batches) // 2
+            await self._submit_batches(batches[:mid])
+            await self._submit_batches(batches[mid:])
+
+    async def _submit_stream_block(self, block: hintlib.sample.StreamBlock):
+        try:
+            await self._write(_stream_encoder(block, self._encoder, 1000))
+        except InfluxDBDataError as exc:
+            values = _stream_values(block.data)
+            if len(values) <= 1:
+                self.logger.error(
+                    "DATA LOSS: stream sample of %s at %s rejected by "
+                    "InfluxDB (%s)",
+                    block.path, block.timestamp, exc,
+                )
+                return
+            self.logger.warning(
+                "%d stream samples of %s rejected by InfluxDB (%s), "
+                "splitting",
+                len(values), block.path, exc,
             )
+            mid = len(values) // 2
+            await self._submit_stream_block(hintlib.sample.StreamBlock(
+                timestamp=block.timestamp,
+                path=block.path,
+                seq0=block.seq0,
+                period=block.period,
+                data=values[:mid],
+            ))
+            await self._submit_stream_block(hintlib.sample.StreamBlock(
+                timestamp=block.timestamp + mid * block.period,
+                path=block.path,
+                seq0=(block.seq0 + mid) % 2**16,
+                period=block.period,
+                data=values[mid:],
+            ))
 
     async def submit(self, data: interface.DataChunk):
-        assert data.class_ == interface.DataClass.SAMPLE_BATCH
-
-        precision = self._cfg.precision
-        if precision == Precision.AUTO:
-            precision = Precision.MILLISECONDS
-
-        async with aiohttp.ClientSession() as session:
-            await self.transport.write(
-                session,
-                self._cfg.database,
-                self._cfg.retention_policy,
-                precision,
-                _async_batcher(
-                    self._convert_samples(data.data),
-                    1000,
-                ),
-                self._cfg.auth,
-            )
+        """
+        Write a data chunk to InfluxDB.
+
+        If InfluxDB rejects the data as malformed or too large, the chunk is
+        split in halves which are written separately, down to single sample
+        batches or stream samples, which are dropped if they are still
+        rejected. Thus, a bad sample does not block the queue. Parts which
+        have been written already are written again if the chunk is retried
+        due to another error; InfluxDB treats such writes as no-ops.
+        """
+        if data.class_ == interface.DataClass.STREAM:
+            block = data.data
+            if (isinstance(block.data, hintlib.sample.EncodedStreamData) and
+                    block.data.compressed):
+                self.logger.warning(
+                    "DATA LOSS: cannot write compressed stream data for %s",
+                    block.path,
+                )
+                return
+            await self._submit_stream_block(block)
+        else:
+            assert data.class_ == interface.DataClass.SAMPLE_BATCH
+            await self._submit_batches(list(data.data))
@@ -107,21 +107,34 @@ class Source(_SinkSourceBase[T], metaclass=abc.ABCMeta):
 
     @property
     def on_data(self) -> typing.Callable[..., typing.Awaitable]:
+        """
+        The listener for the emitted data.
+
+        It is called with the :class:`DataChunk` and a callback (or
+        :data:`None`), which it must call once it has finished processing
+        the data.
+        """
         return self._on_data
 
     @on_data.setter
     def on_data(self, cb: typing.Callable[..., typing.Awaitable]):
         self._on_data = cb
 
-    async def _emit(self, data: DataChunk):
+    async def _emit(self, data: DataChunk,
+                    done_cb: typing.Optional[typing.Callable] = None):
         """
         Emit `data` to the listener.
+
+        If `done_cb` is given, it is called when the listener has finished
+        processing the data.
         """
         if self._on_data is None:
             self.logger.warning("DATA LOSS: no on_data handler registered")
+            if done_cb is not None:
+                done_cb()
             return
 
-        await self._on_data(data)
+        await self._on_data(data, done_cb)
 
     def _emit_cb(self,
                  data: DataChunk,
@@ -132,21 +145,26 @@ class Source(_SinkSourceBase[T], metaclass=abc.ABCMeta):
         Emit `data` to the listener and call `done_cb` when the listener has
         finished processing the data.
 
-        Note that `done_cb` is always called, even if the data was not
-        processed successfully.
+        With the :func:`~.daemon.fanout` listener, this is when all routes
+        have submitted the data to their sink or written it to their
+        persistent queue. Note that `done_cb` is also called if the data was
+        not processed successfully.
         """
         loop = loop or asyncio.get_event_loop()
-        coro = self._emit(data)
+        coro = self._emit(data, done_cb)
         if timeout is not None:
             coro = asyncio.wait_for(coro, timeout, loop=loop)
         task = loop.create_task(coro)
 
         def on_done(task):
-            # just make all warnings go away
-            # TODO: maybe something smarter than this?
-            if task.exception() is None:
-                task.result()
-            done_cb()
+            if task.cancelled():
+                # the listener may hold on to the data; keep it with the
+                # source
+                return
+            if task.exception() is not None:
+                self.logger.error("failed to emit data",
+                                  exc_info=task.exception())
+                done_cb()
 
         task.add_done_callback(on_done)
 
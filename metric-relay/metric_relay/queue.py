@@ -1,12 +1,23 @@
 import abc
 import asyncio
 import collections
+import concurrent.futures
 import enum
+import functools
+import os
+import pathlib
+import pickle
+import struct
+import threading
+import time
 import typing
 import sys
+import zlib
 
 import hintlib.utils
 
+from . import interface
+
 
 class OverflowPolicy(enum.Enum):
     REJECT = "reject"
@@ -14,33 +25,149 @@ class OverflowPolicy(enum.Enum):
     DROP_NEW = "drop-new"
 
 
+class QueueMetrics:
+    """
+    Live counters of a queue.
+
+    :param latency_window: Number of most recent time-in-queue measurements
+                           to keep for percentile calculation.
+
+    .. attribute:: enqueued
+
+       Total number of items pushed into the queue.
+
+    .. attribute:: dequeued
+
+       Total number of items taken from the queue for submission.
+
+    .. attribute:: retries
+
+       Total number of submission retries.
+
+    .. attribute:: failed
+
+       Total number of items which could not be submitted.
+
+    .. attribute:: drops
+
+       Mapping of :class:`OverflowPolicy` to the number of items which were
+       dropped (or rejected) by the respective policy.
+    """
+
+    def __init__(self, latency_window: int = 1024):
+        super().__init__()
+        self.enqueued = 0
+        self.dequeued = 0
+        self.retries = 0
+        self.failed = 0
+        self.drops = {policy: 0 for policy in OverflowPolicy}
+        self._latencies = collections.deque(maxlen=latency_window)
+        self._rate_reference = (time.monotonic(), 0, 0)
+
+    def record_dequeue(self, time_in_queue: float):
+        self.dequeued += 1
+        self._latencies.append(time_in_queue)
+
+    def time_in_queue_percentiles(
+            self,
+            percentiles: typing.Iterable[int] = (50, 90, 99),
+            ) -> typing.Mapping[int, typing.Optional[float]]:
+        """
+        Return the time-in-queue percentiles (in seconds) over the recent
+        window of dequeued items.
+
+        If no items have been dequeued yet, the values are :data:`None`.
+        """
+        latencies = sorted(self._latencies)
+        result = {}
+        for percentile in percentiles:
+            if not latencies:
+                result[percentile] = None
+                continue
+            index = max(0, -(-len(latencies) * percentile // 100) - 1)
+            result[percentile] = latencies[index]
+        return result
+
+    def rates(self) -> typing.Tuple[float, float]:
+        """
+        Return the enqueue and dequeue rates (in items per second) since the
+        last call to this method.
+        """
+        now = time.monotonic()
+        t0, enqueued0, dequeued0 = self._rate_reference
+        self._rate_reference = (now, self.enqueued, self.dequeued)
+        dt = now - t0
+        if dt <= 0:
+            return 0.0, 0.0
+        return ((self.enqueued - enqueued0) / dt,
+                (self.dequeued - dequeued0) / dt)
+
+
 class Queue(metaclass=abc.ABCMeta):
     @abc.abstractmethod
-    def push(self, item):
-        pass
+    def push_nowait(self, item, done_cb: typing.Optional[
+            typing.Callable[[], None]] = None):
+        """
+        Push `item` into the queue without blocking.
+
+        :param done_cb: Called without arguments once the queue does not
+                        need the producer to keep `item` anymore: when it
+                        has been submitted to the sink (successfully or
+                        not), when it has been dropped or, for queues which
+                        store items on disk, when it has been synced.
+        :raises asyncio.QueueFull: if the queue is full and the overflow
+                                   policy is :attr:`OverflowPolicy.REJECT`.
+                                   `done_cb` is not called in that case.
+        """
+
+    async def push(self, item, done_cb=None):
+        self.push_nowait(item, done_cb)
+
+    @property
+    @abc.abstractmethod
+    def depth(self) -> int:
+        """
+        Number of items waiting in the queue.
+        """
 
     @abc.abstractmethod
     async def run(self):
         pass
 
+    async def drain(self):
+        """
+        Wait until all pushed items have been passed to the sink.
+
+        :meth:`run` must be running for this to complete. Queues which keep
+        their items across restarts need not be drained, so by default, this
+        returns immediately.
+        """
 
-class EphemeralQueue(Queue):
+    def close(self):
+        """
+        Release the resources of the queue.
+
+        The queue must not be used afterwards.
+        """
+
+
+class _SinkingQueue(Queue):
     def __init__(self, *,
                  sink: typing.Callable,
                  logger,
-                 max_depth: int,
                  overflow_policy: OverflowPolicy,
-                 max_retries: int = 0):
+                 max_retries: typing.Optional[int] = 0):
         super().__init__()
-        self._queue = collections.deque(maxlen=max_depth)
-        self._nonempty = asyncio.Condition()
+        self._nonempty = asyncio.Event()
         self._overflow_policy = overflow_policy
         self._sink = sink
         self._max_retries = max_retries
         self._retry_backoff = hintlib.utils.ExponentialBackOff()
         self.logger = logger
+        self.metrics = QueueMetrics()
 
     def _apply_overflow_policy(self):
+        self.metrics.drops[self._overflow_policy] += 1
         if self._overflow_policy == OverflowPolicy.REJECT:
             self.logger.debug("rejecting item due to overfull queue")
             raise asyncio.QueueFull
@@ -54,41 +181,44 @@ class EphemeralQueue(Queue):
         )
         return True
 
-    async def push(self, item):
-        await self._nonempty.acquire()
-        try:
-            if len(self._queue) == self._queue.maxlen:
-                if not self._apply_drop_policy():
-                    # drop new item
-                    return
+    async def _sink_with_retries(self, item) -> bool:
+        """
+        Submit `item` to the sink, retrying according to the configured
+        maximum number of retries.
 
-            self._queue.append(item)
-            self._nonempty.notify()
-        finally:
-            self._nonempty.release()
+        If `max_retries` is :data:`None`, submission is retried until it
+        succeeds.
 
-    async def _sink_with_retries(self, item):
+        :return: True if the item was submitted successfully, false otherwise.
+        """
         self._retry_backoff.reset()
         first_err = None
         last_err = None
-        for i in range(self._max_retries + 1):
+        attempt = 0
+        while True:
             try:
                 await self._sink(item)
             except Exception as exc:
                 last_err = sys.exc_info()
                 if first_err is None:
                     first_err = last_err
-                will_retry = i < self._max_retries
-                if will_retry:
-                    delay = next(self._retry_backoff)
-                    self.logger.warning(
-                        "failed to submit item %r to sink",
-                        item,
-                        exc_info=True
-                    )
-                    await asyncio.sleep(delay)
+                will_retry = (self._max_retries is None or
+                              attempt < self._max_retries)
+                if not will_retry:
+                    break
+                delay = next(self._retry_backoff)
+                self.logger.warning(
+                    "failed to submit item %r to sink",
+                    item,
+                    exc_info=True
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+                self.metrics.retries += 1
             else:
-                return
+                return True
+
+        self.metrics.failed += 1
 
         if first_err != last_err:
             self.logger.error(
@@ -105,13 +235,755 @@ class EphemeralQueue(Queue):
                 item,
                 exc_info=last_err,
             )
+        return False
+
+
+class EphemeralQueue(_SinkingQueue):
+    """
+    An in-memory queue.
+
+    :param max_batch_size: Maximum number of sample batches to coalesce into
+                           a single submission to the sink.
+    :param linger: Time in seconds to wait for more sample batches before
+                   submitting less than `max_batch_size` sample batches.
+
+    Sample batch chunks which are waiting in the queue are coalesced into a
+    single :class:`~.interface.DataChunk` in arrival order before they are
+    submitted to the sink. Stream chunks are never coalesced and are
+    submitted in order with the sample batches.
+    """
+
+    def __init__(self, *,
+                 sink: typing.Callable,
+                 logger,
+                 max_depth: int,
+                 overflow_policy: OverflowPolicy,
+                 max_retries: int = 0,
+                 max_batch_size: int = 1,
+                 linger: float = 0):
+        super().__init__(
+            sink=sink,
+            logger=logger,
+            overflow_policy=overflow_policy,
+            max_retries=max_retries,
+        )
+        self._queue = collections.deque()
+        self._max_depth = max_depth
+        self._max_batch_size = max_batch_size
+        self._linger = linger
+        # number of sample batches in the sample batch chunks at the head of
+        # the queue (counted up to max_batch_size) and whether that run of
+        # chunks extends to the end of the queue
+        self._head_batches = 0
+        self._head_open = True
+        # set while no item is queued or being submitted
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def _update_head_batches(self):
+        self._head_batches = 0
+        self._head_open = True
+        for _, item, _ in self._queue:
+            self._count_head_batches(item)
+            if not self._head_open:
+                break
+
+    def _count_head_batches(self, item):
+        if item.class_ != interface.DataClass.SAMPLE_BATCH:
+            self._head_open = False
+            return
+        self._head_batches += len(item.data)
+        if self._head_batches >= self._max_batch_size:
+            self._head_open = False
+
+    def push_nowait(self, item, done_cb=None):
+        if len(self._queue) >= self._max_depth:
+            if not self._apply_overflow_policy():
+                # drop new item
+                if done_cb is not None:
+                    done_cb()
+                return
+            _, _, dropped_done_cb = self._queue.popleft()
+            self._update_head_batches()
+            if dropped_done_cb is not None:
+                dropped_done_cb()
+
+        self._queue.append((time.monotonic(), item, done_cb))
+        self._idle.clear()
+        if self._head_open:
+            self._count_head_batches(item)
+        self.metrics.enqueued += 1
+        self._nonempty.set()
+
+    async def _linger_for_batches(self):
+        deadline = time.monotonic() + self._linger
+        while self._head_batches < self._max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return
+            self._nonempty.clear()
+            try:
+                await asyncio.wait_for(self._nonempty.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    def _pop_coalesced(self, done_cbs) -> interface.DataChunk:
+        """
+        Take the next item and coalesce the sample batch chunks following it.
+
+        The done callbacks of the taken items are appended to `done_cbs`.
+        """
+        now = time.monotonic()
+        enqueued_at, item, done_cb = self._queue.popleft()
+        self.metrics.record_dequeue(now - enqueued_at)
+        if done_cb is not None:
+            done_cbs.append(done_cb)
+        if (item.class_ != interface.DataClass.SAMPLE_BATCH or
+                len(item.data) >= self._max_batch_size):
+            self._update_head_batches()
+            return item
+
+        batches = list(item.data)
+        while self._queue:
+            enqueued_at, item, done_cb = self._queue[0]
+            if item.class_ != interface.DataClass.SAMPLE_BATCH:
+                break
+            if len(batches) + len(item.data) > self._max_batch_size:
+                break
+            self._queue.popleft()
+            self.metrics.record_dequeue(now - enqueued_at)
+            if done_cb is not None:
+                done_cbs.append(done_cb)
+            batches.extend(item.data)
+
+        self._update_head_batches()
+        return interface.DataChunk.from_sample_batches(batches)
 
     async def run(self):
         while True:
-            await self._nonempty.acquire()
-            try:
-                await self._nonempty.wait_for(lambda: len(self._queue) > 0)
-                item = self._queue.pop()
-            finally:
-                self._nonempty.release()
+            while not self._queue:
+                self._nonempty.clear()
+                await self._nonempty.wait()
+            if (self._linger and
+                    0 < self._head_batches < self._max_batch_size):
+                await self._linger_for_batches()
+            done_cbs = []
+            item = self._pop_coalesced(done_cbs)
+            # if the submission is cancelled, the callbacks are not called;
+            # the producer keeps the items then
             await self._sink_with_retries(item)
+            for done_cb in done_cbs:
+                done_cb()
+            if not self._queue:
+                self._idle.set()
+
+    async def drain(self):
+        await self._idle.wait()
+
+
+class PersistentQueue(_SinkingQueue):
+    """
+    A restart-safe queue backed by an append-only, segmented log on disk.
+
+    :param directory: Directory in which the log segments and the
+                      acknowledgement cursor are stored.
+    :type directory: :class:`pathlib.Path`
+    :param max_depth: Maximum number of items which have been pushed, but
+                      not yet taken for submission to the sink.
+    :param segment_size: Size in bytes after which a new segment is started.
+    :param sync_every: Number of written items after which the log is synced
+                       to disk.
+    :param sync_interval: Time in seconds after which pending writes are
+                          synced to disk at the latest.
+    :param max_retries: Number of retries for each item. If :data:`None`,
+                        items are retried until they are accepted by the
+                        sink.
+    :param max_batch_size: Maximum number of sample batches to coalesce into
+                           a single submission to the sink.
+    :param linger: Time in seconds to wait for more sample batches before
+                   submitting less than `max_batch_size` sample batches.
+
+    Sample batch chunks are coalesced like in :class:`EphemeralQueue`; the
+    cursor is moved past all coalesced items once the sink accepted them.
+
+    Pushed items are serialised, written and synced to disk by a worker
+    thread, so that pushing never blocks the event loop. Writes are synced
+    in batches, either after `sync_every` items or after `sync_interval`
+    seconds, whichever comes first. The done callback of a pushed item is
+    called once the item has been synced.
+
+    The position up to which items have been successfully submitted to the
+    sink (or dropped by the overflow policy) is tracked by a cursor file.
+    Segments which lie completely before the cursor are deleted. After a
+    restart, delivery resumes at the cursor; items may thus be submitted
+    more than once, but are not lost.
+    """
+
+    # payload length, crc32 of payload, enqueue time (UNIX timestamp)
+    _record_header = struct.Struct("<LLd")
+    # segment number, offset in segment
+    _cursor = struct.Struct("<QQ")
+
+    _SEGMENT_SUFFIX = ".seg"
+    _CURSOR_NAME = "cursor"
+
+    def __init__(self, *,
+                 directory: pathlib.Path,
+                 sink: typing.Callable,
+                 logger,
+                 max_depth: int,
+                 overflow_policy: OverflowPolicy,
+                 max_retries: typing.Optional[int] = None,
+                 max_batch_size: int = 1,
+                 linger: float = 0,
+                 segment_size: int = 4*1024*1024,
+                 sync_every: int = 64,
+                 sync_interval: float = 1.0):
+        super().__init__(
+            sink=sink,
+            logger=logger,
+            overflow_policy=overflow_policy,
+            max_retries=max_retries,
+        )
+        self._directory = directory
+        self._max_depth = max_depth
+        self._max_batch_size = max_batch_size
+        self._linger = linger
+        self._segment_size = segment_size
+        self._sync_every = sync_every
+        self._sync_interval = sync_interval
+
+        # all file operations run in the executor, under the lock; _segments
+        # and _index are appended to by the executor and consumed from the
+        # event loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="queue-",
+        )
+        self._io_lock = threading.Lock()
+
+        self._segments = collections.deque()
+        # (segment, start offset, end offset) of the written, unread records
+        self._index = collections.deque()
+        # records read from the log, but not taken for submission yet, as
+        # returned by _read_records
+        self._readahead = collections.deque()
+        # (enqueue time, item, done callback) of the pushed, not yet written
+        # items
+        self._pending = collections.deque()
+        # done callbacks of the items which are written, but not synced yet
+        self._unsynced_done = []
+        self._nwriting = 0
+        self._write_future = None
+        self._flush_task = None
+
+        self._writer = None
+        self._writer_segment = None
+        self._unsynced = 0
+        self._sync_handle = None
+
+        self._reader = None
+        self._reader_segment = None
+
+        self._acked = (0, 0)
+        self._cursor_dirty = False
+
+        directory.mkdir(parents=True, exist_ok=True)
+        self._recover()
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of items which have been pushed, but not taken yet.
+        """
+        return (len(self._readahead) + len(self._index) +
+                len(self._pending) + self._nwriting)
+
+    def _segment_path(self, segment: int) -> pathlib.Path:
+        return self._directory / "{:016x}{}".format(
+            segment,
+            self._SEGMENT_SUFFIX,
+        )
+
+    def _read_cursor(self) -> typing.Optional[typing.Tuple[int, int]]:
+        try:
+            with (self._directory / self._CURSOR_NAME).open("rb") as f:
+                return hintlib.utils.read_single(f, self._cursor)
+        except (OSError, EOFError, struct.error):
+            return None
+
+    def _write_cursor(self, acked: typing.Tuple[int, int]):
+        path = self._directory / self._CURSOR_NAME
+        tmp_path = path.with_suffix(".tmp")
+        with tmp_path.open("wb") as f:
+            f.write(self._cursor.pack(*acked))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _scan_segment(self, segment: int, offset: int) -> int:
+        """
+        Index the valid records in `segment` after `offset`.
+
+        A torn or corrupted record ends the segment; it is truncated at that
+        point.
+
+        :return: The number of valid records.
+        """
+        path = self._segment_path(segment)
+        nrecords = 0
+        with path.open("r+b") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(self._record_header.size)
+                if not header:
+                    break
+                if len(header) == self._record_header.size:
+                    length, crc, _ = self._record_header.unpack(header)
+                    payload = f.read(length)
+                    if (len(payload) == length and
+                            zlib.crc32(payload) == crc):
+                        end = offset + len(header) + length
+                        self._index.append((segment, offset, end))
+                        offset = end
+                        nrecords += 1
+                        continue
+
+                self.logger.warning(
+                    "truncating damaged segment %s at offset %d",
+                    path,
+                    offset,
+                )
+                f.truncate(offset)
+                break
+
+        return nrecords
+
+    def _recover(self):
+        segments = []
+        for path in self._directory.iterdir():
+            if path.suffix != self._SEGMENT_SUFFIX:
+                continue
+            try:
+                segments.append(int(path.stem, 16))
+            except ValueError:
+                continue
+        segments.sort()
+
+        cursor = self._read_cursor()
+        if cursor is None:
+            cursor = (segments[0] if segments else 0, 0)
+
+        ack_segment, ack_offset = cursor
+        for segment in segments:
+            if segment < ack_segment:
+                self._segment_path(segment).unlink()
+                continue
+            offset = ack_offset if segment == ack_segment else 0
+            self._scan_segment(segment, offset)
+            self._segments.append(segment)
+
+        if self._index:
+            self.logger.info("recovered %d unacknowledged items",
+                             len(self._index))
+
+        self._acked = cursor
+        # never append to a recovered segment, it may have been truncated
+        self._open_writer(max(segments[-1:] + [ack_segment]) + 1)
+
+    def _open_writer(self, segment: int):
+        if self._writer is not None:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._writer.close()
+        self._writer = self._segment_path(segment).open("xb")
+        self._writer_segment = segment
+        self._segments.append(segment)
+
+    def _write_records(self, records):
+        """
+        Write `records` to the log and index them. Runs in the executor.
+        """
+        with self._io_lock:
+            for enqueued_at, item, _ in records:
+                try:
+                    payload = pickle.dumps(item,
+                                           protocol=pickle.HIGHEST_PROTOCOL)
+                except Exception:  # NOQA
+                    self.logger.error(
+                        "DATA LOSS: failed to serialise item %r",
+                        item,
+                        exc_info=True,
+                    )
+                    continue
+                if self._writer.tell() >= self._segment_size:
+                    self._open_writer(self._writer_segment + 1)
+                start = self._writer.tell()
+                self._writer.write(self._record_header.pack(
+                    len(payload),
+                    zlib.crc32(payload),
+                    enqueued_at,
+                ))
+                self._writer.write(payload)
+                self._index.append(
+                    (self._writer_segment, start, self._writer.tell())
+                )
+                self._unsynced += 1
+
+            # make the records visible to the reader
+            self._writer.flush()
+            if self._unsynced >= self._sync_every:
+                os.fsync(self._writer.fileno())
+                self._unsynced = 0
+
+    def _read_record(self, segment: int, start: int, end: int):
+        """
+        Read the record at `start` in `segment`. Runs in the executor.
+
+        :return: The item and its enqueue time.
+        """
+        with self._io_lock:
+            if self._reader_segment != segment:
+                if self._reader is not None:
+                    self._reader.close()
+                self._reader = self._segment_path(segment).open("rb")
+                self._reader_segment = segment
+            self._reader.seek(start)
+            record = self._reader.read(end - start)
+
+        length, crc, enqueued_at = self._record_header.unpack_from(record)
+        payload = record[self._record_header.size:]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            raise ValueError("checksum mismatch in record at {}".format(
+                (segment, start)
+            ))
+        return pickle.loads(payload), enqueued_at
+
+    def _read_records(self, entries):
+        """
+        Read the records of `entries`. Runs in the executor.
+
+        :return: The entry, item, enqueue time and the error for each record;
+                 the item and the enqueue time are :data:`None` if the record
+                 could not be read.
+        """
+        results = []
+        for entry in entries:
+            try:
+                item, enqueued_at = self._read_record(*entry)
+            except (ValueError, pickle.UnpicklingError) as exc:
+                results.append((entry, None, None, exc))
+            else:
+                results.append((entry, item, enqueued_at, None))
+        return results
+
+    def _sync_records(self, acked: typing.Optional[typing.Tuple[int, int]]):
+        """
+        Sync the log and write the cursor, if given. Runs in the executor.
+        """
+        with self._io_lock:
+            if self._unsynced:
+                os.fsync(self._writer.fileno())
+                self._unsynced = 0
+            if acked is not None:
+                self._write_cursor(acked)
+
+    def _delete_segments(self, segments):
+        """
+        Delete fully acknowledged segments. Runs in the executor.
+        """
+        with self._io_lock:
+            for segment in segments:
+                if segment == self._reader_segment:
+                    self._reader.close()
+                    self._reader = None
+                    self._reader_segment = None
+                try:
+                    self._segment_path(segment).unlink()
+                except OSError:
+                    self.logger.warning("failed to delete segment %s",
+                                        self._segment_path(segment),
+                                        exc_info=True)
+
+    def _run_in_background(self, func, *args) -> concurrent.futures.Future:
+        def done(fut):
+            if not fut.cancelled() and fut.exception() is not None:
+                self.logger.error("queue I/O failed",
+                                  exc_info=fut.exception())
+
+        fut = self._executor.submit(func, *args)
+        fut.add_done_callback(done)
+        return fut
+
+    @staticmethod
+    def _call_done_cbs(done_cbs, fut=None):
+        if fut is not None and not fut.cancelled():
+            # already logged by _run_in_background
+            fut.exception()
+        for done_cb in done_cbs:
+            done_cb()
+
+    def _sync(self):
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+
+        acked = self._acked if self._cursor_dirty else None
+        self._cursor_dirty = False
+        done_cbs, self._unsynced_done = self._unsynced_done, []
+        fut = self._run_in_background(self._sync_records, acked)
+        if done_cbs:
+            asyncio.wrap_future(fut).add_done_callback(
+                functools.partial(self._call_done_cbs, done_cbs),
+            )
+
+    def _schedule_sync(self):
+        if self._sync_handle is not None:
+            return
+        self._sync_handle = asyncio.get_event_loop().call_later(
+            self._sync_interval,
+            self._sync,
+        )
+
+    async def _flush(self):
+        try:
+            while self._pending:
+                records = list(self._pending)
+                self._pending.clear()
+                self._nwriting = len(records)
+                # the executor runs jobs in order, so the next sync covers
+                # these records
+                self._unsynced_done.extend(
+                    done_cb
+                    for _, _, done_cb in records
+                    if done_cb is not None
+                )
+                self._write_future = self._executor.submit(
+                    self._write_records,
+                    records,
+                )
+                try:
+                    await asyncio.wrap_future(self._write_future)
+                except Exception:  # NOQA
+                    self.logger.error(
+                        "DATA LOSS: failed to write %d items to the log",
+                        len(records),
+                        exc_info=True,
+                    )
+                finally:
+                    self._nwriting = 0
+                self._nonempty.set()
+                self._schedule_sync()
+        finally:
+            self._flush_task = None
+
+    def _ack(self, pos: typing.Tuple[int, int]):
+        # the cursor may already be past pos if items were dropped while
+        # the item at pos was being submitted
+        if pos <= self._acked:
+            return
+        self._acked = pos
+        self._cursor_dirty = True
+        segment, _ = pos
+        old_segments = []
+        while self._segments[0] < segment:
+            old_segments.append(self._segments.popleft())
+        if old_segments:
+            self._run_in_background(self._delete_segments, old_segments)
+        self._schedule_sync()
+
+    def _drop_oldest(self):
+        if self._readahead:
+            (segment, _, end), _, _, _ = self._readahead.popleft()
+            self._ack((segment, end))
+        elif self._index:
+            segment, _, end = self._index.popleft()
+            # move the cursor past the dropped record, so that it is neither
+            # kept on disk nor delivered after a restart
+            self._ack((segment, end))
+        elif self._pending:
+            _, _, done_cb = self._pending.popleft()
+            if done_cb is not None:
+                done_cb()
+        # otherwise, all items are currently being written; the queue
+        # exceeds its depth until the next push
+
+    def push_nowait(self, item, done_cb=None):
+        if self.depth >= self._max_depth:
+            if not self._apply_overflow_policy():
+                # drop new item
+                if done_cb is not None:
+                    done_cb()
+                return
+            self._drop_oldest()
+
+        self._pending.append((time.time(), item, done_cb))
+        self.metrics.enqueued += 1
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush())
+
+    def close(self):
+        """
+        Write all pushed items and the cursor to disk and close the log.
+
+        This blocks until all writes are completed.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._write_future is not None:
+            try:
+                self._write_future.result()
+            except Exception:  # NOQA
+                # already logged by _flush
+                pass
+        self._nwriting = 0
+        records = list(self._pending)
+        self._pending.clear()
+        self._write_records(records)
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+        self._sync_records(self._acked)
+        self._cursor_dirty = False
+        self._executor.shutdown()
+        with self._io_lock:
+            self._writer.close()
+            if self._reader is not None:
+                self._reader.close()
+
+        done_cbs, self._unsynced_done = self._unsynced_done, []
+        done_cbs.extend(
+            done_cb
+            for _, _, done_cb in records
+            if done_cb is not None
+        )
+        self._call_done_cbs(done_cbs)
+
+    async def _read_ahead(self, nrecords: int):
+        """
+        Read up to `nrecords` records from the log into the read-ahead
+        buffer, in a single executor call.
+        """
+        entries = []
+        while self._index and len(self._readahead) + len(entries) < nrecords:
+            entries.append(self._index.popleft())
+        if not entries:
+            return
+
+        try:
+            results = await asyncio.get_event_loop().run_in_executor(
+                self._executor,
+                self._read_records,
+                entries,
+            )
+        except BaseException:
+            self._index.extendleft(reversed(entries))
+            raise
+        self._readahead.extend(results)
+
+    def _take_readable(self):
+        """
+        Take the next record from the read-ahead buffer, skipping unreadable
+        records.
+
+        :return: The record or :data:`None` if the buffer is exhausted.
+        """
+        while self._readahead:
+            record = self._readahead.popleft()
+            (segment, _, end), _, _, error = record
+            if error is None:
+                return record
+            self.logger.error(
+                "DATA LOSS: failed to read item from queue",
+                exc_info=error,
+            )
+            self._ack((segment, end))
+        return None
+
+    async def _linger_for_records(self, deadline: float) -> bool:
+        """
+        Wait until records are available or `deadline` has passed.
+
+        :return: True if records are available.
+        """
+        while not self._readahead and not self._index:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return False
+            self._nonempty.clear()
+            try:
+                await asyncio.wait_for(self._nonempty.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _take_coalesced(self, taken):
+        """
+        Take the next item and coalesce the sample batch chunks following it
+        like :class:`EphemeralQueue`.
+
+        The records are appended to `taken`.
+        """
+        await self._read_ahead(1)
+        record = self._take_readable()
+        if record is None:
+            return None
+        taken.append(record)
+        _, item, _, _ = record
+        if (item.class_ != interface.DataClass.SAMPLE_BATCH or
+                len(item.data) >= self._max_batch_size):
+            return item
+
+        batches = list(item.data)
+        deadline = time.monotonic() + self._linger
+        while len(batches) < self._max_batch_size:
+            if not await self._linger_for_records(deadline):
+                break
+            await self._read_ahead(self._max_batch_size - len(batches))
+            if not self._readahead:
+                # dropped while reading
+                continue
+            _, item, _, error = self._readahead[0]
+            if (error is not None or
+                    item.class_ != interface.DataClass.SAMPLE_BATCH or
+                    len(batches) + len(item.data) > self._max_batch_size):
+                break
+            taken.append(self._readahead.popleft())
+            batches.extend(item.data)
+
+        return interface.DataChunk.from_sample_batches(batches)
+
+    async def run(self):
+        try:
+            while True:
+                while not self._readahead and not self._index:
+                    self._nonempty.clear()
+                    await self._nonempty.wait()
+
+                taken = []
+                try:
+                    item = await self._take_coalesced(taken)
+                    if item is None:
+                        continue
+
+                    now = time.time()
+                    for _, _, enqueued_at, _ in taken:
+                        self.metrics.record_dequeue(now - enqueued_at)
+                    if not await self._sink_with_retries(item):
+                        self.logger.warning(
+                            "DATA LOSS: discarding item after failed "
+                            "submission"
+                        )
+                except BaseException:
+                    # not submitted; deliver them again when restarted
+                    self._readahead.extendleft(reversed(taken))
+                    raise
+                (segment, _, end), _, _, _ = taken[-1]
+                self._ack((segment, end))
+        finally:
+            self._sync()
@@ -0,0 +1,522 @@
+import abc
+import dataclasses
+import numbers
+import time
+import typing
+
+from datetime import datetime, timedelta
+
+import schema
+
+import hintlib.sample
+
+from . import filters, interface
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+_subparts = schema.And([str], schema.Use(frozenset))
+
+
+@dataclasses.dataclass(frozen=True)
+class PathMatch:
+    module: object
+    part: object
+    instance: object
+    subparts: typing.Optional[typing.FrozenSet[str]] = None
+
+    @classmethod
+    def from_dict(cls, cfg: typing.Mapping) -> "PathMatch":
+        return cls(
+            module=cfg["module"],
+            part=cfg["part"],
+            instance=cfg["instance"],
+            subparts=cfg.get("subparts"),
+        )
+
+    def matches_subpart(self, subpart) -> bool:
+        return self.subparts is None or subpart in self.subparts
+
+
+class Stage(metaclass=abc.ABCMeta):
+    """
+    A single step of a rewrite pipeline.
+
+    Stages only apply to sample batches whose bare path matches the `module`,
+    `part` and `instance` of the stage configuration (omitted keys match
+    everything). Whether a bare path matches is determined only once per
+    path.
+    """
+
+    def __init__(self, *, config):
+        super().__init__()
+        self._match = config.match
+        self._match_cache = {}
+
+    @classmethod
+    def get_config_schema(cls) -> schema.Schema:
+        return schema.Schema(filters.PATH_MATCH_SCHEMA)
+
+    @classmethod
+    @abc.abstractmethod
+    def compile_config(cls, cfg: typing.Mapping):
+        pass
+
+    def _matches(self, bare_path) -> bool:
+        try:
+            return self._match_cache[bare_path]
+        except KeyError:
+            pass
+        result = filters.path_matches(
+            bare_path,
+            self._match.module,
+            self._match.part,
+            self._match.instance,
+        )
+        self._match_cache[bare_path] = result
+        return result
+
+    def process(
+            self,
+            batch: hintlib.sample.SampleBatch,
+            ) -> typing.Iterable[hintlib.sample.SampleBatch]:
+        """
+        Rewrite a single sample batch.
+
+        :return: The sample batches to pass on.
+
+        Stages may hold back batches (e.g. for aggregation) and emit them
+        later.
+        """
+        if not self._matches(batch.bare_path):
+            return (batch,)
+        return self._process(batch)
+
+    def flush(self) -> typing.Iterable[hintlib.sample.SampleBatch]:
+        """
+        Pass on all batches which are held back.
+
+        This is called when the pipeline shuts down.
+        """
+        return ()
+
+    @abc.abstractmethod
+    def _process(self, batch):
+        """
+        Rewrite a single matching sample batch.
+        """
+
+
+def _replace_samples(batch, samples, **kwargs):
+    return hintlib.sample.SampleBatch(
+        timestamp=kwargs.get("timestamp", batch.timestamp),
+        bare_path=kwargs.get("bare_path", batch.bare_path),
+        samples=samples,
+    )
+
+
+@dataclasses.dataclass(frozen=True)
+class RenameConfig:
+    match: PathMatch
+    new_path: typing.Mapping[str, object]
+    subparts: typing.Mapping[str, str]
+
+
+class RenameStage(Stage):
+    """
+    Change the module, part or instance of matching paths and rename
+    subparts.
+    """
+
+    def __init__(self, *, config: RenameConfig):
+        super().__init__(config=config)
+        self._new_path = config.new_path
+        self._subparts = config.subparts
+        self._path_cache = {}
+
+    @classmethod
+    def get_config_schema(cls) -> schema.Schema:
+        return schema.Schema({
+            **filters.PATH_MATCH_SCHEMA,
+            schema.Optional("new_module"): str,
+            schema.Optional("new_part"): str,
+            schema.Optional("new_instance"): schema.Or(str, int),
+            schema.Optional("subparts", default={}): {str: str},
+        })
+
+    @classmethod
+    def compile_config(cls, cfg: typing.Mapping) -> RenameConfig:
+        return RenameConfig(
+            match=PathMatch.from_dict(cfg),
+            new_path={
+                key[4:]: value
+                for key, value in cfg.items()
+                if key.startswith("new_")
+            },
+            subparts=cfg["subparts"],
+        )
+
+    def _process(self, batch):
+        try:
+            bare_path = self._path_cache[batch.bare_path]
+        except KeyError:
+            bare_path = batch.bare_path.replace(**self._new_path)
+            self._path_cache[batch.bare_path] = bare_path
+
+        samples = batch.samples
+        if self._subparts:
+            samples = {
+                self._subparts.get(subpart, subpart): value
+                for subpart, value in samples.items()
+            }
+
+        return (_replace_samples(batch, samples, bare_path=bare_path),)
+
+
+@dataclasses.dataclass(frozen=True)
+class ScaleConfig:
+    match: PathMatch
+    factor: numbers.Real
+    offset: numbers.Real
+
+
+class ScaleStage(Stage):
+    """
+    Apply ``value * factor + offset`` to matching numeric samples.
+    """
+
+    def __init__(self, *, config: ScaleConfig):
+        super().__init__(config=config)
+        self._factor = config.factor
+        self._offset = config.offset
+
+    @classmethod
+    def get_config_schema(cls) -> schema.Schema:
+        return schema.Schema({
+            **filters.PATH_MATCH_SCHEMA,
+            schema.Optional("subparts"): _subparts,
+            schema.Optional("factor", default=1): numbers.Real,
+            schema.Optional("offset", default=0): numbers.Real,
+        })
+
+    @classmethod
+    def compile_config(cls, cfg: typing.Mapping) -> ScaleConfig:
+        return ScaleConfig(
+            match=PathMatch.from_dict(cfg),
+            factor=cfg["factor"],
+            offset=cfg["offset"],
+        )
+
+    def _process(self, batch):
+        samples = {
+            subpart: (
+                value * self._factor + self._offset
+                if (isinstance(value, numbers.Real) and
+                    self._match.matches_subpart(subpart))
+                else value
+            )
+            for subpart, value in batch.samples.items()
+        }
+        return (_replace_samples(batch, samples),)
+
+
+@dataclasses.dataclass(frozen=True)
+class DeadbandConfig:
+    match: PathMatch
+    threshold: numbers.Real
+    max_interval: typing.Optional[timedelta]
+
+
+class DeadbandStage(Stage):
+    """
+    Suppress matching samples which differ by at most `threshold` from the
+    last value passed on for the same subpart.
+
+    If `max_interval` is set, a sample is passed on anyway if the last value
+    was passed on at least that long ago. Batches without remaining samples
+    are dropped.
+    """
+
+    def __init__(self, *, config: DeadbandConfig):
+        super().__init__(config=config)
+        self._threshold = config.threshold
+        self._max_interval = config.max_interval
+        self._last = {}
+
+    @classmethod
+    def get_config_schema(cls) -> schema.Schema:
+        return schema.Schema({
+            **filters.PATH_MATCH_SCHEMA,
+            schema.Optional("subparts"): _subparts,
+            "threshold": schema.And(numbers.Real, lambda x: x >= 0),
+            schema.Optional("max_interval"): schema.And(
+                numbers.Real,
+                lambda x: x > 0,
+            ),
+        })
+
+    @classmethod
+    def compile_config(cls, cfg: typing.Mapping) -> DeadbandConfig:
+        max_interval = cfg.get("max_interval")
+        if max_interval is not None:
+            max_interval = timedelta(seconds=max_interval)
+        return DeadbandConfig(
+            match=PathMatch.from_dict(cfg),
+            threshold=cfg["threshold"],
+            max_interval=max_interval,
+        )
+
+    def _passes(self, key, timestamp, value) -> bool:
+        try:
+            last_value, last_timestamp = self._last[key]
+        except KeyError:
+            return True
+        if abs(value - last_value) > self._threshold:
+            return True
+        return (self._max_interval is not None and
+                timestamp - last_timestamp >= self._max_interval)
+
+    def _process(self, batch):
+        samples = {}
+        for subpart, value in batch.samples.items():
+            if (not isinstance(value, numbers.Real) or
+                    not self._match.matches_subpart(subpart)):
+                samples[subpart] = value
+                continue
+
+            key = (batch.bare_path, subpart)
+            if self._passes(key, batch.timestamp, value):
+                self._last[key] = (value, batch.timestamp)
+                samples[subpart] = value
+
+        if not samples:
+            return ()
+        if len(samples) == len(batch.samples):
+            return (batch,)
+        return (_replace_samples(batch, samples),)
+
+
+class _Bucket:
+    __slots__ = ("index", "values", "last_seen")
+
+    def __init__(self, index):
+        self.index = index
+        # monotonic time of the most recent batch for the bucket's path
+        self.last_seen = None
+        # subpart -> [count, sum, min, max]
+        self.values = {}
+
+    def add(self, samples):
+        for subpart, value in samples.items():
+            if not isinstance(value, numbers.Real):
+                continue
+            try:
+                acc = self.values[subpart]
+            except KeyError:
+                self.values[subpart] = [1, value, value, value]
+                continue
+            acc[0] += 1
+            acc[1] += value
+            if value < acc[2]:
+                acc[2] = value
+            if value > acc[3]:
+                acc[3] = value
+
+
+_AGGREGATORS = {
+    "mean": lambda acc: acc[1] / acc[0],
+    "min": lambda acc: acc[2],
+    "max": lambda acc: acc[3],
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class DownsampleConfig:
+    match: PathMatch
+    interval: numbers.Real
+    function: str
+
+
+class DownsampleStage(Stage):
+    """
+    Aggregate the numeric samples of matching paths over time buckets of
+    `interval` seconds, using the given aggregation `function` (``mean``,
+    ``min`` or ``max``).
+
+    The aggregated batch of a bucket is passed on with the start of the
+    bucket as timestamp as soon as a batch for a later bucket arrives for the
+    same path. So that paths which go quiet are not held back forever, a
+    bucket is also passed on when no batch has arrived for its path for two
+    intervals of (monotonic) local time; this is checked whenever a batch is
+    processed, at most once per interval. The timestamps of other paths are
+    not taken into account, since their clocks may be skewed against each
+    other. Batches for earlier buckets of a path (late or retransmitted data)
+    are dropped, since their bucket has already been passed on. Non-numeric
+    samples are discarded.
+    """
+
+    def __init__(self, *, config: DownsampleConfig):
+        super().__init__(config=config)
+        self._interval = config.interval
+        self._aggregate = _AGGREGATORS[config.function]
+        self._buckets = {}
+        self._last_index = {}
+        self._next_stale_check = None
+
+    @classmethod
+    def get_config_schema(cls) -> schema.Schema:
+        return schema.Schema({
+            **filters.PATH_MATCH_SCHEMA,
+            "interval": schema.And(numbers.Real, lambda x: x > 0),
+            schema.Optional("function", default="mean"): schema.Or(
+                *_AGGREGATORS.keys()
+            ),
+        })
+
+    @classmethod
+    def compile_config(cls, cfg: typing.Mapping) -> DownsampleConfig:
+        return DownsampleConfig(
+            match=PathMatch.from_dict(cfg),
+            interval=cfg["interval"],
+            function=cfg["function"],
+        )
+
+    def _finish(self, bare_path, bucket):
+        samples = {
+            subpart: self._aggregate(acc)
+            for subpart, acc in bucket.values.items()
+        }
+        if not samples:
+            return ()
+        return (hintlib.sample.SampleBatch(
+            timestamp=_EPOCH + timedelta(
+                seconds=bucket.index * self._interval
+            ),
+            bare_path=bare_path,
+            samples=samples,
+        ),)
+
+    def _index(self, timestamp):
+        return int((timestamp - _EPOCH).total_seconds() // self._interval)
+
+    def _flush_stale(self, now):
+        """
+        Finish the buckets of the paths which have not received a batch for
+        two intervals before `now`.
+        """
+        result = []
+        for bare_path, bucket in list(self._buckets.items()):
+            if now - bucket.last_seen >= 2 * self._interval:
+                del self._buckets[bare_path]
+                # later batches for this bucket are late
+                self._last_index[bare_path] = bucket.index + 1
+                result.extend(self._finish(bare_path, bucket))
+        return result
+
+    def process(self, batch):
+        now = time.monotonic()
+        stale = ()
+        if self._next_stale_check is None:
+            self._next_stale_check = now + self._interval
+        elif now >= self._next_stale_check:
+            self._next_stale_check = now + self._interval
+            stale = self._flush_stale(now)
+
+        result = super().process(batch)
+        if stale:
+            return list(stale) + list(result)
+        return result
+
+    def flush(self):
+        result = []
+        for bare_path, bucket in self._buckets.items():
+            result.extend(self._finish(bare_path, bucket))
+        self._buckets.clear()
+        return result
+
+    def _process(self, batch):
+        index = self._index(batch.timestamp)
+        last_index = self._last_index.get(batch.bare_path)
+        if last_index is not None and index < last_index:
+            # the bucket of the batch has already been passed on
+            return ()
+        self._last_index[batch.bare_path] = index
+
+        result = ()
+        bucket = self._buckets.get(batch.bare_path)
+        if bucket is not None and bucket.index != index:
+            result = self._finish(batch.bare_path, bucket)
+            bucket = None
+        if bucket is None:
+            bucket = _Bucket(index)
+            self._buckets[batch.bare_path] = bucket
+        bucket.last_seen = time.monotonic()
+        bucket.add(batch.samples)
+        return result
+
+
+STAGE_TYPES = {
+    "rename": RenameStage,
+    "scale": ScaleStage,
+    "deadband": DeadbandStage,
+    "downsample": DownsampleStage,
+}
+
+
+class Rewriter:
+    """
+    Pipeline of rewrite stages for sample batches.
+
+    :param stages: The stages, in the order in which they are applied.
+
+    Stream blocks are passed on unchanged.
+    """
+
+    def __init__(self, stages: typing.Iterable[Stage]):
+        super().__init__()
+        self._stages = list(stages)
+
+    def _rewrite_batches(self, batches):
+        for stage in self._stages:
+            batches = [
+                rewritten
+                for batch in batches
+                for rewritten in stage.process(batch)
+            ]
+        return batches
+
+    def apply(
+            self,
+            data: interface.DataChunk,
+            ) -> typing.Optional[interface.DataChunk]:
+        """
+        Rewrite a data chunk.
+
+        :return: The rewritten chunk or :data:`None` if nothing is left.
+        """
+        if data.class_ != interface.DataClass.SAMPLE_BATCH:
+            return data
+
+        batches = self._rewrite_batches(data.data)
+        if not batches:
+            return None
+        return interface.DataChunk.from_sample_batches(batches)
+
+    def flush(self) -> typing.Optional[interface.DataChunk]:
+        """
+        Pass the batches held back by the stages through the rest of the
+        pipeline.
+
+        :return: The resulting chunk or :data:`None` if nothing is left.
+        """
+        batches = []
+        for stage in self._stages:
+            batches = [
+                rewritten
+                for batch in batches
+                for rewritten in stage.process(batch)
+            ]
+            batches.extend(stage.flush())
+        if not batches:
+            return None
+        return interface.DataChunk.from_sample_batches(batches)
@@ -13,6 +13,10 @@ stream_schema = Schema({
     Optional("range", default=1.0): float,
     Optional("sample_type", default="h"): And(str, Const(array.array)),
     Optional("batch_size"): _batch_size,
+    Optional("mmap", default=False): bool,
+    Optional("sync_every"): _batch_size,
+    Optional("sync_interval"): And(float, Const(lambda x: x > 0)),
+    Optional("fit_drift", default=False): bool,
 })
 
 sbx_source_schema = Schema({
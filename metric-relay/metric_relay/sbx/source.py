@@ -7,12 +7,12 @@ import typing
 
 from datetime import datetime, timedelta
 
-from hintlib.utils import unpack_and_splice, escape_path
+from hintlib.utils import escape_path
 from hintlib import sample, timeline
 
 import metric_relay.snurl
 
-from ..base import DataClass, Source, DataChunk
+from ..interface import DataClass, Source, DataChunk
 
 from . import stream, wireformat, config
 
@@ -101,6 +101,102 @@ def batch_samples(
         )
 
 
+class InstanceRewriter:
+    """
+    Rewrite the instance of sensor paths according to the ``rewrite`` rules
+    of the ``samples`` configuration.
+
+    :param rules: The validated rewrite rules.
+    """
+
+    def __init__(self, rules):
+        super().__init__()
+        self._rules = {
+            (rule["part"], rule["instance"]): rule["new_instance"]
+            for rule in rules
+        }
+
+    def rewrite_path(self, path: sample.SensorPath) -> sample.SensorPath:
+        try:
+            new_instance = self._rules[path.part, str(path.instance)]
+        except KeyError:
+            return path
+        return path.replace(instance=new_instance)
+
+    def rewrite(self, s: sample.Sample) -> sample.Sample:
+        return s.replace(sensor=self.rewrite_path(s.sensor))
+
+
+class SampleBatcher:
+    """
+    Build :class:`~hintlib.sample.SampleBatch` objects directly from the
+    sample groups of decoded messages.
+
+    :param rewrite_path: Optional function to rewrite the de-enumified bare
+        paths.
+
+    This is equivalent to passing the samples of a message through
+    :func:`deenumify_samples`, the rewriter, :func:`rtcify_samples` and
+    :func:`batch_samples`, but without creating intermediate
+    :class:`~hintlib.sample.Sample` objects. The de-enumified and rewritten
+    bare paths are cached.
+    """
+
+    MAX_CACHE_SIZE = 4096
+
+    def __init__(self, rewrite_path=None):
+        super().__init__()
+        self._rewrite_path = rewrite_path
+        self._path_cache = {}
+
+    def _get_bare_path(self, path):
+        try:
+            return self._path_cache[path]
+        except KeyError:
+            pass
+
+        result = path.replace(part=path.part.value)
+        if self._rewrite_path is not None:
+            result = self._rewrite_path(result)
+
+        if len(self._path_cache) >= self.MAX_CACHE_SIZE:
+            self._path_cache.clear()
+        self._path_cache[path] = result
+        return result
+
+    def batches(
+            self,
+            groups: typing.Iterable,
+            map_to_rtc: typing.Callable[[int], datetime],
+            ) -> typing.Iterable[sample.SampleBatch]:
+        """
+        Convert sample groups to sample batches.
+
+        :param groups: Iterable of ``(timestamp, bare_path, samples)``
+            tuples as returned by ``get_sample_groups``.
+        :param map_to_rtc: Function to map raw timestamps to RTC time.
+
+        Timestamps which are already :class:`datetime` objects are passed
+        through. Each distinct raw timestamp is only mapped once.
+        """
+        timestamps = {}
+        for timestamp, bare_path, samples in groups:
+            if not isinstance(timestamp, datetime):
+                try:
+                    timestamp = timestamps[timestamp]
+                except KeyError:
+                    timestamp = timestamps[timestamp] = map_to_rtc(timestamp)
+
+            yield sample.SampleBatch(
+                timestamp=timestamp,
+                bare_path=self._get_bare_path(bare_path),
+                samples={
+                    (subpart.value if subpart is not None else None): value
+                    for subpart, value in samples.items()
+                },
+            )
+
+
 class StreamProcessor:
     __slots__ = ("buffer_", "range_")
 
@@ -111,6 +207,10 @@ class StreamProcessor:
             emit_cb,
             sample_type=cfg["sample_type"],
             logger=logger,
+            use_mmap=cfg["mmap"],
+            sync_every=cfg.get("sync_every"),
+            sync_interval=cfg.get("sync_interval"),
+            fit_drift=cfg["fit_drift"],
         )
         self.buffer_.batch_size = cfg.get("batch_size", default_batch_size)
         self.range_ = cfg["range"]
@@ -128,6 +228,14 @@ class SNURLSBXSource(Source):
 
         cfg = config.sbx_source_schema.validate(cfg)
 
+        self._individual_rewriter = InstanceRewriter(
+            cfg["samples"]["rewrite"],
+        )
+        self._sample_batcher = SampleBatcher(
+            self._individual_rewriter.rewrite_path,
+        )
+        self._last_rtc_timestamp = None, None
+
         self._streams = {
             path: StreamProcessor(
                 stream_cfg,
@@ -165,13 +273,22 @@ class SNURLSBXSource(Source):
     def emitted_data_classes(self) -> typing.Iterable[DataClass]:
         return {DataClass.SAMPLE_BATCH, DataClass.STREAM}
 
-    def _data_received(self, remainder: bytes):
-        remainder, (rtc_timestamp, type_raw) = unpack_and_splice(
-            remainder,
-            wireformat.data_frame_header_fmt,
-        )
+    def _data_received(self, payload: memoryview):
+        # the decoders work on views into the datagram and copy only what
+        # they keep
+        rtc_timestamp, type_raw = data_frame_header_fmt.unpack_from(payload)
+        remainder = memoryview(payload)[data_frame_header_fmt.size:]
 
-        rtc_timestamp = datetime.utcfromtimestamp(rtc_timestamp)
+        # consecutive frames mostly share the same RTC second
+        last_raw, last_rtc_timestamp = self._last_rtc_timestamp
+        if last_raw == rtc_timestamp:
+            rtc_timestamp = last_rtc_timestamp
+        else:
+            self._last_rtc_timestamp = (
+                rtc_timestamp,
+                datetime.utcfromtimestamp(rtc_timestamp),
+            )
+            rtc_timestamp = self._last_rtc_timestamp[1]
 
         try:
             type_ = wireformat.DataFrameType(type_raw)
@@ -198,7 +315,7 @@ class SNURLSBXSource(Source):
                 )
             except Exception:
                 self.logger.warning("failed to decode ESP status message %r",
-                                    remainder,
+                                    bytes(remainder),
                                     exc_info=True)
             else:
                 self._process_message(
@@ -210,14 +327,10 @@ class SNURLSBXSource(Source):
                               type_)
 
     def _process_generic_message(self, obj):
-        if hasattr(obj, "get_samples"):
-            batches = list(batch_samples(
-                rtcify_samples(
-                    map(
-                        self._individual_rewriter.rewrite,
-                        deenumify_samples(obj.get_samples())
-                    )
-                )
+        if hasattr(obj, "get_sample_groups"):
+            batches = list(self._sample_batcher.batches(
+                obj.get_sample_groups(),
+                self._rtcifier.map_to_rtc,
             ))
             self._emit_cb(
                 DataChunk.from_sample_batches(batches),
@@ -1,29 +1,66 @@
+import array
+import asyncio
+import collections
+import collections.abc
 import io
 import logging
+import mmap
 import os
 import struct
+import sys
+import time
+import typing
 
 from datetime import datetime, timedelta
 
 from hintlib import utils, timeline
 
 
-def decompress(average, packet):
-    def to_sint(v):
-        return struct.unpack("<h", struct.pack("<H", v))[0]
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-    values = [to_sint(average)]
 
-    remaining_payload_size = len(packet)
+# bits of a bitmap byte, most significant first
+_BITMAP_BITS = [
+    tuple((byte >> shift) & 1 for shift in range(7, -1, -1))
+    for byte in range(256)
+]
+
+# number of payload bytes described by a full bitmap byte
+_BITMAP_PAYLOAD_SIZE = [
+    sum(1 if bit else 2 for bit in bits)
+    for bits in _BITMAP_BITS
+]
+
+#: Minimum packet size for which the NumPy decoder is used.
+NUMPY_MIN_PACKET_SIZE = 512
 
+
+def _to_signed(values):
+    # reinterpret the unsigned 16-bit values as signed
+    result = array.array("h")
+    result.frombytes(array.array("H", values).tobytes())
+    return result
+
+
+def _read_bitmap(packet):
+    remaining_payload_size = len(packet)
+    offset = 0
     bitmap = []
     while remaining_payload_size > 0:
         remaining_payload_size -= 1
-        next_bitmap_part = packet[0]
-        packet = packet[1:]
+        next_bitmap_part = packet[offset]
+        offset += 1
 
-        for i in range(7, -1, -1):
-            bit = (next_bitmap_part & (1 << i)) >> i
+        payload_size = _BITMAP_PAYLOAD_SIZE[next_bitmap_part]
+        if payload_size < remaining_payload_size:
+            bitmap.extend(_BITMAP_BITS[next_bitmap_part])
+            remaining_payload_size -= payload_size
+            continue
+
+        for bit in _BITMAP_BITS[next_bitmap_part]:
             bitmap.append(bit)
             if bit:
                 remaining_payload_size -= 1
@@ -31,27 +68,275 @@ def decompress(average, packet):
                 remaining_payload_size -= 2
             if remaining_payload_size <= 0:
                 if remaining_payload_size < 0:
-                    print("reference:", average)
-                    print("bitmap so far:", bitmap)
-                    print("remaining packet:", packet)
                     raise ValueError(
                         "codec error: remaining payload is negative!"
                     )
                 break
 
+    return bitmap, offset
+
+
+def _decompress_python(average, packet):
+    bitmap, offset = _read_bitmap(packet)
+
+    values = [average]
+    append = values.append
     for compressed in bitmap:
         if compressed:
-            raw, = struct.unpack("<B", packet[:1])
-            packet = packet[1:]
+            raw = packet[offset]
+            offset += 1
         else:
-            raw, = struct.unpack("<H", packet[:2])
-            packet = packet[2:]
-        value = (raw + average) % 65536
-        values.append(to_sint(value))
+            raw = packet[offset] | (packet[offset + 1] << 8)
+            offset += 2
+        append((raw + average) & 0xffff)
+
+    return _to_signed(values)
+
+
+def _decompress_numpy(average, packet):
+    size = len(packet)
+    raw = numpy.frombuffer(packet, dtype=numpy.uint8)
+
+    # Interpret the whole packet as bitmap; the bitmap ends with the first
+    # bit at which the described payload fills the rest of the packet.
+    bits = numpy.unpackbits(raw)
+    consumed = numpy.cumsum(2 - bits.astype(numpy.int32))
+    consumed += numpy.arange(len(bits), dtype=numpy.int32) // 8 + 1
+    end = int(numpy.argmax(consumed >= size))
+    if consumed[end] > size:
+        raise ValueError("codec error: remaining payload is negative!")
+
+    nsamples = end + 1
+    bits = bits[:nsamples]
+    sizes = 2 - bits
+    offsets = numpy.cumsum(sizes) - sizes + (end // 8 + 1)
+
+    values = numpy.empty(nsamples + 1, dtype=numpy.uint16)
+    values[0] = average
+    deltas = values[1:]
+    deltas[:] = raw[offsets]
+    wide = bits == 0
+    deltas[wide] |= raw[offsets[wide] + 1].astype(numpy.uint16) << 8
+    deltas += numpy.uint16(average)
+
+    return array.array("h", values.view(numpy.int16).tobytes())
+
+
+def decompress(average, packet):
+    """
+    Decompress a delta-compressed stream packet.
+
+    :param average: The raw (unsigned 16-bit) reference value.
+    :param packet: The compressed packet.
+    :type packet: :term:`bytes-like object`
+    :return: The signed 16-bit samples, starting with the reference value.
+    :rtype: :class:`array.array` of type ``h``
+
+    The packet starts with a bitmap which has one bit per sample, most
+    significant bit first. A set bit indicates that the sample is encoded
+    as a single unsigned byte, otherwise it is encoded as unsigned 16-bit
+    little endian integer. The sample values are the encoded values plus
+    the reference value, modulo 2**16.
+
+    NumPy is used for packets of at least :data:`NUMPY_MIN_PACKET_SIZE`
+    bytes if it is available.
+    """
+    packet = memoryview(packet).cast("B")
+    if not packet:
+        return _to_signed([average])
+    if numpy is not None and len(packet) >= NUMPY_MIN_PACKET_SIZE:
+        return _decompress_numpy(average, packet)
+    return _decompress_python(average, packet)
+
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+class ClockAlignment:
+    """
+    Incremental estimate of the RTC time of a reference sample.
+
+    :param period: Interval between two consecutive samples.
+    :type period: :class:`datetime.timedelta`
+    :param window: Number of reference points to take into account.
+    :param fit_drift: Whether to compensate for drift of the sample clock.
+
+    Each reference point ``(seq, rtc)`` predicts the RTC time of the most
+    recent reference sample as ``rtc + (seq_latest - seq) * period``. The
+    estimate (:attr:`t0`) is the mean of these predictions over the last
+    `window` reference points.
+
+    If `fit_drift` is true, a straight line is fitted through the
+    predictions instead (least squares over sequence numbers), so that a
+    sample clock which runs slightly slower or faster than `period` does
+    not bias the estimate towards older reference points.
+
+    The points are kept in integer microseconds relative to a fixed sequence
+    number origin, so that adding a point only updates running sums instead
+    of shifting all points.
+    """
+
+    def __init__(self, period, window=1000, fit_drift=False):
+        super().__init__()
+        self.period = period
+        self._period_us = period // _MICROSECOND
+        self._window = window
+        self._fit_drift = fit_drift
+        self.reset()
+
+    def reset(self):
+        self._epoch = None
+        self._latest_rtc = None
+        self._points = collections.deque()
+        self._seq = 0
+        self._sum = 0
+        self._sum_seq = 0
+        self._sum_seq2 = 0
+        self._sum_seq_value = 0
+
+    def __len__(self):
+        return len(self._points)
+
+    def _update_sums(self, seq, value, sign):
+        self._sum += sign * value
+        if self._fit_drift:
+            self._sum_seq += sign * seq
+            self._sum_seq2 += sign * seq * seq
+            self._sum_seq_value += sign * seq * value
+
+    def add(self, seq_offset, rtc):
+        """
+        Add a reference point.
+
+        :param seq_offset: Sequence number of the new reference sample
+                           relative to the previous reference sample.
+        :type seq_offset: :class:`int`
+        :param rtc: Timestamp of the new reference sample.
+        :type rtc: :class:`datetime.datetime`
+        """
+        if self._epoch is None:
+            self._epoch = _EPOCH.replace(tzinfo=rtc.tzinfo)
+        self._seq += seq_offset
+        self._latest_rtc = rtc
+        value = (
+            (rtc - self._epoch) // _MICROSECOND -
+            self._seq * self._period_us
+        )
+        if len(self._points) >= self._window:
+            self._update_sums(*self._points.popleft(), -1)
+        self._points.append((self._seq, value))
+        self._update_sums(self._seq, value, 1)
+
+    def _to_rtc(self, value):
+        return self._epoch + timedelta(
+            microseconds=value + self._seq * self._period_us
+        )
+
+    @property
+    def t0(self):
+        """
+        The estimated RTC time of the most recent reference sample.
+        """
+        n = len(self._points)
+        if self._fit_drift and n > 1:
+            denominator = n * self._sum_seq2 - self._sum_seq ** 2
+            if denominator:
+                slope = (
+                    (n * self._sum_seq_value - self._sum_seq * self._sum) /
+                    denominator
+                )
+                return self._to_rtc(round(
+                    (self._sum + slope * (n * self._seq - self._sum_seq)) / n
+                ))
+
+        # computed relative to the latest point, which gives the same
+        # rounding as averaging the predictions as timedeltas
+        latest_rtc_us = (self._latest_rtc - self._epoch) // _MICROSECOND
+        return self._latest_rtc + timedelta(microseconds=(
+            self._sum + n * (self._seq * self._period_us - latest_rtc_us)
+        )) / n
+
+    @property
+    def oldest_t0(self):
+        """
+        The RTC time of the most recent reference sample as predicted by the
+        oldest reference point in the window.
+        """
+        return self._to_rtc(self._points[0][1])
+
+
+class SegmentInfo(typing.NamedTuple):
+    t0: datetime
+    seq0: int
+    period: timedelta
+    count: int
+    sample_type: str
+    header_version: int
 
-    assert not packet
 
-    return values
+class SegmentData(collections.abc.Sequence):
+    """
+    The samples of a persisted segment, which are read on first access.
+
+    The length is known without reading the file. When pickled, the samples
+    are pickled as :class:`array.array`.
+    """
+
+    def __init__(self, path, offset, count, sample_size, unpack, logger):
+        super().__init__()
+        self._path = path
+        self._offset = offset
+        self._count = count
+        self._sample_size = sample_size
+        self._unpack = unpack
+        self._logger = logger
+        self._data = None
+
+    def load(self) -> array.array:
+        if self._data is None:
+            try:
+                with self._path.open("rb") as f:
+                    f.seek(self._offset)
+                    raw = f.read(self._count * self._sample_size)
+            except OSError:
+                self._logger.warning(
+                    "DATA LOSS: failed to read samples from %s",
+                    self._path,
+                    exc_info=True,
+                )
+                raw = b""
+            self._data = self._unpack(raw)
+        return self._data
+
+    @property
+    def typecode(self) -> str:
+        return self.load().typecode
+
+    def tolist(self) -> list:
+        return self.load().tolist()
+
+    def __len__(self):
+        if self._data is not None:
+            return len(self._data)
+        return self._count
+
+    def __getitem__(self, index):
+        return self.load()[index]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __reduce_ex__(self, protocol):
+        return self.load().__reduce_ex__(protocol)
+
+    def __repr__(self):
+        return "<{}.{} path={} count={}>".format(
+            __name__,
+            type(self).__qualname__,
+            self._path,
+            self._count,
+        )
 
 
 class Buffer:
@@ -71,35 +356,82 @@ class Buffer:
        :param period: The interval between consecutive samples.
        :type period: :class:`datetime.timedelta`
        :param samples: The sample values
-       :type samples: :class:`collections.abc.Sequence`
+       :type samples: :class:`array.array` of the `sample_type`
        :param handle: A handle object (see below)
 
        The `handle` object has a :meth:`close` method which must be called
        after the data has been successfully processed. Only then the data will
        be deleted from the persistent storage.
 
+    By default, the buffer file is re-opened, appended to and synced to disk
+    on every :meth:`submit`. If `use_mmap` is true, a segment file for
+    :attr:`batch_size` samples is instead preallocated and memory-mapped
+    when a batch starts, and samples are copied into the mapping. The
+    mapping is then only synced to disk when `sync_every` samples have been
+    written since the last sync, at the latest `sync_interval` seconds after
+    the last sync (by a timer on the event loop, so that samples are synced
+    even if no further samples are submitted), and when the batch is
+    emitted. If neither is given, it is synced on every submit.
+
+    The samples are kept in an :class:`array.array` of the `sample_type`,
+    which is handed to :meth:`on_emit` as is; a new array is started for the
+    next batch.
+
+    The headers of emitted segments are appended to an index file, so that
+    on start-up, pending segments are found without opening each of them.
+    Their samples are passed to :meth:`on_emit` as :class:`SegmentData`,
+    which reads the payload only when it is accessed. The segment file is
+    only deleted when the handle is closed, so the handle must not be
+    closed before the samples have been read. Recovered segments are passed
+    to :meth:`on_emit` in order, at most :attr:`MAX_RECOVERED_IN_FLIGHT` at
+    a time; the next one is passed when the handle of a previous one is
+    closed.
     """
 
     _header = struct.Struct(
         "<BQLHLc",
     )
 
+    # version 1 adds the number of valid samples, since segment files are
+    # preallocated
+    _header_v1 = struct.Struct(
+        "<BQLHLcL",
+    )
+
+    _index_name = struct.Struct("<H")
+
+    #: Number of closed segments after which the index is compacted, unless
+    #: more segments are pending.
+    INDEX_COMPACT_THRESHOLD = 64
+
+    #: Number of recovered segments which are passed to :meth:`on_emit`
+    #: before their handles have been closed.
+    MAX_RECOVERED_IN_FLIGHT = 4
+
     class _Handle:
-        def __init__(self, path):
+        def __init__(self, path, on_close=None):
             super().__init__()
             self.__path = path
+            self.__on_close = on_close
 
         def close(self):
             try:
                 self.__path.unlink()
             except OSError:
                 pass
+            if self.__on_close is not None:
+                self.__on_close(self.__path)
+                self.__on_close = None
 
     def __init__(self, persistent_directory,
                  on_emit,
                  *,
                  sample_type="H",
-                 logger=None):
+                 logger=None,
+                 use_mmap=False,
+                 sync_every=None,
+                 sync_interval=None,
+                 fit_drift=False):
         if len(sample_type) != 1 or not (32 <= ord(sample_type[0]) <= 127):
             raise ValueError("invalid sample type")
         super().__init__()
@@ -110,14 +442,34 @@ class Buffer:
         persistent_directory.mkdir(exist_ok=True)
         self.__dirfd = os.open(str(persistent_directory), os.O_DIRECTORY)
         self.__path = persistent_directory / "current"
+        self.__index_path = persistent_directory / "index"
+        self.__pending = {}
+        self.__closed_segments = 0
+        self.__recovered = collections.deque()
+        self.__recovered_in_flight = 0
 
         self.__sample_type = sample_type
         self.__sample_struct = struct.Struct(
             # we only allow ascii here
             "<"+sample_type
         )
+        # whether the in-memory array layout equals the on-disk layout
+        self.__native_layout = (
+            array.array(sample_type).itemsize == self.__sample_struct.size and
+            sys.byteorder == "little"
+        )
         self.batch_size = 1024
 
+        self.__use_mmap = use_mmap
+        self.__fit_drift = fit_drift
+        self.__sync_every = sync_every
+        self.__sync_interval = sync_interval
+        self.__segment_fd = None
+        self.__segment_map = None
+        self.__unsynced = 0
+        self.__last_sync = time.monotonic()
+        self.__sync_handle = None
+
         self.__batch_seq_abs0 = None
         self.__batch_seq_rel0 = None
         self.__batch_data = None
@@ -128,15 +480,23 @@ class Buffer:
         )
         self.__period = None
         self.__alignment_t0 = None
-        self.__alignment_data = []
+        self.__alignment = None
         self._emit_existing()
 
     def __del__(self):
+        if self.__sync_handle is not None:
+            self.__sync_handle.cancel()
+        if self.__segment_map is not None:
+            # the header is always up to date in the mapping; the data is
+            # recovered from the segment file on the next start
+            self.__segment_map.close()
+            os.close(self.__segment_fd)
         os.close(self.__dirfd)
 
     def reset(self):
         self._emit()
-        self.__alignment_data.clear()
+        if self.__alignment is not None:
+            self.__alignment.reset()
         self.__timeline.reset(0)
 
     def align(self, seq_rel, rtc, period):
@@ -151,8 +511,8 @@ class Buffer:
         :type period: :class:`datetime.timedelta`
 
         The assignment of RTC times to sequence numbers is configured smoothly
-        by using the most recent three calls to :meth:`align` to determine the
-        mapping.
+        by using the most recent 1000 calls to :meth:`align` to determine the
+        mapping (see :class:`ClockAlignment`; `fit_drift` is passed on).
 
         A change to `period` causes current buffers to be emitted and the
         mapping to be reset.
@@ -164,35 +524,16 @@ class Buffer:
 
         if self.__period != period:
             self.reset()
+            self.__alignment = ClockAlignment(period,
+                                              fit_drift=self.__fit_drift)
         self.__period = period
 
         offset = self.__timeline.feed_and_transform(seq_rel)
         self.__timeline.reset(seq_rel)
-        if len(self.__alignment_data) > 999:
-            del self.__alignment_data[0]
-
-        for i in range(len(self.__alignment_data)):
-            old_seq_abs, old_rtc = self.__alignment_data[i]
-            self.__alignment_data[i] = (
-                old_seq_abs - offset,
-                old_rtc,
-            )
+        self.__alignment.add(offset, rtc)
 
-        self.__alignment_data.append((0, rtc))
-
-        expected = (
-            self.__alignment_data[0][1] -
-            self.__alignment_data[0][0]*self.__period
-        )
-
-        self.__alignment_t0 = rtc + sum(
-            (
-                (old_rtc-old_seq_abs*self.__period)-rtc
-                for old_seq_abs, old_rtc
-                in self.__alignment_data
-            ),
-            timedelta(0)
-        ) / len(self.__alignment_data)
+        expected = self.__alignment.oldest_t0
+        self.__alignment_t0 = self.__alignment.t0
 
         self.logger.debug(
             "difference: %s%s; drift: %s%s",
@@ -205,7 +546,113 @@ class Buffer:
         if self.__batch_seq_abs0 is not None:
             self.__batch_seq_abs0 -= offset
 
+    def _pack_samples(self, samples):
+        if self.__native_layout:
+            return samples.cast("B")
+        return struct.pack(
+            "<{}{}".format(len(samples), self.__sample_type),
+            *samples
+        )
+
+    def _unpack_samples(self, raw):
+        raw = raw[:len(raw) - len(raw) % self.__sample_struct.size]
+        if self.__native_layout:
+            data = array.array(self.__sample_type)
+            data.frombytes(raw)
+            return data
+        return array.array(self.__sample_type, (
+            value
+            for value, in self.__sample_struct.iter_unpack(raw)
+        ))
+
+    def _open_segment(self):
+        size = (self._header_v1.size +
+                self.batch_size * self.__sample_struct.size)
+        fd = os.open(str(self.__path), os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                     0o644)
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+            segment_map = mmap.mmap(fd, size)
+        except:  # NOQA
+            os.close(fd)
+            raise
+        os.fsync(self.__dirfd)
+        self.__segment_fd = fd
+        self.__segment_map = segment_map
+
+    def _sync_segment(self):
+        self.__segment_map[:self._header_v1.size] = self._make_header(
+            len(self.__batch_data),
+        )
+        self.__segment_map.flush()
+        self.__unsynced = 0
+        self.__last_sync = time.monotonic()
+        if self.__sync_handle is not None:
+            self.__sync_handle.cancel()
+            self.__sync_handle = None
+
+    def _sync_timer_expired(self):
+        self.__sync_handle = None
+        if self.__segment_map is not None and self.__unsynced:
+            self._sync_segment()
+
+    def _schedule_sync(self):
+        if self.__sync_handle is not None:
+            return
+        self.__sync_handle = asyncio.get_event_loop().call_later(
+            max(0, self.__last_sync + self.__sync_interval - time.monotonic()),
+            self._sync_timer_expired,
+        )
+
+    def _close_segment(self):
+        if self.__segment_map is None:
+            return
+        nsamples = len(self.__batch_data)
+        self._sync_segment()
+        self.__segment_map.close()
+        self.__segment_map = None
+        # give back the preallocated space which was not used
+        os.ftruncate(
+            self.__segment_fd,
+            self._header_v1.size + nsamples * self.__sample_struct.size,
+        )
+        os.close(self.__segment_fd)
+        self.__segment_fd = None
+
+    def _buffer_samples_mmap(self, samples):
+        if self.__segment_map is None:
+            self._open_segment()
+
+        start = (self._header_v1.size +
+                 len(self.__batch_data) * self.__sample_struct.size)
+        data = self._pack_samples(samples)
+        self.__segment_map[start:start+len(data)] = data
+        self.__batch_data.frombytes(samples.cast("B"))
+        self.__unsynced += len(samples)
+
+        if self.__sync_every is None and self.__sync_interval is None:
+            self._sync_segment()
+        elif ((self.__sync_every is not None and
+               self.__unsynced >= self.__sync_every) or
+              (self.__sync_interval is not None and
+               time.monotonic() - self.__last_sync >= self.__sync_interval)):
+            self._sync_segment()
+        else:
+            # keep the header current for recovery in case the mapping is
+            # written back without an explicit sync
+            self.__segment_map[:self._header_v1.size] = self._make_header(
+                len(self.__batch_data),
+            )
+            if self.__sync_interval is not None:
+                self._schedule_sync()
+
     def _buffer_samples(self, samples):
+        if self.__use_mmap:
+            return self._buffer_samples_mmap(samples)
+
         try:
             f = self.__path.open("xb")
         except FileExistsError:
@@ -216,16 +663,13 @@ class Buffer:
             # we always re-write the header with current information
             f.write(self._make_header())
             f.seek(0, io.SEEK_END)
-            f.writelines(
-                self.__sample_struct.pack(sample)
-                for sample in samples
-            )
+            f.write(self._pack_samples(samples))
             os.fsync(f.fileno())
 
         os.fsync(self.__dirfd)
 
         # self.__timeline.forward(len(samples))
-        self.__batch_data.extend(samples)
+        self.__batch_data.frombytes(samples.cast("B"))
 
     def _get_batch_t0(self):
         return self.__alignment_t0 + self.__period * self.__batch_seq_abs0
@@ -235,24 +679,38 @@ class Buffer:
             return
 
         t0 = self.__alignment_t0 + self.__period * self.__batch_seq_abs0
+        self._close_segment()
         data = self.__batch_data
         nitems = len(data)
-        self.__batch_data = []
+        self.__batch_data = array.array(self.__sample_type)
 
         persistent = self.__path.parent / str(t0.isoformat())
         self.__path.rename(persistent)
+        if self.__use_mmap:
+            os.fsync(self.__dirfd)
+
+        info = SegmentInfo(
+            t0=t0,
+            seq0=self.__batch_seq_rel0,
+            period=self.__period,
+            count=nitems,
+            sample_type=self.__sample_type,
+            header_version=0x01 if self.__use_mmap else 0x00,
+        )
+        self.__pending[persistent.name] = info
+        with self.__index_path.open("ab") as f:
+            f.write(self._make_index_record(persistent.name, info))
 
         self.on_emit(
             t0,
             self.__batch_seq_rel0,
             self.__period,
             data,
-            self._Handle(persistent)
+            self._Handle(persistent, self._segment_closed)
         )
 
         self.__batch_seq_abs0 += nitems
         self.__batch_seq_rel0 = (self.__batch_seq_rel0 + nitems) % (2**16)
-        self.__batch_data = []
 
     def submit(self, first_seq_rel, samples):
         """
@@ -274,75 +732,183 @@ class Buffer:
         if self.__batch_seq_rel0 is None:
             self.__batch_seq_rel0 = first_seq_rel
             self.__batch_seq_abs0 = first_seq_abs
-            self.__batch_data = []
+            self.__batch_data = array.array(self.__sample_type)
 
         if first_seq_abs != self.__batch_seq_abs0 + len(self.__batch_data):
             self._emit()
             self.__batch_seq_abs0 = first_seq_abs
             self.__batch_seq_rel0 = first_seq_rel
 
-        samples = list(samples)
+        if (not isinstance(samples, array.array) or
+                samples.typecode != self.__sample_type):
+            samples = array.array(self.__sample_type, samples)
+        samples = memoryview(samples)
         while len(samples) + len(self.__batch_data) >= self.batch_size:
             to_submit = self.batch_size - len(self.__batch_data)
             self._buffer_samples(samples[:to_submit])
             self._emit()
-            del samples[:to_submit]
+            samples = samples[to_submit:]
         if samples:
             self._buffer_samples(samples)
 
-    def _make_header(self):
+    def _make_header(self, count=None):
         t0 = self._get_batch_t0()
         t0_s, t0_us = utils.decompose_dt(t0)
-
-        return self._header.pack(
-            0x00,  # version
+        fields = (
             t0_s, t0_us,
             self.__batch_seq_rel0,
             round(self.__period.total_seconds() * 1e6),  # period
             self.__sample_type.encode("ascii"),  # sample type
         )
 
-    def _parse_sample_data(self, f):
-        version, t0_s, t0_us, seq0, period, sample_type = \
-            utils.read_single(
-                f,
-                self._header
+        if count is None:
+            return self._header.pack(0x00, *fields)
+        return self._header_v1.pack(0x01, *fields, count)
+
+    def _make_index_record(self, name, info):
+        t0_s, t0_us = utils.decompose_dt(info.t0)
+        name = name.encode("utf-8")
+        return b"".join([
+            self._header_v1.pack(
+                info.header_version,
+                t0_s, t0_us,
+                info.seq0,
+                round(info.period.total_seconds() * 1e6),
+                info.sample_type.encode("ascii"),
+                info.count,
+            ),
+            self._index_name.pack(len(name)),
+            name,
+        ])
+
+    def _read_index(self):
+        try:
+            f = self.__index_path.open("rb")
+        except FileNotFoundError:
+            return {}
+
+        result = {}
+        with f:
+            while True:
+                try:
+                    (version, t0_s, t0_us, seq0, period, sample_type,
+                     count) = utils.read_single(f, self._header_v1)
+                    name_length, = utils.read_single(f, self._index_name)
+                except EOFError:
+                    break
+                name = f.read(name_length)
+                if len(name) < name_length:
+                    # partially written record
+                    break
+                result[name.decode("utf-8", errors="replace")] = SegmentInfo(
+                    t0=datetime.utcfromtimestamp(t0_s).replace(
+                        microsecond=t0_us
+                    ),
+                    seq0=seq0,
+                    period=timedelta(microseconds=period),
+                    count=count,
+                    sample_type=sample_type.decode("ascii", errors="replace"),
+                    header_version=version,
+                )
+        return result
+
+    def _write_index(self):
+        tmp_path = self.__index_path.with_name(self.__index_path.name + ".tmp")
+        with tmp_path.open("wb") as f:
+            for name, info in self.__pending.items():
+                f.write(self._make_index_record(name, info))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(tmp_path), str(self.__index_path))
+        os.fsync(self.__dirfd)
+        self.__closed_segments = 0
+
+    def _segment_closed(self, path):
+        if self.__pending.pop(path.name, None) is None:
+            return
+        self.__closed_segments += 1
+        if self.__closed_segments >= max(self.INDEX_COMPACT_THRESHOLD,
+                                         len(self.__pending)):
+            self._write_index()
+
+    def _recovered_segment_closed(self, path):
+        self._segment_closed(path)
+        self.__recovered_in_flight -= 1
+        self._release_recovered()
+
+    def _release_recovered(self):
+        while (self.__recovered and
+               self.__recovered_in_flight < self.MAX_RECOVERED_IN_FLIGHT):
+            info, path = self.__recovered.popleft()
+            self.__recovered_in_flight += 1
+            self.on_emit(
+                info.t0,
+                info.seq0,
+                info.period,
+                SegmentData(
+                    path,
+                    (self._header_v1.size if info.header_version == 0x01
+                     else self._header.size),
+                    info.count,
+                    self.__sample_struct.size,
+                    self._unpack_samples,
+                    self.logger,
+                ),
+                self._Handle(path, self._recovered_segment_closed)
             )
 
+    def _parse_segment_info(self, f):
+        version = f.read(1)
+        f.seek(0)
+        if version == b"\x01":
+            (version, t0_s, t0_us, seq0, period, sample_type,
+             count) = utils.read_single(f, self._header_v1)
+        else:
+            version, t0_s, t0_us, seq0, period, sample_type = \
+                utils.read_single(
+                    f,
+                    self._header
+                )
+            count = None
+
         self.logger.debug(
             "found file with version %d",
             version,
         )
 
-        if version != 0x00:
+        if version not in (0x00, 0x01):
             self.logger.warning(
                 "discarding data due to unsupported format"
             )
             return
 
-        sample_type = sample_type.decode("ascii", errors="replace")
-        t0 = datetime.utcfromtimestamp(t0_s).replace(microsecond=t0_us)
-        period = timedelta(microseconds=period)
-        data = [
-            value
-            for value, in utils.read_all(
-                    f,
-                    self.__sample_struct)
-        ]
-
-        self.logger.debug(
-            "found %d samples starting at %r with period %s",
-            len(data),
-            t0,
-            period,
+        if count is None:
+            f.seek(0, io.SEEK_END)
+            count = (f.tell() - self._header.size) // \
+                self.__sample_struct.size
+
+        return SegmentInfo(
+            t0=datetime.utcfromtimestamp(t0_s).replace(microsecond=t0_us),
+            seq0=seq0,
+            period=timedelta(microseconds=period),
+            count=count,
+            sample_type=sample_type.decode("ascii", errors="replace"),
+            header_version=version,
         )
 
-        return t0, seq0, period, data
-
     def _emit_existing(self):
+        indexed = self._read_index()
         items = []
 
         for path in self.__path.parent.iterdir():
+            if path.name.startswith(self.__index_path.name):
+                continue
+
+            info = indexed.get(path.name)
+            if info is not None and path != self.__path:
+                items.append((info, path))
+                continue
+
             try:
                 f = path.open("rb")
             except OSError:
@@ -358,20 +924,29 @@ class Buffer:
 
             with f:
                 try:
-                    data = self._parse_sample_data(f)
+                    info = self._parse_segment_info(f)
                 except EOFError:
-                    data = None
+                    info = None
 
-            if data is not None:
-                items.append((data, path))
+            if info is not None:
+                if path == self.__path:
+                    # new batches are written to this path
+                    recovered = path.parent / str(info.t0.isoformat())
+                    path.rename(recovered)
+                    path = recovered
+                items.append((info, path))
 
         items.sort(key=lambda x: x[0])
 
-        for (t0, seq0, period, data), path in items:
-            self.on_emit(
-                t0,
-                seq0,
-                period,
-                data,
-                self._Handle(path)
+        self.__pending = {path.name: info for info, path in items}
+        self._write_index()
+
+        for info, path in items:
+            self.logger.debug(
+                "found %d samples starting at %r with period %s",
+                info.count,
+                info.t0,
+                info.period,
             )
+        self.__recovered.extend(items)
+        self._release_recovered()
@@ -1,3 +1,4 @@
+import abc
 import binascii
 import collections
 import math
@@ -7,8 +8,9 @@ import time
 from datetime import datetime, timedelta
 from enum import Enum
 
-from hintlib.utils import unpack_and_splice, unpack_all
-from hintlib import sample
+from hintlib import bme280, sample
+
+from . import stream
 
 
 class DataFrameType(Enum):
@@ -34,6 +36,49 @@ class MsgType(Enum):
     SENSOR_STREAM_COMPASS_Z = 0xfd
 
 
+# Slots of the CPU time counters in v6 status messages: the idle and
+# scheduler ticks, the ticks spent in interrupt handlers and, from
+# CPU_TASK_BASE on, the ticks of each task.
+CPU_IDLE = 0x00
+CPU_SCHED = 0x01
+CPU_INTR_BASE = 0x02
+CPU_TASK_BASE = 0x10
+CPU_SLOTS = 0x20
+
+
+def _unpack_all_from(struct_, buf, offset=0):
+    return struct_.iter_unpack(buf[offset:])
+
+
+class _SampleGroupsMessage(metaclass=abc.ABCMeta):
+    """
+    Base for messages which carry sensor samples.
+
+    Subclasses implement :meth:`get_sample_groups`; :meth:`get_samples` is
+    derived from it, so that the values are converted in one place only.
+    """
+
+    @abc.abstractmethod
+    def get_sample_groups(self):
+        """
+        Yield the samples of the message as ``(timestamp, bare_path,
+        {subpart: value})`` groups.
+        """
+
+    def get_samples(self):
+        """
+        Yield the samples of the message as individual
+        :class:`hintlib.sample.Sample` objects.
+        """
+        for timestamp, bare_path, values in self.get_sample_groups():
+            for subpart, value in values.items():
+                yield sample.Sample(
+                    timestamp,
+                    bare_path.replace(subpart=subpart),
+                    value,
+                )
+
+
 class StatusMessage:
     rtc = None
     uptime = None
@@ -53,13 +98,10 @@ class StatusMessage:
         )
 
         @classmethod
-        def unpack_and_splice(cls, version, buf):
+        def unpack_from(cls, version, buf, offset):
             result = cls()
-            buf, (result.transaction_overruns,) = unpack_and_splice(
-                buf,
-                cls._v2
-            )
-            return buf, result
+            result.transaction_overruns, = cls._v2.unpack_from(buf, offset)
+            return offset + cls._v2.size, result
 
     class BME280Metrics:
         configure_status = 0xff
@@ -76,21 +118,16 @@ class StatusMessage:
         )
 
         @classmethod
-        def unpack_and_splice(cls, version, buf):
+        def unpack_from(cls, version, buf, offset):
             result = cls()
             if version < 3:
-                buf, (result.timeouts,) = unpack_and_splice(
-                    buf,
-                    cls._v2
-                )
+                result.timeouts, = cls._v2.unpack_from(buf, offset)
                 result.configure_status = 0x00
-            else:
-                buf, (result.configure_status, result.timeouts,) = \
-                    unpack_and_splice(
-                        buf,
-                        cls._v3
-                    )
-            return buf, result
+                return offset + cls._v2.size, result
+
+            result.configure_status, result.timeouts = \
+                cls._v3.unpack_from(buf, offset)
+            return offset + cls._v3.size, result
 
     class IMUStreamState(collections.namedtuple(
             "_IMUStreamState",
@@ -102,13 +139,10 @@ class StatusMessage:
         )
 
         @classmethod
-        def unpack_and_splice(cls, version, buf):
-            buf, (seq, ts, period) = unpack_and_splice(
-                buf,
-                cls._v1
-            )
+        def unpack_from(cls, version, buf, offset):
+            seq, ts, period = cls._v1.unpack_from(buf, offset)
             period = timedelta(milliseconds=period)
-            return buf, cls(seq, ts, period)
+            return offset + cls._v1.size, cls(seq, ts, period)
 
     class TXMetrics(collections.namedtuple(
             "_TXState",
@@ -123,19 +157,9 @@ class StatusMessage:
         )
 
         @classmethod
-        def unpack_and_splice(cls, version, buf):
-            buf, (most_buffers_allocated,
-                  buffers_allocated,
-                  buffers_ready,
-                  buffers_total) = unpack_and_splice(
-                buf,
-                cls._v1,
-            )
-
-            return buf, cls(most_buffers_allocated,
-                            buffers_allocated,
-                            buffers_ready,
-                            buffers_total)
+        def unpack_from(cls, version, buf, offset):
+            return (offset + cls._v1.size,
+                    cls._make(cls._v1.unpack_from(buf, offset)))
 
     class TasksMetrics(collections.namedtuple(
             "_TasksMetrics",
@@ -151,12 +175,9 @@ class StatusMessage:
             )
 
             @classmethod
-            def unpack_and_splice(cls, version, buf):
-                buf, (cpu_ticks,) = unpack_and_splice(
-                    buf,
-                    cls._v1,
-                )
-                return buf, cls(cpu_ticks)
+            def unpack_from(cls, version, buf, offset):
+                cpu_ticks, = cls._v1.unpack_from(buf, offset)
+                return offset + cls._v1.size, cls(cpu_ticks)
 
         _v1 = struct.Struct(
             "<"
@@ -164,21 +185,20 @@ class StatusMessage:
         )
 
         @classmethod
-        def unpack_and_splice(cls, version, buf):
-            buf, (count, idle_ticks) = unpack_and_splice(
-                buf,
-                cls._v1,
-            )
+        def unpack_from(cls, version, buf, offset):
+            count, idle_ticks = cls._v1.unpack_from(buf, offset)
+            offset += cls._v1.size
 
             tasks = []
             for i in range(count):
-                buf, task = cls.TaskMetrics.unpack_and_splice(
+                offset, task = cls.TaskMetrics.unpack_from(
                     version,
                     buf,
+                    offset,
                 )
                 tasks.append(task)
 
-            return buf, cls(idle_ticks, tuple(tasks))
+            return offset, cls(idle_ticks, tuple(tasks))
 
     class CPUMetrics(collections.namedtuple(
             "_CPUMetrics",
@@ -191,31 +211,29 @@ class StatusMessage:
 
         _v1 = struct.Struct(
             "<" +
-            "H"*0x20
+            "H"*CPU_SLOTS
         )
 
+        # the interrupt handlers are identified by their slot
         INTERRUPT_MAP = {
-            getattr(lib, key): key[9:].lower()
-            for key in dir(lib)
-            if key.startswith("CPU_INTR_")
+            index: "intr{}".format(index - CPU_INTR_BASE)
+            for index in range(CPU_INTR_BASE, CPU_TASK_BASE)
         }
 
         @classmethod
-        def unpack_and_splice(cls, version, buf):
-            buf, (*data,) = unpack_and_splice(
-                buf,
-                cls._v1,
-            )
+        def unpack_from(cls, version, buf, offset):
+            data = cls._v1.unpack_from(buf, offset)
+            offset += cls._v1.size
 
-            idle = data[lib.CPU_IDLE]
-            sched = data[lib.CPU_SCHED]
+            idle = data[CPU_IDLE]
+            sched = data[CPU_SCHED]
             interrupts = {
                 name: data[index]
                 for index, name in cls.INTERRUPT_MAP.items()
             }
-            tasks = data[lib.CPU_TASK_BASE:]
+            tasks = data[CPU_TASK_BASE:]
 
-            return buf, cls(idle, sched, interrupts, tasks)
+            return offset, cls(idle, sched, interrupts, tasks)
 
     _base_header = struct.Struct(
         "<"
@@ -231,13 +249,11 @@ class StatusMessage:
     def from_buf(cls, type_, buf):
         result = cls()
         result.type_ = type_
-        buf, (rtc,
-              uptime,
-              protocol_version,
-              status_version) = unpack_and_splice(
-                  buf,
-                  cls._base_header,
-              )
+        (rtc,
+         uptime,
+         protocol_version,
+         status_version) = cls._base_header.unpack_from(buf, 0)
+        offset = cls._base_header.size
 
         if protocol_version != 1:
             raise ValueError("unsupported protocol")
@@ -248,42 +264,46 @@ class StatusMessage:
         result.rtc = None
         result.uptime = uptime
         if 1 <= status_version:
-            buf, result.v1_accel_stream_state = \
-                cls.IMUStreamState.unpack_and_splice(status_version, buf)
-            buf, result.v1_compass_stream_state = \
-                cls.IMUStreamState.unpack_and_splice(status_version, buf)
+            offset, result.v1_accel_stream_state = \
+                cls.IMUStreamState.unpack_from(status_version, buf, offset)
+            offset, result.v1_compass_stream_state = \
+                cls.IMUStreamState.unpack_from(status_version, buf, offset)
 
         if 2 <= status_version:
             result.v2_i2c_metrics = []
             for i2c_bus_no in range(2):
-                buf, metrics = cls.I2CMetrics.unpack_and_splice(
+                offset, metrics = cls.I2CMetrics.unpack_from(
                     status_version,
                     buf,
+                    offset,
                 )
                 result.v2_i2c_metrics.append(metrics)
 
             if status_version >= 4:
                 result.v4_bme280_metrics = []
-                buf, metrics = \
-                    cls.BME280Metrics.unpack_and_splice(
+                offset, metrics = \
+                    cls.BME280Metrics.unpack_from(
                         status_version,
                         buf,
+                        offset,
                     )
                 result.v4_bme280_metrics.append(metrics)
 
-                buf, metrics = \
-                    cls.BME280Metrics.unpack_and_splice(
+                offset, metrics = \
+                    cls.BME280Metrics.unpack_from(
                         status_version,
                         buf,
+                        offset,
                     )
                 result.v4_bme280_metrics.append(metrics)
 
                 result.v2_bme280_metrics = result.v4_bme280_metrics[0]
             else:
-                buf, result.v2_bme280_metrics = \
-                    cls.BME280Metrics.unpack_and_splice(
+                offset, result.v2_bme280_metrics = \
+                    cls.BME280Metrics.unpack_from(
                         status_version,
                         buf,
+                        offset,
                     )
                 result.v4_bme280_metrics = [
                     result.v2_bme280_metrics,
@@ -291,21 +311,24 @@ class StatusMessage:
                 ]
 
         if 5 <= status_version:
-            buf, result.v5_tx_metrics = cls.TXMetrics.unpack_and_splice(
+            offset, result.v5_tx_metrics = cls.TXMetrics.unpack_from(
                 status_version,
                 buf,
+                offset,
             )
 
         if 5 <= status_version < 6:
-            buf, result.v5_task_metrics = cls.TasksMetrics.unpack_and_splice(
+            offset, result.v5_task_metrics = cls.TasksMetrics.unpack_from(
                 status_version,
                 buf,
+                offset,
             )
 
         if 6 <= status_version:
-            buf, result.v6_cpu_metrics = cls.CPUMetrics.unpack_and_splice(
+            offset, result.v6_cpu_metrics = cls.CPUMetrics.unpack_from(
                 status_version,
                 buf,
+                offset,
             )
 
         return result
@@ -320,7 +343,7 @@ class StatusMessage:
         )
 
 
-class DS18B20Message:
+class DS18B20Message(_SampleGroupsMessage):
     timestamp = None
     samples = None
 
@@ -342,16 +365,17 @@ class DS18B20Message:
 
     @classmethod
     def from_buf(cls, type_, buf):
-        buf, (timestamp,) = unpack_and_splice(
-            buf,
-            cls._header,
-        )
+        timestamp, = cls._header.unpack_from(buf, 0)
 
         return cls(
             timestamp,
             (
                 (id_, value/16)
-                for id_, value in unpack_all(buf, cls._sample)
+                for id_, value in _unpack_all_from(
+                    cls._sample,
+                    buf,
+                    cls._header.size,
+                )
             ),
             type_=type_,
         )
@@ -365,19 +389,19 @@ class DS18B20Message:
             id(self),
         )
 
-    def get_samples(self):
+    def get_sample_groups(self):
         for id_, value in self.samples:
-            yield sample.Sample(
+            yield (
                 self.timestamp,
                 sample.SensorPath(
                     sample.Part.DS18B20,
                     binascii.b2a_hex(id_).decode(),
                 ),
-                value,
+                {None: value},
             )
 
 
-class NoiseMessage:
+class NoiseMessage(_SampleGroupsMessage):
     samples = None
 
     _header = struct.Struct(
@@ -402,12 +426,12 @@ class NoiseMessage:
 
     @classmethod
     def from_buf(cls, type_, buf):
-        buf, (factor,) = unpack_and_splice(buf, cls._header)
+        factor, = cls._header.unpack_from(buf, 0)
         return cls(
             [
                 (ts, sqavg / (2**24-1) / factor, min_, max_)
                 for ts, sqavg, min_, max_
-                in unpack_all(buf, cls._sample)
+                in _unpack_all_from(cls._sample, buf, cls._header.size)
             ],
             type_=type_
         )
@@ -420,33 +444,16 @@ class NoiseMessage:
             id(self),
         )
 
-    def get_samples(self):
+    def get_sample_groups(self):
         for ts, sqavg, min_, max_ in self.samples:
-            rms = math.sqrt(sqavg)
-            yield sample.Sample(
-                ts,
-                self._sensor_path.replace(
-                    subpart=sample.CustomNoiseSubpart.RMS
-                ),
-                rms,
-            )
-            yield sample.Sample(
-                ts,
-                self._sensor_path.replace(
-                    subpart=sample.CustomNoiseSubpart.MIN
-                ),
-                min_ / (2**15-1)
-            )
-            yield sample.Sample(
-                ts,
-                self._sensor_path.replace(
-                    subpart=sample.CustomNoiseSubpart.MAX
-                ),
-                max_ / (2**15-1)
-            )
+            yield ts, self._sensor_path, {
+                sample.CustomNoiseSubpart.RMS: math.sqrt(sqavg),
+                sample.CustomNoiseSubpart.MIN: min_ / (2**15-1),
+                sample.CustomNoiseSubpart.MAX: max_ / (2**15-1),
+            }
 
 
-class LightMessage:
+class LightMessage(_SampleGroupsMessage):
     samples = None
 
     _sample = struct.Struct(
@@ -454,6 +461,11 @@ class LightMessage:
         "H4H"
     )
 
+    _sensor_path = sample.SensorPath(
+        sample.Part.TCS3200,
+        0,
+    )
+
     _ch_parts = [
         sample.TCS3200Subpart.RED,
         sample.TCS3200Subpart.GREEN,
@@ -471,7 +483,8 @@ class LightMessage:
         return cls(
             (
                 (timestamp, tuple(values))
-                for timestamp, *values in unpack_all(buf, cls._sample)
+                for timestamp, *values in _unpack_all_from(cls._sample,
+                                                           buf)
             ),
             type_=type_,
         )
@@ -484,21 +497,12 @@ class LightMessage:
             id(self),
         )
 
-    def get_samples(self):
+    def get_sample_groups(self):
         for ts, channels in self.samples:
-            for ch_i, ch_subpart in enumerate(self._ch_parts):
-                yield sample.Sample(
-                    ts,
-                    sample.SensorPath(
-                        sample.Part.TCS3200,
-                        0,
-                        ch_subpart,
-                    ),
-                    channels[ch_i]
-                )
+            yield ts, self._sensor_path, dict(zip(self._ch_parts, channels))
 
 
-class BME280Message:
+class BME280Message(_SampleGroupsMessage):
     timestamp = None
     instance = None
     temperature = None
@@ -523,12 +527,12 @@ class BME280Message:
 
     @classmethod
     def from_buf(cls, type_, buf):
-        buf, (timestamp,
-              instance,
-              dig88,
-              dige1,
-              readout) = unpack_and_splice(buf, cls._message)
-        if buf:
+        (timestamp,
+         instance,
+         dig88,
+         dige1,
+         readout) = cls._message.unpack_from(buf, 0)
+        if len(buf) > cls._message.size:
             raise ValueError("too much data in buffer")
 
         calibration = bme280.get_calibration(dig88, dige1)
@@ -570,35 +574,15 @@ class BME280Message:
             id(self),
         )
 
-    def get_samples(self):
-        yield sample.Sample(
+    def get_sample_groups(self):
+        yield (
             self.timestamp,
-            sample.SensorPath(
-                sample.Part.BME280,
-                self.instance,
-                sample.BME280Subpart.TEMPERATURE,
-            ),
-            self.temperature,
-        )
-
-        yield sample.Sample(
-            self.timestamp,
-            sample.SensorPath(
-                sample.Part.BME280,
-                self.instance,
-                sample.BME280Subpart.PRESSURE,
-            ),
-            self.pressure,
-        )
-
-        yield sample.Sample(
-            self.timestamp,
-            sample.SensorPath(
-                sample.Part.BME280,
-                self.instance,
-                sample.BME280Subpart.HUMIDITY,
-            ),
-            self.humidity,
+            sample.SensorPath(sample.Part.BME280, self.instance),
+            {
+                sample.BME280Subpart.TEMPERATURE: self.temperature,
+                sample.BME280Subpart.PRESSURE: self.pressure,
+                sample.BME280Subpart.HUMIDITY: self.humidity,
+            },
         )
 
 
@@ -628,13 +612,10 @@ class SensorStreamMessage:
 
     @classmethod
     def from_buf(cls, type_, buf):
-        buf, (seq, reference) = unpack_and_splice(
-            buf,
-            cls._header,
-        )
-        data = sensor_stream.decompress(
+        seq, reference = cls._header.unpack_from(buf, 0)
+        data = stream.decompress(
             reference,
-            buf
+            memoryview(buf)[cls._header.size:],
         )
         return cls(
             type_,
@@ -680,21 +661,41 @@ msgtype_to_cls = {
 }
 
 
-def decode_sbx_message(buf):
-    try:
-        type_ = MsgType(buf[0])
-    except ValueError:
-        raise ValueError("unknown message type: 0x{:02x}".format(buf[0]))
+# raw type byte -> (type, decoder)
+_decoders = {
+    type_.value: (type_, cls.from_buf)
+    for type_, cls in msgtype_to_cls.items()
+}
 
+
+def decode_sbx_message(buf):
+    """
+    Decode a single SBX message.
+
+    :param buf: The message, starting with the type byte.
+    :type buf: :term:`bytes-like object`
+
+    The message is decoded from a :class:`memoryview` of `buf`, without
+    copying the payload.
+    """
+    buf = memoryview(buf)
+    if not buf:
+        raise ValueError("empty message")
     try:
-        cls = msgtype_to_cls[type_]
+        type_, decoder = _decoders[buf[0]]
     except KeyError:
-        raise ValueError("no handler for message: {}".format(type_))
+        try:
+            type_ = MsgType(buf[0])
+        except ValueError:
+            raise ValueError(
+                "unknown message type: 0x{:02x}".format(buf[0])
+            ) from None
+        raise ValueError("no handler for message: {}".format(type_)) from None
 
-    return cls.from_buf(type_, buf[1:])
+    return decoder(type_, buf[1:])
 
 
-class ESPStatusMessage:
+class ESPStatusMessage(_SampleGroupsMessage):
     type_ = None
     rtc_timestamp = None
     tx_sent = None
@@ -741,12 +742,7 @@ class ESPStatusMessage:
 
     @classmethod
     def from_buf(cls, rtc_timestamp, buf):
-        buf, argv = unpack_and_splice(
-            buf,
-            cls._v1
-        )
-
-        return cls(rtc_timestamp, *argv)
+        return cls(rtc_timestamp, *cls._v1.unpack_from(buf, 0))
 
     def __repr__(self):
         return "<{}.{} 0x{:x}>".format(
@@ -755,22 +751,20 @@ class ESPStatusMessage:
             id(self),
         )
 
-    def get_samples(self):
+    def get_sample_groups(self):
+        samples = {}
         for attr in dir(self):
             if not attr.startswith("tx_"):
                 continue
             value = getattr(self, attr)
             if value is None:
                 continue
-
-            yield sample.Sample(
-                self.rtc_timestamp,
-                sample.SensorPath(
-                    sample.Part.ESP8266_TX,
-                    instance=None,
-                    subpart=sample.ESP8266TXSubpart(
-                        attr[3:].replace("_", "-"),
-                    )
-                ),
-                getattr(self, attr)
-            )
+            samples[sample.ESP8266TXSubpart(
+                attr[3:].replace("_", "-"),
+            )] = value
+
+        yield (
+            self.rtc_timestamp,
+            sample.SensorPath(sample.Part.ESP8266_TX, instance=None),
+            samples,
+        )
@@ -2,8 +2,8 @@ import asyncio
 import concurrent.futures
 import functools
 import itertools
+import math
 import numbers
-import time
 import typing
 
 from datetime import datetime
@@ -27,6 +27,157 @@ def byte_range(x: int):
 byte = schema.And(int, byte_range)
 
 
+class WriteByte(typing.NamedTuple):
+    device: int
+    register: int
+    data: int
+
+    def execute(self, bus: smbus.SMBus, logger):
+        logger.debug("write: 0x%02x 0x%02x <- 0x%02x",
+                     self.device, self.register, self.data)
+        bus.write_byte_data(self.device, self.register, self.data)
+
+
+class ReadByte(typing.NamedTuple):
+    device: int
+    register: int
+
+    def execute(self, bus: smbus.SMBus, logger):
+        logger.debug("reading: 0x%02x 0x%02x", self.device, self.register)
+        result = bus.read_byte_data(self.device, self.register)
+        logger.debug("read: 0x%02x 0x%02x -> 0x%02x",
+                     self.device, self.register, result)
+        return result
+
+
+class ReadRange(typing.NamedTuple):
+    device: int
+    register_start: int
+    nbytes: int
+
+    def execute(self, bus: smbus.SMBus, logger):
+        logger.debug("reading: 0x%02x 0x%02x [%d]",
+                     self.device, self.register_start, self.nbytes)
+        result = bytes(bus.read_i2c_block_data(
+            self.device,
+            self.register_start,
+            self.nbytes,
+        ))
+        logger.debug("read: 0x%02x 0x%02x [%d] -> %r",
+                     self.device, self.register_start, self.nbytes, result)
+        return result
+
+
+class VerifiedWrite(typing.NamedTuple):
+    device: int
+    register: int
+    data: int
+
+    def execute(self, bus: smbus.SMBus, logger):
+        WriteByte(self.device, self.register, self.data).execute(bus, logger)
+        readback = ReadByte(self.device, self.register).execute(bus, logger)
+        if self.data != readback:
+            raise ValueError(
+                f"readback {readback:02x} does not match data {self.data:02x}"
+            )
+        logger.debug("verified write to 0x%02x 0x%02x completed",
+                     self.device, self.register)
+
+
+class _SamplingGroup:
+    def __init__(self, origin):
+        super().__init__()
+        self.origin = origin
+        self.pending = []
+        self.task = None
+
+
+class SamplingScheduler:
+    """
+    Sample several devices on one bus in a single transaction per pass.
+
+    :param transport: The transport of the bus.
+
+    Requests with the same interval are executed on a common grid of
+    deadlines, which is kept even while there are no requests. A pass which
+    is missed (because the bus or the event loop was busy) is skipped
+    instead of being caught up on, so that samples are never taken in
+    bursts.
+    """
+
+    def __init__(self, transport: "Transport"):
+        super().__init__()
+        self._transport = transport
+        self._groups = {}
+
+    async def sample(self, interval: numbers.Real, op):
+        """
+        Execute `op` in the next pass for `interval`.
+
+        :param interval: The sampling interval in seconds.
+        :param op: The operation to execute.
+        :return: The time of the pass and the result of `op`.
+
+        If the operation fails, its exception is raised; the other
+        operations of the pass are not affected.
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            group = self._groups[interval]
+        except KeyError:
+            group = _SamplingGroup(loop.time())
+            self._groups[interval] = group
+
+        fut = loop.create_future()
+        group.pending.append((op, fut))
+        if group.task is None:
+            group.task = loop.create_task(self._run_group(interval, group))
+        return await fut
+
+    async def _run_group(self, interval, group):
+        loop = asyncio.get_event_loop()
+        last_deadline = None
+        try:
+            while True:
+                now = loop.time()
+                deadline = group.origin + math.ceil(
+                    (now - group.origin) / interval
+                ) * interval
+                if last_deadline is not None:
+                    deadline = max(deadline, last_deadline + interval)
+                if deadline > now:
+                    await asyncio.sleep(deadline - now)
+                last_deadline = deadline
+
+                pending = [(op, fut) for op, fut in group.pending
+                           if not fut.done()]
+                group.pending.clear()
+                if not pending:
+                    return
+
+                ts = datetime.utcnow()
+                try:
+                    results = await self._transport.transaction(
+                        [op for op, _ in pending],
+                        return_exceptions=True,
+                    )
+                except Exception as exc:  # NOQA
+                    results = [exc] * len(pending)
+
+                for (_, fut), result in zip(pending, results):
+                    if fut.done():
+                        continue
+                    if isinstance(result, Exception):
+                        fut.set_exception(result)
+                    else:
+                        fut.set_result((ts, result))
+        finally:
+            group.task = None
+            for _, fut in group.pending:
+                fut.cancel()
+            group.pending.clear()
+
+
 class Transport(interface.Transport[smbus.SMBus]):
     def __init__(self, *, config: smbus.SMBus, **kwargs):
         super().__init__(config=config, **kwargs)
@@ -35,6 +186,7 @@ class Transport(interface.Transport[smbus.SMBus]):
             max_workers=1,
             thread_name_prefix="smbus-",
         )
+        self.scheduler = SamplingScheduler(self)
 
     @classmethod
     def get_config_schema(cls) -> schema.Schema:
@@ -52,61 +204,57 @@ class Transport(interface.Transport[smbus.SMBus]):
                 f"failed to open I2C bus {bus_index:d}: {exc}"
             ) from exc
 
-    async def write_byte(self, device: int, register: int, data: int):
+    def _execute(self, ops, return_exceptions):
+        results = []
+        for op in ops:
+            try:
+                results.append(op.execute(self._bus, self.logger))
+            except Exception as exc:  # NOQA
+                if not return_exceptions:
+                    raise
+                results.append(exc)
+        return results
+
+    async def transaction(self, ops, *, return_exceptions: bool = False):
+        """
+        Execute a sequence of I2C operations in a single executor call.
+
+        :param ops: The operations (:class:`WriteByte`, :class:`ReadByte`,
+            :class:`ReadRange`, :class:`VerifiedWrite`) to execute in order.
+        :param return_exceptions: If true, an exception raised by an
+            operation is returned in place of its result and the remaining
+            operations are still executed, like with :func:`asyncio.gather`.
+        :return: The results of the operations, :data:`None` for writes.
+        :rtype: :class:`list`
+
+        By default, the first failing operation aborts the transaction and
+        its exception is raised.
+        """
         loop = asyncio.get_event_loop()
-        self.logger.debug("write: 0x%02x 0x%02x <- 0x%02x",
-                          device, register, data)
-        await loop.run_in_executor(
+        return await loop.run_in_executor(
             self._executor,
             functools.partial(
-                self._bus.write_byte_data,
-                device,
-                register,
-                data,
+                self._execute,
+                list(ops),
+                return_exceptions,
             )
         )
 
+    async def write_byte(self, device: int, register: int, data: int):
+        await self.transaction([WriteByte(device, register, data)])
+
     async def read_byte(self, device: int, register: int):
-        loop = asyncio.get_event_loop()
-        self.logger.debug("reading: 0x%02x 0x%02x", device, register)
-        result = await loop.run_in_executor(
-            self._executor,
-            functools.partial(
-                self._bus.read_byte_data,
-                device,
-                register,
-            )
-        )
-        self.logger.debug("read: 0x%02x 0x%02x -> 0x%02x",
-                          device, register, result)
+        result, = await self.transaction([ReadByte(device, register)])
         return result
 
     async def read_range(self, device: int, register_start: int, nbytes: int):
-        loop = asyncio.get_event_loop()
-        self.logger.debug("reading: 0x%02x 0x%02x [%d]",
-                          device, register_start, nbytes)
-        result = bytes(await loop.run_in_executor(
-            self._executor,
-            functools.partial(
-                self._bus.read_i2c_block_data,
-                device,
-                register_start,
-                nbytes,
-            )
-        ))
-        self.logger.debug("read: 0x%02x 0x%02x [%d] -> %r",
-                          device, register_start, nbytes, result)
+        result, = await self.transaction([
+            ReadRange(device, register_start, nbytes),
+        ])
         return result
 
     async def verified_write(self, device: int, register: int, data: int):
-        await self.write_byte(device, register, data)
-        readback = await self.read_byte(device, register)
-        if data != readback:
-            raise ValueError(
-                f"readback {readback:02x} does not match data {data:02x}"
-            )
-        self.logger.debug("verified write to 0x%02x 0x%02x completed",
-                          device, register)
+        await self.transaction([VerifiedWrite(device, register, data)])
 
 
 class BME280Config(typing.NamedTuple):
@@ -148,6 +296,11 @@ class BME280(interface.Source[BME280Config]):
         self._ctrl_hum = config.ctrl_hum_reg_value
         self._ctrl_meas = config.ctrl_meas_reg_value
         self._reconfigure_interval = config.reconfigure_interval
+        self._readout_op = ReadRange(
+            self._address,
+            self.REG_DATA_START,
+            self.READOUT_SIZE,
+        )
 
     @classmethod
     def get_config_schema(cls) -> schema.Schema:
@@ -196,40 +349,23 @@ class BME280(interface.Source[BME280Config]):
         await self.detect()
         self.logger.debug("configuration: 0x%02x 0x%02x 0x%02x",
                           self._cfg, self._ctrl_meas, self._ctrl_hum)
-        await self.transport.verified_write(
-            self._address,
-            self.REG_CONFIG,
-            self._cfg,
-        )
-        await self.transport.verified_write(
-            self._address,
-            self.REG_CTRL_MEAS,
-            self._ctrl_meas,
-        )
-        await self.transport.verified_write(
-            self._address,
-            self.REG_CTRL_HUM,
-            self._ctrl_hum,
-        )
+        await self.transport.transaction([
+            VerifiedWrite(self._address, self.REG_CONFIG, self._cfg),
+            VerifiedWrite(self._address, self.REG_CTRL_MEAS, self._ctrl_meas),
+            VerifiedWrite(self._address, self.REG_CTRL_HUM, self._ctrl_hum),
+        ])
         self.logger.debug("configuration complete")
 
     async def read_raw_calibration(self):
-        dig88 = await self.transport.read_range(
-            self._address,
-            0x88, self.DIG88_SIZE,
-        )
-        dige1 = await self.transport.read_range(
-            self._address,
-            0xe1, self.DIGE1_SIZE,
-        )
+        dig88, dige1 = await self.transport.transaction([
+            ReadRange(self._address, 0x88, self.DIG88_SIZE),
+            ReadRange(self._address, 0xe1, self.DIGE1_SIZE),
+        ])
         return dig88, dige1
 
     async def read_raw_values(self):
-        return await self.transport.read_range(
-            self._address,
-            self.REG_DATA_START,
-            self.READOUT_SIZE,
-        )
+        result, = await self.transport.transaction([self._readout_op])
+        return result
 
     def apply_compensations(self, calibration, raw_values):
         temp_raw, pressure_raw, humidity_raw = hintlib.bme280.get_readout(
@@ -265,6 +401,9 @@ class BME280(interface.Source[BME280Config]):
     async def sample_and_emit(self, calibration):
         ts = datetime.utcnow()
         raw_values = await self.read_raw_values()
+        await self._emit_raw_values(calibration, ts, raw_values)
+
+    async def _emit_raw_values(self, calibration, ts, raw_values):
         self.logger.debug("raw values: %r", raw_values)
         T, P, hum = self.apply_compensations(calibration, raw_values)
         self.logger.debug("cooked values: %r %r %r", T, P, hum)
@@ -274,7 +413,6 @@ class BME280(interface.Source[BME280Config]):
         )
 
     async def run(self):
-        tnext = time.monotonic()
         while True:
             await self.configure()
             calibration = hintlib.bme280.get_calibration(
@@ -286,14 +424,13 @@ class BME280(interface.Source[BME280Config]):
                              "calibrated successfully",
                              self._address)
             for i in range(self._reconfigure_interval):
-                tnow = time.monotonic()
-                if tnow < tnext:
-                    self.logger.debug("waiting for %.4fs until next sample",
-                                      tnext - tnow)
-                    await asyncio.sleep(tnext - tnow)
-
-                tnext += self._interval
-                await self.sample_and_emit(calibration)
+                # sensors on the same bus and with the same interval are
+                # read out together
+                ts, raw_values = await self.transport.scheduler.sample(
+                    self._interval,
+                    self._readout_op,
+                )
+                await self._emit_raw_values(calibration, ts, raw_values)
 
             self.logger.debug(
                 "reconfiguration interval passed, reconfiguring"
@@ -15,10 +15,19 @@ In contrast to TCP, it does **not** provide:
 * Guarantee of reception of all data (up to the termination of the connection)
 
 .. autoclass:: Protocol
+
+.. autoclass:: Server
+
+.. autoclass:: BatchedDatagramTransport
+
+.. autofunction:: create_batched_endpoint
 """
 
 import asyncio
+import bisect
+import collections
 import functools
+import heapq
 import ipaddress
 import logging
 import numbers
@@ -283,93 +292,204 @@ class SerialNumberProvider:
 
 
 class SerialNumberRangeSet:
-    def __init__(self):
-        self._ranges = []
+    """
+    Set of serial numbers, stored as sorted, disjoint ranges.
 
-    def add(self, sn):
-        for i, (start, end) in enumerate(self._ranges):
-            if start <= sn <= end:
-                return
+    :param bits: The number of bits of the serial numbers.
 
-            if end + 1 == sn:
-                if i+1 < len(self._ranges):
-                    next_start, next_end = self._ranges[i+1]
-                    if next_start == sn + 1:
-                        self._ranges[i] = start, next_end
-                        del self._ranges[i+1]
-                        return
+    Serial numbers can be passed as :class:`SerialNumber` or as plain
+    integers.
 
-                self._ranges[i] = start, sn
-                return
+    The ranges are kept as two sorted lists of range starts and ends. The
+    values are stored as offsets relative to a base serial number, so that
+    they can be compared with plain integer comparisons and searched using
+    :mod:`bisect`. This requires that all serial numbers in the set are
+    within half the serial number space of each other, which holds for the
+    out-of-order set of a receive window.
+    """
 
-            if start == sn + 1:
-                self._ranges[i] = sn, end
-                return
+    def __init__(self, bits=16):
+        super().__init__()
+        self._bits = bits
+        self._mod = 2**bits
+        self._half = self._mod >> 1
+        self._base = 0
+        self._starts = []
+        self._ends = []
+
+    def _offset(self, sn):
+        if isinstance(sn, SerialNumber):
+            sn = sn.to_int()
+        offset = (sn - self._base) % self._mod
+        if offset >= self._half:
+            offset -= self._mod
+        return offset
+
+    def _to_sn(self, offset):
+        return SerialNumber(self._bits, (self._base + offset) % self._mod)
+
+    def _rebase(self):
+        # keep the offsets small so that they do not wrap around
+        shift = self._starts[0]
+        if -(self._half >> 1) < shift < (self._half >> 1):
+            return
+        self._base = (self._base + shift) % self._mod
+        self._starts[:] = [start - shift for start in self._starts]
+        self._ends[:] = [end - shift for end in self._ends]
+
+    def add(self, sn):
+        if not self._starts:
+            self._base = sn.to_int() if isinstance(sn, SerialNumber) else sn
+            self._starts.append(0)
+            self._ends.append(0)
+            return
+
+        starts, ends = self._starts, self._ends
+        offset = self._offset(sn)
+        i = bisect.bisect_right(starts, offset)
+        if i > 0 and ends[i-1] >= offset:
+            return
+
+        merge_prev = i > 0 and ends[i-1] + 1 == offset
+        merge_next = i < len(starts) and starts[i] == offset + 1
+        if merge_prev and merge_next:
+            ends[i-1] = ends[i]
+            del starts[i]
+            del ends[i]
+        elif merge_prev:
+            ends[i-1] = offset
+        elif merge_next:
+            starts[i] = offset
+        else:
+            starts.insert(i, offset)
+            ends.insert(i, offset)
 
-        self._ranges.append((sn, sn))
+        if i == 0:
+            self._rebase()
 
     def discard_if_first(self, sn):
-        if not self._ranges:
+        if not self._starts:
             return
-        start, end = self._ranges[0]
-        if start == sn:
-            if start == end:
-                del self._ranges[0]
+        if self._starts[0] == self._offset(sn):
+            if self._starts[0] == self._ends[0]:
+                del self._starts[0]
+                del self._ends[0]
             else:
-                self._ranges[0] = start + 1, end
+                self._starts[0] += 1
 
     def discard_up_to(self, sn):
-        while self._ranges and self._ranges[0][0] <= sn:
-            start, end = self._ranges[0]
-            if end <= sn:
-                del self._ranges[0]
-                continue
-            self._ranges[0] = sn + 1, end
+        """
+        Remove all serial numbers up to and including `sn`.
+
+        :return: The number of removed serial numbers.
+        """
+        if not self._starts:
+            return 0
+
+        offset = self._offset(sn)
+        i = bisect.bisect_right(self._ends, offset)
+        ndiscarded = 0
+        if i:
+            ndiscarded = sum(self._ends[:i]) - sum(self._starts[:i]) + i
+            del self._starts[:i]
+            del self._ends[:i]
+        if self._starts:
+            if self._starts[0] <= offset:
+                ndiscarded += offset + 1 - self._starts[0]
+                self._starts[0] = offset + 1
+            self._rebase()
+        return ndiscarded
 
     @property
     def nranges(self):
-        return len(self._ranges)
+        return len(self._starts)
 
     def iter_ranges(self):
-        return iter(self._ranges)
+        for start, end in zip(self._starts, self._ends):
+            yield self._to_sn(start), self._to_sn(end)
+
+    def iter_raw_ranges(self):
+        """
+        Iterate over the ranges as pairs of integers.
+        """
+        base, mod = self._base, self._mod
+        for start, end in zip(self._starts, self._ends):
+            yield (base + start) % mod, (base + end) % mod
 
     def clear(self):
-        self._ranges.clear()
+        self._starts.clear()
+        self._ends.clear()
 
     def __repr__(self):
         return "<{}.{} {!r}>".format(
             type(self).__module__,
             type(self).__name__,
-            list(self._ranges),
+            list(self.iter_ranges()),
         )
 
     def __contains__(self, item):
-        for start, end in self._ranges:
-            if item >= start and item <= end:
-                return True
-        return False
+        if not self._starts:
+            return False
+        offset = self._offset(item)
+        i = bisect.bisect_right(self._starts, offset)
+        return i > 0 and self._ends[i-1] >= offset
 
     @property
     def first_start(self):
-        if not self._ranges:
+        if not self._starts:
             return None
-        return self._ranges[0][0]
+        return self._to_sn(self._starts[0])
 
     @property
     def first_end(self):
-        if not self._ranges:
+        if not self._starts:
             return None
-        return self._ranges[0][1]
+        return self._to_sn(self._ends[0])
+
+    @property
+    def first_raw_range(self):
+        """
+        The first range as pair of integers or :data:`None` if the set is
+        empty.
+        """
+        if not self._starts:
+            return None
+        return (
+            (self._base + self._starts[0]) % self._mod,
+            (self._base + self._ends[0]) % self._mod,
+        )
+
+
+class _TxEntry:
+    __slots__ = ("first_sent", "last_sent", "retransmits", "frame")
+
+    def __init__(self, timestamp, frame):
+        super().__init__()
+        self.first_sent = timestamp
+        self.last_sent = timestamp
+        self.retransmits = 0
+        self.frame = frame
+
+    def __repr__(self):
+        return "<{} retransmits={} frame={!r}>".format(
+            type(self).__name__,
+            self.retransmits,
+            self.frame,
+        )
 
 
 class Protocol(asyncio.DatagramProtocol):
     """
     Sensor Node UDP Reliability Layer protocol implementation.
 
-    .. signal:: on_data_received(payload: bytes)
+    .. signal:: on_data_received(payload: memoryview)
 
         Fires when a datagram was received.
 
+        The payload is a view into the received datagram; handlers which
+        keep the payload beyond the callback must copy it with
+        :class:`bytes`.
+
         Events are fired in the order the datagrams were send by the sender,
         not necessarily in reception order. This also means that events may
         be delayed and are thus not a good source of timestamps for received
@@ -382,6 +502,45 @@ class Protocol(asyncio.DatagramProtocol):
         This always happens when the other side has lots its entire state.
 
     This is a :class:`asyncio.DatagramProtocol`.
+
+    :param retransmit_threshold: Initial retransmission timeout, used until
+        the first round-trip time has been measured.
+    :param min_retransmit_threshold: Lower bound for the retransmission
+        timeout.
+    :param max_retransmit_threshold: Upper bound for the retransmission
+        timeout, including the backoff of repeated retransmissions.
+    :param tx_max_buffer_size: Maximum number of unacknowledged frames
+        (transmit window). Can be changed at runtime via the attribute of
+        the same name.
+    :param max_retransmits: Number of retransmissions of a frame after
+        which it is dropped from the transmit buffer (and counted in
+        :attr:`tx_dropped`) instead of being retransmitted again.
+    :param rx_loss_emulation: Probability with which received datagrams are
+        dropped, for testing.
+    :param rx_reorder_emulation: Probability with which a received datagram
+        is held back until after the next datagram (or for
+        :attr:`REORDER_HOLD_TIME`), for testing.
+    :param dest_host: Address to send to until the peer is known. By
+        default, datagrams are broadcast.
+
+    The round-trip time is estimated from the DACKs as specified in
+    :rfc:`6298`, using only frames which were not retransmitted. Frames are
+    retransmitted when their retransmission timeout expires, with the
+    timeout doubling for each retransmission of the same frame. Expired
+    frames are piggybacked onto new frames; if no new frames are sent, a
+    timer retransmits them (only while an event loop is running). The timer
+    stops once all frames have been acknowledged or dropped after
+    `max_retransmits` retransmissions, so that a vanished peer does not
+    cause retransmissions forever.
+
+    The counters :attr:`tx_sent`, :attr:`tx_acked`,
+    :attr:`tx_retransmit_count` and :attr:`tx_dropped` together with
+    :attr:`tx_retransmit_ratio` and :attr:`tx_goodput_ratio` describe the
+    efficiency of the link.
+
+    Internally, serial numbers are handled as plain integers with inlined
+    :rfc:`1982` comparisons, as the per-datagram overhead of
+    :class:`SerialNumber` objects is significant on small devices.
     """
 
     SERIAL_BITS = 16
@@ -390,47 +549,81 @@ class Protocol(asyncio.DatagramProtocol):
     on_data_received = aioxmpp.callbacks.Signal()
     on_resync = aioxmpp.callbacks.Signal()
 
+    #: Granularity of the clock used for the retransmission timeout.
+    CLOCK_GRANULARITY = 0.001
+
+    #: Maximum exponent of the backoff of repeated retransmissions.
+    MAX_BACKOFF = 6
+
+    #: Maximum time for which the reorder emulation holds back a datagram.
+    REORDER_HOLD_TIME = 0.05
+
     def __init__(self, dest_port, *,
                  retransmit_threshold=timedelta(seconds=0.05),
+                 min_retransmit_threshold=timedelta(seconds=0.01),
+                 max_retransmit_threshold=timedelta(seconds=2),
                  tx_max_buffer_size=16,
+                 max_retransmits=10,
                  rx_loss_emulation=False,
+                 rx_reorder_emulation=False,
                  autohandshake=True,
+                 dest_host="255.255.255.255",
                  logger=None):
         super().__init__()
+        self._rto_min = min_retransmit_threshold.total_seconds()
+        self._rto_max = max_retransmit_threshold.total_seconds()
         self.retransmit_threshold = retransmit_threshold
+        self._srtt = None
+        self._rttvar = None
+        self._clock = time.monotonic
+        self._loop = None
+        self._retransmit_handle = None
         self.logger = logger or logging.getLogger(__name__)
 
         self.app_request_handler = None
 
         self._connection_id = 0
 
-        self._tx_buffer = []
-        self._tx_max_buffer_size = tx_max_buffer_size
+        self._sn_mod = 2**self.SERIAL_BITS
+        self._sn_half = self._sn_mod >> 1
+
+        # maps the serial numbers of the unacknowledged frames, in
+        # transmission order, to _TxEntry objects
+        self._tx_buffer = collections.OrderedDict()
         self._rx_loss_emulation = rx_loss_emulation
+        self._rx_reorder_emulation = rx_reorder_emulation
+        self._rx_reorder_held = None
         self._transport = None
-        self._tx_sn = SerialNumberProvider(self.SERIAL_BITS)
-        self._tx_dest_addr = ("255.255.255.255", dest_port)
+        self._tx_next_sn = 0
+        self._tx_dest_addr = (dest_host, dest_port)
         self._tx_broadcast_addr = self._tx_dest_addr
         self._tx_last_acked_sn = None
-        self._tx_broadcast_threshold = self._tx_max_buffer_size // 2
+        self.tx_max_buffer_size = tx_max_buffer_size
+        self.max_retransmits = max_retransmits
 
         self.tx_retransmit_count = 0
         self.tx_sent = 0
+        self.tx_acked = 0
         self.tx_dropped = 0
         self.rx_given_up_count = 0
+        self.tx_datagrams = 0
+        self.rx_datagrams = 0
 
         self.tx_app_request_retransmit_interval = timedelta(seconds=1)
 
-        self._rx_max_consecutive_sn = SerialNumber(
-            self.SERIAL_BITS,
-            2**self.SERIAL_BITS - 1
-        )
-        self._rx_out_of_order = SerialNumberRangeSet()
+        self._rx_max_consecutive_sn = self._sn_mod - 1
+        self._rx_out_of_order = SerialNumberRangeSet(self.SERIAL_BITS)
         self._rx_last_sn = self._rx_max_consecutive_sn
         self._rx_app_requests = {}
         self._autohandshake = autohandshake
 
+        # heap of (offset, sn, payload) of frames waiting for their
+        # predecessors; offset is the signed distance of sn from
+        # _rx_buffer_base
         self._rx_buffer = []
+        self._rx_buffer_base = 0
+        self._rx_in_burst = False
+        self._rx_ack_pending = False
 
         self.synchronized = asyncio.Event()
         self.synchronized.clear()
@@ -439,86 +632,241 @@ class Protocol(asyncio.DatagramProtocol):
     def tx_buffer_size(self):
         return len(self._tx_buffer)
 
+    @property
+    def tx_max_buffer_size(self):
+        """
+        Maximum number of unacknowledged frames.
+
+        When the buffer is full, the oldest frame is dropped to make room for
+        a new one. Reducing the size drops the oldest frames immediately.
+        """
+        return self._tx_max_buffer_size
+
+    @tx_max_buffer_size.setter
+    def tx_max_buffer_size(self, value):
+        if value < 1:
+            raise ValueError("tx_max_buffer_size must be positive")
+        self._tx_max_buffer_size = value
+        self._tx_broadcast_threshold = value // 2
+        while len(self._tx_buffer) > value:
+            self._tx_buffer.popitem(last=False)
+            self.tx_dropped += 1
+
+    @property
+    def retransmit_threshold(self):
+        """
+        The current retransmission timeout as :class:`datetime.timedelta`.
+        """
+        return timedelta(seconds=self._rto)
+
+    @retransmit_threshold.setter
+    def retransmit_threshold(self, value):
+        self._rto = min(max(value.total_seconds(), self._rto_min),
+                        self._rto_max)
+
+    @property
+    def srtt(self):
+        """
+        The smoothed round-trip time as :class:`datetime.timedelta` or
+        :data:`None` if it has not been measured yet.
+        """
+        if self._srtt is None:
+            return None
+        return timedelta(seconds=self._srtt)
+
+    @property
+    def rttvar(self):
+        """
+        The round-trip time variation as :class:`datetime.timedelta` or
+        :data:`None` if it has not been measured yet.
+        """
+        if self._rttvar is None:
+            return None
+        return timedelta(seconds=self._rttvar)
+
+    @property
+    def tx_retransmit_ratio(self):
+        """
+        Number of retransmissions per sent frame.
+        """
+        if not self.tx_sent:
+            return 0.0
+        return self.tx_retransmit_count / self.tx_sent
+
+    @property
+    def tx_goodput_ratio(self):
+        """
+        Fraction of frame transmissions, including retransmissions, which
+        carried a frame which was eventually acknowledged.
+        """
+        ntransmissions = self.tx_sent + self.tx_retransmit_count
+        if not ntransmissions:
+            return 0.0
+        return self.tx_acked / ntransmissions
+
+    def _update_rtt(self, sample):
+        # RFC 6298, section 2
+        if self._srtt is None:
+            self._srtt = sample
+            self._rttvar = sample / 2
+        else:
+            self._rttvar = (0.75 * self._rttvar +
+                            0.25 * abs(self._srtt - sample))
+            self._srtt = 0.875 * self._srtt + 0.125 * sample
+        self._rto = min(
+            max(
+                self._srtt + max(self.CLOCK_GRANULARITY, 4 * self._rttvar),
+                self._rto_min,
+            ),
+            self._rto_max,
+        )
+
+    def _entry_timeout(self, entry):
+        return min(self._rto * (1 << min(entry.retransmits, self.MAX_BACKOFF)),
+                   self._rto_max)
+
     def connection_made(self, transport):
         self.logger.debug("using transport %r", transport)
         self._transport = transport
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no timer based retransmissions, e.g. when driven manually
+            self._loop = None
         sock = self._transport.get_extra_info("socket")
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
     def connection_lost(self, exc):
         self._transport = None
+        self._loop = None
+        if self._retransmit_handle is not None:
+            self._retransmit_handle.cancel()
+            self._retransmit_handle = None
         self.logger.debug("lost transport: %r", exc)
 
     def _mark_received_locally(self, sn):
-        if sn <= self._rx_max_consecutive_sn:
+        mod = self._sn_mod
+        max_consecutive = self._rx_max_consecutive_sn
+        if (max_consecutive - sn) % mod < self._sn_half:
             self.logger.debug("old packet received (%s)", sn)
             return False
 
-        if (self._rx_max_consecutive_sn + 1) == sn:
-            self._rx_max_consecutive_sn += 1
-            self._rx_out_of_order.discard_up_to(sn)
+        out_of_order = self._rx_out_of_order
+        if (max_consecutive + 1) % mod == sn:
+            max_consecutive = sn
+            out_of_order.discard_up_to(sn)
         else:
-            if sn in self._rx_out_of_order:
+            if sn in out_of_order:
                 return False
-            self._rx_out_of_order.add(sn)
+            out_of_order.add(sn)
 
-        if self._rx_out_of_order.first_start == self._rx_max_consecutive_sn + 1:
-            self._rx_max_consecutive_sn = self._rx_out_of_order.first_end
-            self._rx_out_of_order.discard_up_to(self._rx_max_consecutive_sn)
+        first_range = out_of_order.first_raw_range
+        if (first_range is not None and
+                first_range[0] == (max_consecutive + 1) % mod):
+            max_consecutive = first_range[1]
+            out_of_order.discard_up_to(max_consecutive)
+
+        self._rx_max_consecutive_sn = max_consecutive
 
         self.logger.debug(
             "marked %s as received. rx map: max=%s, out_of_order=%r",
             sn,
-            self._rx_max_consecutive_sn,
-            self._rx_out_of_order
+            max_consecutive,
+            out_of_order,
         )
         return True
 
     def _mark_received_remotely_single(self, sn):
-        for i, (_, buffered_sn, _) in enumerate(self._tx_buffer):
-            if buffered_sn == sn:
-                self.logger.debug(
-                    "dropping %s from buffer as it was received by peer",
-                    buffered_sn,
-                )
-                del self._tx_buffer[i]
-                return
+        if self._tx_buffer.pop(sn, None) is not None:
+            self.tx_acked += 1
+            self.logger.debug(
+                "dropping %s from buffer as it was received by peer",
+                sn,
+            )
 
     def _mark_received_remotely_up_to(self, sn):
         self.logger.debug("dropping everything up to %s from buffer",
                           sn)
 
-        last_less_than = None
-        for i, (_, buffered_sn, _) in enumerate(self._tx_buffer):
-            if buffered_sn <= sn:
-                last_less_than = i
-                continue
-            break
-
-        if last_less_than is None:
-            return
+        buffer_ = self._tx_buffer
+        mod, half = self._sn_mod, self._sn_half
+        ndropped = 0
+        while buffer_ and (sn - next(iter(buffer_))) % mod < half:
+            buffer_.popitem(last=False)
+            ndropped += 1
 
-        self.logger.debug(
-            "dropping %r from buffer as they were received by peer",
-            [sn for _, sn, _ in self._tx_buffer[:i+1]]
-        )
-        del self._tx_buffer[:i+1]
+        self.tx_acked += ndropped
+        if ndropped:
+            self.logger.debug(
+                "dropped %d frame(s) from buffer as they were received by "
+                "peer",
+                ndropped,
+            )
 
     def _require_connection(self):
         if not self._transport:
             raise ConnectionError("not connected")
 
     def _flush_rx_buffer(self):
-        for _, payload in self._rx_buffer:
+        while self._rx_buffer:
+            _, _, payload = heapq.heappop(self._rx_buffer)
             self.on_data_received(payload)
-        self._rx_buffer.clear()
+
+    def datagrams_received(self, datagrams):
+        """
+        Process a burst of datagrams.
+
+        :param datagrams: The received datagrams as ``(data, addr)`` pairs.
+
+        This is equivalent to calling :meth:`datagram_received` for each
+        datagram, except that at most one DACK is sent for the whole burst.
+        It is called by :class:`BatchedDatagramTransport`.
+        """
+        self._rx_in_burst = True
+        try:
+            for data, addr in datagrams:
+                self.datagram_received(data, addr)
+        finally:
+            self._rx_in_burst = False
+            if self._rx_ack_pending:
+                self._rx_ack_pending = False
+                self._emit_ack()
 
     def datagram_received(self, data, addr):
+        self.rx_datagrams += 1
+
         if (self._rx_loss_emulation and
                 random.random() < self._rx_loss_emulation):
             self.logger.debug("dropping datagram for packet loss emulation")
             return
 
+        if self._rx_reorder_emulation:
+            held = self._rx_reorder_held
+            if held is not None:
+                self._rx_reorder_held = None
+                self._process_datagram(data, addr)
+                self._process_datagram(*held)
+                return
+
+            if random.random() < self._rx_reorder_emulation:
+                self.logger.debug("holding back datagram for reorder "
+                                  "emulation")
+                self._rx_reorder_held = data, addr
+                if self._loop is not None:
+                    self._loop.call_later(self.REORDER_HOLD_TIME,
+                                          self._release_held_datagram,
+                                          self._rx_reorder_held)
+                return
+
+        self._process_datagram(data, addr)
+
+    def _release_held_datagram(self, held):
+        if self._rx_reorder_held is not held or self._transport is None:
+            return
+        self._rx_reorder_held = None
+        self._process_datagram(*held)
+
+    def _process_datagram(self, data, addr):
         if len(data) < common_header_fmt.size:
             self.logger.warning(
                 "dropping short datagram (len %d < header size %d)",
@@ -527,9 +875,11 @@ class Protocol(asyncio.DatagramProtocol):
             )
             return
 
-        data, common_hdr = unpack_and_splice(data, common_header_fmt)
+        # all payloads are handed out as views into the datagram
+        data = memoryview(data)
         version, packet_type, connection_id, min_avail_sn, max_recvd_sn, \
-            last_recvd_sn = common_hdr
+            last_recvd_sn = common_header_fmt.unpack_from(data)
+        data = data[common_header_fmt.size:]
 
         if version != 0x00:
             self.logger.warning(
@@ -547,10 +897,6 @@ class Protocol(asyncio.DatagramProtocol):
             )
             return
 
-        min_avail_sn = SerialNumber(self.SERIAL_BITS, min_avail_sn)
-        max_recvd_sn = SerialNumber(self.SERIAL_BITS, max_recvd_sn)
-        last_recvd_sn = SerialNumber(self.SERIAL_BITS, last_recvd_sn)
-
         self.logger.debug(
             "datagram: packet_type = %s, connection_id = 0x%08x, "
             "min_avail_sn = %s, max_recvd_sn = %s, last_recvd_sn = %s",
@@ -561,6 +907,12 @@ class Protocol(asyncio.DatagramProtocol):
         valid_connection = (connection_id and
                             connection_id == self._connection_id)
         if valid_connection:
+            # the peer acknowledges the first frame of the last DATA packet
+            # it received as last_recvd_sn; following Karn's algorithm, only
+            # frames which were sent once give a valid RTT sample
+            entry = self._tx_buffer.get(last_recvd_sn)
+            if entry is not None and not entry.retransmits:
+                self._update_rtt(self._clock() - entry.first_sent)
             self._mark_received_remotely_up_to(max_recvd_sn)
             self._mark_received_remotely_single(last_recvd_sn)
             self._tx_last_acked_sn = last_recvd_sn
@@ -588,8 +940,8 @@ class Protocol(asyncio.DatagramProtocol):
             self._connection_id = connection_id
             self._flush_rx_buffer()
             self._rx_out_of_order.clear()
-            self._rx_max_consecutive_sn = min_avail_sn - 1
-            self._tx_last_acked_sn = self._tx_sn.current
+            self._rx_max_consecutive_sn = (min_avail_sn - 1) % self._sn_mod
+            self._tx_last_acked_sn = self._tx_next_sn
             self._tx_dest_addr = addr
             self.synchronized.set()
             self.on_resync()
@@ -615,11 +967,28 @@ class Protocol(asyncio.DatagramProtocol):
                 )
 
         if valid_connection:
-            # discard state for everything up to min_avail_sn
-            self._rx_out_of_order.discard_up_to(min_avail_sn)
-            if self._rx_max_consecutive_sn < min_avail_sn:
-                self.logger.debug("giving up on receiving frames")
-                self._rx_max_consecutive_sn = min_avail_sn
+            # discard state for everything before min_avail_sn; the peer
+            # does not have these frames anymore, but it still has
+            # min_avail_sn itself
+            mod = self._sn_mod
+            last_unavail_sn = (min_avail_sn - 1) % mod
+            ndiscarded = self._rx_out_of_order.discard_up_to(last_unavail_sn)
+            ngap = (last_unavail_sn - self._rx_max_consecutive_sn) % mod
+            if 0 < ngap < self._sn_half:
+                # the discarded frames were received out of order and are
+                # still delivered
+                self.logger.debug("giving up on receiving %d frame(s)",
+                                  ngap - ndiscarded)
+                self.rx_given_up_count += ngap - ndiscarded
+                self._rx_max_consecutive_sn = last_unavail_sn
+            # frames right after the new maximum may already have been
+            # received out of order; without absorbing them here, they would
+            # be accepted (and buffered) a second time
+            first_range = self._rx_out_of_order.first_raw_range
+            if (first_range is not None and
+                    first_range[0] == (self._rx_max_consecutive_sn + 1) % mod):
+                self._rx_max_consecutive_sn = first_range[1]
+                self._rx_out_of_order.discard_up_to(first_range[1])
 
     def _handle_data_entry(self, sn, payload):
         self.logger.debug(
@@ -630,16 +999,25 @@ class Protocol(asyncio.DatagramProtocol):
             self.logger.debug("duplicate frame, discarding")
             return
 
-        for i, (recvd_sn, _) in enumerate(self._rx_buffer):
-            if recvd_sn == sn:
-                # already in buffer
-                break
-            if recvd_sn > sn:
-                # insert before
-                self._rx_buffer.insert(i, (sn, payload))
-                break
-        else:
-            self._rx_buffer.append((sn, payload))
+        # _mark_received_locally rejects duplicates, so sn cannot be in the
+        # buffer yet
+        mod, half = self._sn_mod, self._sn_half
+        buffer_ = self._rx_buffer
+        if not buffer_:
+            self._rx_buffer_base = self._rx_max_consecutive_sn
+        offset = (sn - self._rx_buffer_base + half) % mod - half
+        if not -(half >> 1) < offset < (half >> 1):
+            # keep the offsets far away from wrapping around
+            base = self._rx_max_consecutive_sn
+            self._rx_buffer_base = base
+            buffer_[:] = [
+                ((buffered_sn - base + half) % mod - half, buffered_sn,
+                 buffered_payload)
+                for _, buffered_sn, buffered_payload in buffer_
+            ]
+            heapq.heapify(buffer_)
+            offset = (sn - base + half) % mod - half
+        heapq.heappush(buffer_, (offset, sn, payload))
 
     def _handle_data(self, remainder, valid_connection, **kwargs):
         if not valid_connection:
@@ -647,54 +1025,51 @@ class Protocol(asyncio.DatagramProtocol):
             return
 
         first_sn = None
-        while remainder:
-            remainder, (sn, length) = unpack_and_splice(
-                remainder,
-                data_entry_header_fmt
-            )
-            sn = SerialNumber(self.SERIAL_BITS, sn)
+        offset = 0
+        end = len(remainder)
+        while offset < end:
+            sn, length = data_entry_header_fmt.unpack_from(remainder, offset)
+            offset += data_entry_header_fmt.size
             if first_sn is None:
                 first_sn = sn
 
-            payload = remainder[:length]
-            remainder = remainder[length:]
-            self._handle_data_entry(sn, payload)
+            self._handle_data_entry(sn, remainder[offset:offset+length])
+            offset += length
 
-        delete_up_to = 0
-        for i, (recvd_sn, payload) in enumerate(self._rx_buffer):
-            delete_up_to = i
-            if recvd_sn > self._rx_max_consecutive_sn:
-                break
+        buffer_ = self._rx_buffer
+        max_consecutive = self._rx_max_consecutive_sn
+        mod, half = self._sn_mod, self._sn_half
+        while buffer_ and (max_consecutive - buffer_[0][1]) % mod < half:
+            _, _, payload = heapq.heappop(buffer_)
             self.logger.debug("emitting event for %r", payload)
             self.on_data_received(payload)
-        else:
-            delete_up_to = len(self._rx_buffer)
-        self.logger.debug("rx max = %s, delete_up_to = %d, rx buffer = %r",
+        self.logger.debug("rx max = %s, %d frame(s) buffered",
                           self._rx_max_consecutive_sn,
-                          delete_up_to,
-                          self._rx_buffer)
-        del self._rx_buffer[:delete_up_to]
+                          len(self._rx_buffer))
 
         self._rx_last_sn = first_sn
-        self._emit_ack()
+        if self._rx_in_burst:
+            self._rx_ack_pending = True
+        else:
+            self._emit_ack()
 
     def _handle_dack(self, remainder, valid_connection, **kwargs):
         if not valid_connection:
             self.logger.debug("ignoring DACK from unknown connection")
             return
 
-        while remainder:
-            remainder, (first, last) = unpack_and_splice(
-                remainder,
-                dack_entry_fmt,
-            )
-            while first <= last:
-                self._mark_received_remotely_single(first)
-                first += 1
+        for first, last in dack_entry_fmt.iter_unpack(remainder):
+            nsns = (last - first) % self._sn_mod
+            if nsns >= self._sn_half:
+                continue
+            for i in range(nsns + 1):
+                self._mark_received_remotely_single(
+                    (first + i) % self._sn_mod
+                )
 
     def _handle_app_req(self, remainder, addr, **kwargs):
         remainder, (request_id, type_) = unpack_and_splice(
-            remainder,
+            bytes(remainder),
             app_req_header_fmt,
         )
         self.logger.debug("app request 0x%08x: request received (type=%r)",
@@ -730,7 +1105,7 @@ class Protocol(asyncio.DatagramProtocol):
 
     def _handle_app_resp(self, remainder, **kwargs):
         remainder, (request_id, ) = unpack_and_splice(
-            remainder,
+            bytes(remainder),
             app_resp_header_fmt,
         )
 
@@ -748,22 +1123,23 @@ class Protocol(asyncio.DatagramProtocol):
 
     def _compose_common_header(self, packet_type):
         if self._tx_buffer:
-            min_avail_sn = self._tx_buffer[0][1]
+            min_avail_sn = next(iter(self._tx_buffer))
         else:
-            min_avail_sn = self._tx_sn.current
+            min_avail_sn = self._tx_next_sn
 
         return common_header_fmt.pack(
             0x00,
             packet_type.value,
             self._connection_id,
-            min_avail_sn.to_int(),
-            self._rx_max_consecutive_sn.to_int(),
-            self._rx_last_sn.to_int(),
+            min_avail_sn,
+            self._rx_max_consecutive_sn,
+            self._rx_last_sn,
         )
 
     def _tx(self, packet, dest):
         self.logger.debug("sending packet to %s: %r",
                           dest, packet)
+        self.tx_datagrams += 1
         self._transport.sendto(packet, dest)
 
     def _emit_ack(self):
@@ -771,31 +1147,90 @@ class Protocol(asyncio.DatagramProtocol):
 
         parts = [common_hdr]
         for i, (start, end) in zip(range(256),
-                                   self._rx_out_of_order.iter_ranges()):
-            parts.append(dack_entry_fmt.pack(start.to_int(), end.to_int()))
+                                   self._rx_out_of_order.iter_raw_ranges()):
+            parts.append(dack_entry_fmt.pack(start, end))
 
         self.logger.debug("sending ack for %d ranges", len(parts)-1)
         self._tx(b"".join(parts), self._tx_dest_addr)
 
+    def _piggyback_expired(self, parts, total_length, now, stop_sn=None):
+        # append the frames whose retransmission timeout expired and drop
+        # those which have been retransmitted too often
+        nframes = 0
+        expired = []
+        for sn, entry in self._tx_buffer.items():
+            if total_length >= self.MAX_PACKET_SIZE or sn == stop_sn:
+                break
+            if now - entry.last_sent < self._entry_timeout(entry):
+                continue
+            if entry.retransmits >= self.max_retransmits:
+                expired.append(sn)
+                continue
+            parts.append(entry.frame)
+            total_length += len(entry.frame)
+            entry.last_sent = now
+            entry.retransmits += 1
+            nframes += 1
+        self.tx_retransmit_count += nframes
+
+        if expired:
+            self.logger.debug(
+                "dropping %d frame(s) after %d retransmissions",
+                len(expired),
+                self.max_retransmits,
+            )
+            for sn in expired:
+                del self._tx_buffer[sn]
+            self.tx_dropped += len(expired)
+        return nframes
+
+    def _arm_retransmit_timer(self):
+        if self._retransmit_handle is not None:
+            self._retransmit_handle.cancel()
+            self._retransmit_handle = None
+
+        if self._loop is None or not self._tx_buffer:
+            return
+
+        now = self._clock()
+        delay = min(
+            entry.last_sent + self._entry_timeout(entry) - now
+            for entry in self._tx_buffer.values()
+        )
+        self._retransmit_handle = self._loop.call_later(
+            max(delay, 0),
+            self._retransmit_timeout,
+        )
+
+    def _retransmit_timeout(self):
+        self._retransmit_handle = None
+        if self._transport is None or not self._tx_buffer:
+            return
+
+        parts = [self._compose_common_header(PacketType.DATA)]
+        nframes = self._piggyback_expired(parts, len(parts[0]),
+                                          self._clock())
+        if nframes:
+            self.logger.debug("retransmitting %d frame(s) after timeout",
+                              nframes)
+            dest = (self._tx_broadcast_addr if self._connection_id == 0
+                    else self._tx_dest_addr)
+            self._tx(b"".join(parts), dest)
+
+        self._arm_retransmit_timer()
+
     def _trigger_tx(self, use_broadcast):
         if not self._tx_buffer:
             return
 
         common_hdr = self._compose_common_header(PacketType.DATA)
-        _, main_sn, main_frame = self._tx_buffer[-1]
-        parts = [common_hdr, main_frame]
+        main_sn = next(reversed(self._tx_buffer))
+        main_entry = self._tx_buffer[main_sn]
+        parts = [common_hdr, main_entry.frame]
         total_length = sum(map(len, parts))
 
-        i = 0
-        now = time.monotonic()
-        while total_length < self.MAX_PACKET_SIZE:
-            pb_ts, pb_sn, pb_frame = self._tx_buffer[i]
-            if pb_sn == main_sn:
-                break
-            parts.append(pb_frame)
-            total_length += len(pb_frame)
-            self.tx_retransmit_count += 1
-            i += 1
+        self._piggyback_expired(parts, total_length, main_entry.first_sent,
+                                stop_sn=main_sn)
 
         self.logger.debug(
             "transmitting frame for sn %s with %d piggybacked frame(s)",
@@ -805,34 +1240,37 @@ class Protocol(asyncio.DatagramProtocol):
 
         dest = self._tx_broadcast_addr if use_broadcast else self._tx_dest_addr
         self._tx(b"".join(parts), dest)
+        self._arm_retransmit_timer()
 
     def send_frame(self, buf):
         self._require_connection()
 
-        with self._tx_sn as sn:
-            data_entry_hdr = data_entry_header_fmt.pack(
-                sn.to_int(),
-                len(buf),
-            )
+        sn = self._tx_next_sn
+        data_entry_hdr = data_entry_header_fmt.pack(
+            sn,
+            len(buf),
+        )
 
-            frame = b"".join([data_entry_hdr, buf])
-            ts = time.monotonic()
-            if len(self._tx_buffer) == self._tx_max_buffer_size:
-                self.logger.debug(
-                    "dropping frame from tx buffer due to space limitations"
-                )
-                self.tx_dropped += 1
-                del self._tx_buffer[0]
-            self._tx_buffer.append((ts, sn, frame))
-
-            use_broadcast = (
-                self._connection_id == 0 or
-                self._tx_last_acked_sn is None or
-                sn - self._tx_last_acked_sn > self._tx_broadcast_threshold
+        frame = b"".join([data_entry_hdr, buf])
+        ts = self._clock()
+        if len(self._tx_buffer) >= self._tx_max_buffer_size:
+            self.logger.debug(
+                "dropping frame from tx buffer due to space limitations"
             )
+            self.tx_dropped += 1
+            self._tx_buffer.popitem(last=False)
+        self._tx_buffer[sn] = _TxEntry(ts, frame)
+
+        use_broadcast = (
+            self._connection_id == 0 or
+            self._tx_last_acked_sn is None or
+            ((sn - self._tx_last_acked_sn + self._sn_half) % self._sn_mod -
+             self._sn_half) > self._tx_broadcast_threshold
+        )
 
-            self._trigger_tx(use_broadcast)
-            self.tx_sent += 1
+        self._trigger_tx(use_broadcast)
+        self._tx_next_sn = (sn + 1) % self._sn_mod
+        self.tx_sent += 1
 
     def error_received(self, exc):
         pass
@@ -902,10 +1340,427 @@ class Protocol(asyncio.DatagramProtocol):
         ))
 
 
+class _PeerTransport(asyncio.DatagramTransport):
+    # the view of the shared server transport for a single peer protocol
+    def __init__(self, server, addr):
+        super().__init__()
+        self._server = server
+        self._addr = addr
+        self._closing = False
+
+    def get_extra_info(self, name, default=None):
+        return self._server._transport.get_extra_info(name, default)
+
+    def sendto(self, data, addr=None):
+        # a peer protocol only ever talks to its peer; this also replaces
+        # the broadcast address which it uses before the handshake
+        if self._closing or self._server._transport is None:
+            return
+        self._server._transport.sendto(data, self._addr)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        self._closing = True
+
+    def abort(self):
+        self.close()
+
+
+class Server(asyncio.DatagramProtocol):
+    """
+    SNURL endpoint serving many peers on one socket.
+
+    :param protocol_factory: Callable which returns a new :class:`Protocol`
+        for a peer; it is called with the address of the peer.
+    :param max_peers: Maximum number of peers. When a new peer arrives while
+        the limit is reached, the peer which was idle the longest is evicted.
+    :param idle_timeout: Peers from which nothing was received for this long
+        are evicted.
+    :param logger: Logger to use.
+
+    Datagrams are demultiplexed by ``(addr, connection_id)`` into one
+    :class:`Protocol` instance per peer, which keeps the complete
+    reliability state of that peer. A datagram with a connection ID which
+    is not known for its address (e.g. the zero connection ID of a node
+    which just rebooted) is passed to the protocol of that address, which
+    then resyncs; datagrams from other peers are not affected.
+
+    Memory use is bounded by `max_peers` times the buffer sizes of the peer
+    protocols.
+
+    .. signal:: on_peer_added(addr, protocol)
+
+        Fires when a protocol was created for a new peer, before the first
+        datagram is passed to it.
+
+    .. signal:: on_peer_removed(addr, protocol)
+
+        Fires when a peer was evicted.
+
+    .. signal:: on_data_received(addr, payload: memoryview)
+
+        Fires for each payload delivered by any peer protocol, see
+        :meth:`Protocol.on_data_received`.
+
+    This is a :class:`asyncio.DatagramProtocol`, which also supports
+    :class:`BatchedDatagramTransport`.
+    """
+
+    on_peer_added = aioxmpp.callbacks.Signal()
+    on_peer_removed = aioxmpp.callbacks.Signal()
+    on_data_received = aioxmpp.callbacks.Signal()
+
+    def __init__(self, protocol_factory=None, *,
+                 max_peers=256,
+                 idle_timeout=timedelta(minutes=10),
+                 logger=None):
+        super().__init__()
+        self.logger = logger or logging.getLogger(__name__)
+        self._protocol_factory = protocol_factory or self._default_factory
+        self.max_peers = max_peers
+        self.idle_timeout = idle_timeout
+        self._transport = None
+        self._loop = None
+        self._evict_handle = None
+        self._clock = time.monotonic
+        # addr -> [connection_id, protocol, last_activity], least recently
+        # active first
+        self._peers = collections.OrderedDict()
+
+    def _default_factory(self, addr):
+        return Protocol(
+            addr[1],
+            logger=self.logger.getChild("{}:{}".format(*addr[:2])),
+        )
+
+    @property
+    def npeers(self):
+        return len(self._peers)
+
+    def iter_peers(self):
+        """
+        Iterate over ``(addr, connection_id, protocol)`` of all peers.
+        """
+        for addr, (connection_id, protocol, _) in self._peers.items():
+            yield addr, connection_id, protocol
+
+    def get_peer(self, addr, connection_id=None):
+        """
+        Return the protocol of a peer.
+
+        :param addr: The address of the peer.
+        :param connection_id: If given, the connection ID must match, too.
+        :raises KeyError: if there is no such peer.
+        """
+        current_id, protocol, _ = self._peers[addr]
+        if connection_id is not None and connection_id != current_id:
+            raise KeyError((addr, connection_id))
+        return protocol
+
+    def connection_made(self, transport):
+        self._transport = transport
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+        self._schedule_eviction()
+
+    def connection_lost(self, exc):
+        if self._evict_handle is not None:
+            self._evict_handle.cancel()
+            self._evict_handle = None
+        for addr in list(self._peers):
+            self._remove_peer(addr, exc)
+        self._transport = None
+        self._loop = None
+
+    def error_received(self, exc):
+        self.logger.debug("error on socket: %r", exc)
+
+    def _schedule_eviction(self):
+        if self._loop is None:
+            return
+        self._evict_handle = self._loop.call_later(
+            max(self.idle_timeout.total_seconds() / 2, 1),
+            self._evict_timer,
+        )
+
+    def _evict_timer(self):
+        self.evict_idle()
+        self._schedule_eviction()
+
+    def evict_idle(self):
+        """
+        Evict all peers which have been idle for longer than
+        :attr:`idle_timeout`.
+
+        This is called periodically while an event loop is running.
+        """
+        deadline = self._clock() - self.idle_timeout.total_seconds()
+        while self._peers:
+            addr, (_, _, last_activity) = next(iter(self._peers.items()))
+            if last_activity >= deadline:
+                break
+            self.logger.info("evicting idle peer %s", addr)
+            self._remove_peer(addr, None)
+
+    def _remove_peer(self, addr, exc):
+        _, protocol, _ = self._peers.pop(addr)
+        protocol._transport.close()
+        protocol.connection_lost(exc)
+        self.on_peer_removed(addr, protocol)
+
+    def _add_peer(self, addr):
+        while len(self._peers) >= self.max_peers:
+            oldest = next(iter(self._peers))
+            self.logger.warning(
+                "peer limit (%d) reached, evicting least recently active "
+                "peer %s",
+                self.max_peers,
+                oldest,
+            )
+            self._remove_peer(oldest, None)
+
+        protocol = self._protocol_factory(addr)
+        protocol.connection_made(_PeerTransport(self, addr))
+        protocol.on_data_received.connect(
+            functools.partial(self.on_data_received, addr)
+        )
+        state = [None, protocol, self._clock()]
+        self._peers[addr] = state
+        self.logger.info("new peer %s", addr)
+        self.on_peer_added(addr, protocol)
+        return state
+
+    def _lookup(self, data, addr):
+        # returns the peer state for the datagram or None if it is to be
+        # dropped
+        if len(data) < common_header_fmt.size or data[0] != 0x00:
+            self.logger.debug("dropping invalid datagram from %s", addr)
+            return None
+
+        connection_id = int.from_bytes(data[2:6], "little")
+        try:
+            state = self._peers[addr]
+        except KeyError:
+            state = self._add_peer(addr)
+        else:
+            self._peers.move_to_end(addr)
+            if connection_id != state[0]:
+                self.logger.debug(
+                    "connection id of peer %s changes from %r to 0x%08x",
+                    addr, state[0], connection_id,
+                )
+        state[2] = self._clock()
+        return state
+
+    def _update_connection_id(self, state):
+        state[0] = state[1]._connection_id
+
+    def datagram_received(self, data, addr):
+        state = self._lookup(data, addr)
+        if state is None:
+            return
+        state[1].datagram_received(data, addr)
+        self._update_connection_id(state)
+
+    def datagrams_received(self, datagrams):
+        """
+        Process a burst of datagrams.
+
+        The datagrams are grouped by peer, keeping their order, and passed
+        to :meth:`Protocol.datagrams_received` of the respective protocols,
+        so that each peer gets at most one DACK per burst.
+        """
+        bursts = collections.OrderedDict()
+        for data, addr in datagrams:
+            state = self._lookup(data, addr)
+            if state is None:
+                continue
+            bursts.setdefault(addr, (state, []))[1].append((data, addr))
+
+        for state, burst in bursts.values():
+            state[1].datagrams_received(burst)
+            self._update_connection_id(state)
+
+
+class BatchedDatagramTransport(asyncio.DatagramTransport):
+    """
+    Datagram transport which receives datagrams in bursts.
+
+    :param loop: The event loop to use.
+    :param sock: The bound, non-blocking datagram socket.
+    :param protocol: The protocol to connect to the socket.
+    :param max_burst: Maximum number of datagrams to read per burst.
+    :param waiter: Optional future which is completed once the protocol has
+        been connected.
+
+    On each wakeup of the event loop, all datagrams pending on the socket (up
+    to `max_burst`) are read and passed to the protocol at once, using its
+    ``datagrams_received`` method if it has one and ``datagram_received``
+    otherwise. Datagrams which the protocol sends while it processes a burst
+    are sent after the burst.
+
+    This reduces the number of event loop wakeups when a peer sends many
+    datagrams at once, e.g. when a sensor node flushes its buffer after a
+    reconnect. The standard library does not expose ``recvmmsg`` and
+    ``sendmmsg``, so the datagrams of a burst are still read and sent with
+    one system call each.
+
+    Send errors, including a full send buffer, are reported via the
+    ``error_received`` method of the protocol; the datagram is dropped.
+    """
+
+    MAX_DATAGRAM_SIZE = 65535
+
+    def __init__(self, loop, sock, protocol, *, max_burst=64, waiter=None):
+        super().__init__(extra={
+            "socket": sock,
+            "sockname": sock.getsockname(),
+        })
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._max_burst = max_burst
+        self._tx_queue = None
+        self._closing = False
+        self._burst_handler = getattr(protocol, "datagrams_received", None)
+
+        self._loop.add_reader(self._sock.fileno(), self._read_ready)
+        self._loop.call_soon(self._connection_made, waiter)
+
+    def _connection_made(self, waiter):
+        self._protocol.connection_made(self)
+        if waiter is not None and not waiter.cancelled():
+            waiter.set_result(None)
+
+    def _read_ready(self):
+        burst = []
+        recvfrom = self._sock.recvfrom
+        for _ in range(self._max_burst):
+            try:
+                burst.append(recvfrom(self.MAX_DATAGRAM_SIZE))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as exc:
+                self._protocol.error_received(exc)
+                break
+
+        if not burst:
+            return
+
+        self._tx_queue = []
+        try:
+            if self._burst_handler is not None:
+                self._burst_handler(burst)
+            else:
+                for data, addr in burst:
+                    self._protocol.datagram_received(data, addr)
+        finally:
+            queue = self._tx_queue
+            self._tx_queue = None
+            for data, addr in queue:
+                self._send(data, addr)
+
+    def _send(self, data, addr):
+        try:
+            if addr is None:
+                self._sock.send(data)
+            else:
+                self._sock.sendto(data, addr)
+        except OSError as exc:
+            self._protocol.error_received(exc)
+
+    def sendto(self, data, addr=None):
+        if self._closing:
+            return
+        if self._tx_queue is not None:
+            self._tx_queue.append((bytes(data), addr))
+            return
+        self._send(data, addr)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._sock.fileno())
+        self._loop.call_soon(self._call_connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+    def _call_connection_lost(self, exc):
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._sock.close()
+
+
+async def create_batched_endpoint(loop, protocol_factory, local_addr, *,
+                                  max_burst=64):
+    """
+    Create a datagram endpoint using :class:`BatchedDatagramTransport`.
+
+    :param loop: The event loop to use.
+    :param protocol_factory: Callable returning the protocol instance.
+    :param local_addr: The ``(host, port)`` to bind to.
+    :param max_burst: Maximum number of datagrams to read per burst.
+    :return: The transport and the protocol.
+
+    This is the counterpart to
+    :meth:`asyncio.loop.create_datagram_endpoint`.
+    """
+    infos = await loop.getaddrinfo(*local_addr, type=socket.SOCK_DGRAM)
+    family, type_, proto, _, addr = infos[0]
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setblocking(False)
+        sock.bind(addr)
+    except:  # NOQA
+        sock.close()
+        raise
+
+    protocol = protocol_factory()
+    waiter = loop.create_future()
+    transport = BatchedDatagramTransport(loop, sock, protocol,
+                                         max_burst=max_burst,
+                                         waiter=waiter)
+    try:
+        await waiter
+    except:  # NOQA
+        transport.close()
+        raise
+    return transport, protocol
+
+
 PORT1 = 7200
 PORT2 = 7201
 
 
+async def _create_endpoint(loop, args, protocol_factory, local_addr):
+    if args.batched:
+        return await create_batched_endpoint(
+            loop,
+            protocol_factory,
+            local_addr,
+        )
+    return await loop.create_datagram_endpoint(
+        protocol_factory,
+        local_addr,
+    )
+
+
 async def _recv_setup(loop, args):
     def receiver_factory():
         protocol = Protocol(
@@ -915,7 +1770,8 @@ async def _recv_setup(loop, args):
         )
         return protocol
 
-    _, receiver = await loop.create_datagram_endpoint(
+    _, receiver = await _create_endpoint(
+        loop, args,
         receiver_factory,
         (args.rx_bind, PORT2),
     )
@@ -933,7 +1789,8 @@ async def _send_setup(loop, args):
         )
         return protocol
 
-    _, sender = await loop.create_datagram_endpoint(
+    _, sender = await _create_endpoint(
+        loop, args,
         sender_factory,
         ("127.0.0.1", PORT1),
     )
@@ -1120,7 +1977,7 @@ SCENARIOS = {
 async def amain(loop, args):
     logger = logging.getLogger("main")
 
-    sigint_event = asyncio.Event(loop=loop)
+    sigint_event = asyncio.Event()
     loop.add_signal_handler(signal.SIGINT, sigint_event.set)
     loop.add_signal_handler(signal.SIGTERM, sigint_event.set)
 
@@ -1176,6 +2033,12 @@ if __name__ == "__main__":
         type=int,
         default=16,
     )
+    parser.add_argument(
+        "--batched",
+        action="store_true",
+        default=False,
+        help="Receive datagrams in bursts and coalesce their ACKs",
+    )
     parser.add_argument(
         "--rx-bind",
         default="0.0.0.0",
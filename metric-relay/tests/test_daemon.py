@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import unittest
+
+from datetime import datetime, timedelta
+
+import hintlib.sample
+
+import metric_relay.daemon as daemon
+import metric_relay.filters as filters
+import metric_relay.interface as interface
+import metric_relay.rewrite as rewrite
+
+
+PATH = hintlib.sample.SensorPath(module="m", part="bme280", instance="a")
+
+
+class FakeSource(interface.Source):
+    def __init__(self):
+        super().__init__(logger=logging.getLogger("source"), transport=None,
+                         config=None)
+        self.running = asyncio.Event()
+
+    async def run(self):
+        self.running.set()
+        for i in range(3):
+            await self._emit(interface.DataChunk.from_sample_batch(
+                hintlib.sample.SampleBatch(
+                    timestamp=datetime(2020, 1, 1) + timedelta(seconds=i),
+                    bare_path=PATH,
+                    samples={"temperature": i},
+                )
+            ))
+        await super().run()
+
+
+class FakeSink(interface.Sink):
+    def __init__(self):
+        super().__init__(logger=logging.getLogger("sink"), transport=None,
+                         config=None)
+        self.submitted = []
+
+    async def submit(self, data):
+        await asyncio.sleep(0.01)
+        self.submitted.extend(data.data)
+
+
+class TestMetricRelay(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_passes_rewriter_flush_to_ephemeral_sink_on_shutdown(self):
+        source = FakeSource()
+        sink = FakeSink()
+        rewriter = rewrite.Rewriter([
+            rewrite.DownsampleStage(config=rewrite.DownsampleConfig(
+                match=rewrite.PathMatch(filters.ANY, filters.ANY,
+                                        filters.ANY),
+                interval=60,
+                function="mean",
+            )),
+        ])
+        relay = daemon.MetricRelay(
+            transports=[],
+            sources=[source],
+            sinks=[sink],
+            routes=[daemon.Route(
+                from_=source,
+                to=sink,
+                data_class=interface.DataClass.SAMPLE_BATCH,
+                persistent=False,
+                rewriter=rewriter,
+            )],
+            logger=logging.getLogger("relay"),
+            metrics_interval=None,
+        )
+
+        async def impl():
+            task = asyncio.ensure_future(relay.run())
+            await source.running.wait()
+            await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        self.loop.run_until_complete(asyncio.wait_for(impl(), 5))
+
+        self.assertEqual(
+            [(batch.bare_path, batch.samples) for batch in sink.submitted],
+            [(PATH, {"temperature": 1})],
+        )
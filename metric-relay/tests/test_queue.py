@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import pathlib
+import tempfile
+import unittest
+
+import metric_relay.interface as interface
+import metric_relay.queue as queue
+
+
+def chunk(value):
+    return interface.DataChunk.from_sample_batch(value)
+
+
+def run_coroutine(coro, timeout=5):
+    return asyncio.get_event_loop().run_until_complete(
+        asyncio.wait_for(coro, timeout)
+    )
+
+
+class TestPersistentQueue(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.directory = pathlib.Path(self._tmpdir.name)
+        self.submitted = []
+        self.submissions = []
+        self.queues = []
+
+    def tearDown(self):
+        # let pending tasks of the queues run before closing them
+        run_coroutine(asyncio.sleep(0))
+        for q in self.queues:
+            q.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self._tmpdir.cleanup()
+
+    async def _sink(self, item):
+        self.submissions.append(item)
+        if item.class_ == interface.DataClass.STREAM:
+            self.submitted.append(item.data)
+        else:
+            self.submitted.extend(item.data)
+
+    def _make_queue(self, **kwargs):
+        kwargs.setdefault("max_depth", 100)
+        kwargs.setdefault("overflow_policy", queue.OverflowPolicy.DROP_OLD)
+        q = queue.PersistentQueue(
+            directory=self.directory,
+            sink=self._sink,
+            logger=logging.getLogger("test"),
+            **kwargs
+        )
+        self.queues.append(q)
+        return q
+
+    def _restart(self, q, **kwargs):
+        q.close()
+        self.queues.remove(q)
+        return self._make_queue(**kwargs)
+
+    def _segments(self):
+        return sorted(self.directory.glob("*.seg"))
+
+    def _deliver(self, q, nitems):
+        async def impl():
+            task = asyncio.ensure_future(q.run())
+            try:
+                while len(self.submitted) < nitems:
+                    await asyncio.sleep(0.01)
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        run_coroutine(impl())
+
+    def test_delivers_in_order(self):
+        q = self._make_queue()
+        for i in range(10):
+            q.push_nowait(chunk(i))
+        self.assertEqual(q.depth, 10)
+
+        self._deliver(q, 10)
+
+        self.assertEqual(self.submitted, list(range(10)))
+        self.assertEqual(q.depth, 0)
+
+    def test_recovers_unacknowledged_items(self):
+        q = self._make_queue()
+        for i in range(5):
+            q.push_nowait(chunk(i))
+
+        q = self._restart(q)
+        self.assertEqual(q.depth, 5)
+
+        self._deliver(q, 5)
+        self.assertEqual(self.submitted, list(range(5)))
+
+    def test_resumes_at_cursor(self):
+        q = self._make_queue()
+        for i in range(3):
+            q.push_nowait(chunk(i))
+        self._deliver(q, 3)
+
+        q = self._restart(q)
+        self.assertEqual(q.depth, 0)
+
+        q.push_nowait(chunk(3))
+        self._deliver(q, 4)
+        self.assertEqual(self.submitted, list(range(4)))
+
+    def test_deletes_acknowledged_segments(self):
+        q = self._make_queue(segment_size=1)
+        for i in range(5):
+            q.push_nowait(chunk(i))
+        self._deliver(q, 5)
+
+        q = self._restart(q, segment_size=1)
+        # only the segments of the current writers are left
+        self.assertLessEqual(len(self._segments()), 2)
+
+    def test_truncates_torn_write(self):
+        q = self._make_queue()
+        for i in range(3):
+            q.push_nowait(chunk(i))
+        q = self._restart(q)
+        q.push_nowait(chunk(3))
+        q.close()
+        self.queues.remove(q)
+
+        last_segment = self._segments()[-1]
+        data = last_segment.read_bytes()
+        last_segment.write_bytes(data[:-2])
+
+        q = self._make_queue()
+        self.assertEqual(q.depth, 3)
+        self.assertEqual(last_segment.stat().st_size, 0)
+
+        self._deliver(q, 3)
+        self.assertEqual(self.submitted, list(range(3)))
+
+    def test_skips_corrupt_record(self):
+        q = self._make_queue()
+        for i in range(3):
+            q.push_nowait(chunk(i))
+        q = self._restart(q)
+
+        # corrupt the payload of the second record after recovery
+        segment = self._segments()[0]
+        data = bytearray(segment.read_bytes())
+        record_size = len(data) // 3
+        data[2 * record_size - 1] ^= 0xff
+        segment.write_bytes(bytes(data))
+
+        with self.assertLogs("test", logging.ERROR):
+            self._deliver(q, 2)
+        self.assertEqual(self.submitted, [0, 2])
+
+    def test_drop_old_overflow(self):
+        q = self._make_queue(max_depth=3, segment_size=1)
+        for i in range(20):
+            q.push_nowait(chunk(i))
+            # let the items reach the log
+            run_coroutine(asyncio.sleep(0.01))
+        self.assertEqual(q.depth, 3)
+        self.assertEqual(
+            q.metrics.drops[queue.OverflowPolicy.DROP_OLD],
+            17,
+        )
+
+        q = self._restart(q, max_depth=3, segment_size=1)
+        self.assertEqual(q.depth, 3)
+        # one record per segment: the segment of the cursor, the segments
+        # of the three remaining items and the new writer segment; the
+        # segments of the dropped items are deleted
+        self.assertEqual(len(self._segments()), 5)
+
+        self._deliver(q, 3)
+        self.assertEqual(self.submitted, [17, 18, 19])
+
+    def test_drop_new_overflow(self):
+        q = self._make_queue(max_depth=3,
+                             overflow_policy=queue.OverflowPolicy.DROP_NEW)
+        for i in range(5):
+            q.push_nowait(chunk(i))
+        self.assertEqual(q.depth, 3)
+
+        self._deliver(q, 3)
+        self.assertEqual(self.submitted, [0, 1, 2])
+
+    def test_reject_overflow(self):
+        q = self._make_queue(max_depth=1,
+                             overflow_policy=queue.OverflowPolicy.REJECT)
+        q.push_nowait(chunk(0))
+        with self.assertRaises(asyncio.QueueFull):
+            q.push_nowait(chunk(1))
+
+    def test_coalesces_sample_batches(self):
+        q = self._make_queue(max_batch_size=4)
+        for i in range(6):
+            q.push_nowait(chunk(i))
+        q.push_nowait(interface.DataChunk.from_stream_block(6))
+        for i in range(7, 10):
+            q.push_nowait(chunk(i))
+
+        self._deliver(q, 10)
+
+        self.assertEqual(self.submitted, list(range(10)))
+        self.assertEqual(
+            [tuple(item.data) if item.class_ ==
+             interface.DataClass.SAMPLE_BATCH else item.data
+             for item in self.submissions],
+            [(0, 1, 2, 3), (4, 5), 6, (7, 8, 9)]
+        )
+
+        q = self._restart(q, max_batch_size=4)
+        self.assertEqual(q.depth, 0)
+
+    def test_lingers_for_sample_batches(self):
+        q = self._make_queue(max_batch_size=4, linger=0.2)
+        q.push_nowait(chunk(0))
+
+        async def push_later():
+            await asyncio.sleep(0.05)
+            q.push_nowait(chunk(1))
+
+        asyncio.ensure_future(push_later())
+        self._deliver(q, 2)
+
+        self.assertEqual(len(self.submissions), 1)
+        self.assertEqual(self.submitted, [0, 1])
+
+    def test_calls_done_callback_after_sync(self):
+        q = self._make_queue(sync_interval=0.05)
+        done = []
+        q.push_nowait(chunk(0), lambda: done.append(0))
+        self.assertEqual(done, [])
+
+        run_coroutine(asyncio.sleep(0.2))
+        self.assertEqual(done, [0])
+
+    def test_calls_done_callback_of_dropped_item(self):
+        q = self._make_queue(max_depth=1,
+                             overflow_policy=queue.OverflowPolicy.DROP_NEW)
+        done = []
+        q.push_nowait(chunk(0))
+        q.push_nowait(chunk(1), lambda: done.append(1))
+        self.assertEqual(done, [1])
+
+    def test_calls_done_callbacks_on_close(self):
+        q = self._make_queue()
+        done = []
+        q.push_nowait(chunk(0), lambda: done.append(0))
+        q.close()
+        self.queues.remove(q)
+        self.assertEqual(done, [0])
+
+
+class TestEphemeralQueue(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.submitted = []
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    async def _sink(self, item):
+        await asyncio.sleep(0.01)
+        self.submitted.extend(item.data)
+
+    def _make_queue(self, **kwargs):
+        kwargs.setdefault("max_depth", 100)
+        kwargs.setdefault("overflow_policy", queue.OverflowPolicy.DROP_OLD)
+        return queue.EphemeralQueue(
+            sink=self._sink,
+            logger=logging.getLogger("test"),
+            **kwargs
+        )
+
+    def test_calls_done_callbacks_after_submission(self):
+        q = self._make_queue(max_batch_size=2)
+        done = []
+        for i in range(3):
+            q.push_nowait(chunk(i),
+                          lambda i=i: done.append((i, list(self.submitted))))
+
+        async def impl():
+            task = asyncio.ensure_future(q.run())
+            try:
+                while len(done) < 3:
+                    await asyncio.sleep(0.01)
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        run_coroutine(impl())
+        self.assertEqual(done, [
+            (0, [0, 1]),
+            (1, [0, 1]),
+            (2, [0, 1, 2]),
+        ])
+
+    def test_calls_done_callback_of_dropped_item(self):
+        q = self._make_queue(max_depth=1)
+        done = []
+        q.push_nowait(chunk(0), lambda: done.append(0))
+        q.push_nowait(chunk(1), lambda: done.append(1))
+        self.assertEqual(done, [0])
+        self.assertEqual(q.depth, 1)
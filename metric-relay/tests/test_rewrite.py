@@ -0,0 +1,125 @@
+import unittest
+import unittest.mock
+
+from datetime import datetime, timedelta
+
+import hintlib.sample
+
+import metric_relay.filters as filters
+import metric_relay.rewrite as rewrite
+
+
+T0 = datetime(2020, 1, 1)
+
+PATH_A = hintlib.sample.SensorPath(module="m", part="bme280", instance="a")
+PATH_B = hintlib.sample.SensorPath(module="m", part="bme280", instance="b")
+
+
+def batch(seconds, value, bare_path=PATH_A):
+    return hintlib.sample.SampleBatch(
+        timestamp=T0 + timedelta(seconds=seconds),
+        bare_path=bare_path,
+        samples={"temperature": value},
+    )
+
+
+def make_stage(interval):
+    return rewrite.DownsampleStage(config=rewrite.DownsampleConfig(
+        match=rewrite.PathMatch(filters.ANY, filters.ANY, filters.ANY),
+        interval=interval,
+        function="mean",
+    ))
+
+
+class TestDownsampleStage(unittest.TestCase):
+    def setUp(self):
+        self.stage = make_stage(60)
+        self.now = 0
+        patcher = unittest.mock.patch.object(rewrite.time, "monotonic",
+                                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _process(self, batches):
+        return self._process_at((self.now, batch) for batch in batches)
+
+    def _process_at(self, timed_batches):
+        result = []
+        for now, batch in timed_batches:
+            self.now = now
+            result.extend(
+                (result.timestamp, result.bare_path, result.samples)
+                for result in self.stage.process(batch)
+            )
+        return result
+
+    def test_aggregates_buckets(self):
+        result = self._process([
+            batch(0, 10), batch(10, 20), batch(20, 30), batch(70, 40),
+        ])
+        self.assertEqual(result, [(T0, PATH_A, {"temperature": 20})])
+
+    def test_drops_late_batches(self):
+        result = self._process([
+            batch(0, 10), batch(10, 20), batch(-5, 100), batch(20, 30),
+            batch(70, 40),
+        ])
+        self.assertEqual(result, [(T0, PATH_A, {"temperature": 20})])
+
+    def test_does_not_emit_bucket_twice(self):
+        result = self._process([
+            batch(0, 10), batch(70, 40), batch(10, 20), batch(130, 50),
+        ])
+        self.assertEqual(result, [
+            (T0, PATH_A, {"temperature": 10}),
+            (T0 + timedelta(seconds=60), PATH_A, {"temperature": 40}),
+        ])
+
+    def test_flushes_quiet_paths(self):
+        result = self._process_at([
+            (0, batch(0, 10, PATH_B)), (10, batch(10, 10)),
+            (70, batch(70, 20)), (130, batch(130, 30)),
+        ])
+        self.assertEqual(result, [
+            (T0, PATH_A, {"temperature": 10}),
+            (T0, PATH_B, {"temperature": 10}),
+            (T0 + timedelta(seconds=60), PATH_A, {"temperature": 20}),
+        ])
+
+    def test_late_batch_after_quiet_flush(self):
+        result = self._process_at([
+            (0, batch(0, 10, PATH_B)), (130, batch(130, 30)),
+            (131, batch(10, 20, PATH_B)),
+        ])
+        self.assertEqual(result, [(T0, PATH_B, {"temperature": 10})])
+
+    def test_time_skewed_paths(self):
+        self.stage = make_stage(10)
+        # two 1 Hz paths, with B running 25 s behind A
+        timed_batches = []
+        for t in range(100):
+            timed_batches.append((t, batch(t + 25, t % 10)))
+            timed_batches.append((t, batch(t, t % 10, PATH_B)))
+
+        result = self._process_at(timed_batches)
+
+        self.assertEqual(
+            [item for item in result if item[1] == PATH_B],
+            [
+                (T0 + timedelta(seconds=10 * i), PATH_B,
+                 {"temperature": 4.5})
+                for i in range(9)
+            ],
+        )
+
+    def test_flush(self):
+        self._process([batch(0, 10), batch(10, 20, PATH_B)])
+        result = sorted(
+            (batch.bare_path, batch.samples)
+            for batch in self.stage.flush()
+        )
+        self.assertEqual(result, [
+            (PATH_A, {"temperature": 10}),
+            (PATH_B, {"temperature": 20}),
+        ])
+        self.assertEqual(list(self.stage.flush()), [])
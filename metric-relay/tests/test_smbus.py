@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import time
+import unittest
+
+import metric_relay.smbus as smbus
+
+
+INTERVAL = 0.1
+# tolerance for pass times, in units of INTERVAL
+SLACK = 0.25
+
+
+class FakeSMBus:
+    def __init__(self):
+        self.registers = {}
+        self.failing = set()
+        self.delays = {}
+        self.reads = []
+
+    def read_byte_data(self, device, register):
+        self.reads.append((time.monotonic(), device, register))
+        time.sleep(self.delays.get(device, 0))
+        if device in self.failing:
+            raise OSError(f"no ACK from 0x{device:02x}")
+        return self.registers[device, register]
+
+    def write_byte_data(self, device, register, data):
+        if device in self.failing:
+            raise OSError(f"no ACK from 0x{device:02x}")
+        self.registers[device, register] = data
+
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.bus = FakeSMBus()
+        self.bus.registers[0x76, 0xd0] = 0x60
+        self.bus.registers[0x77, 0xd0] = 0x58
+        self.bus.failing.add(0x40)
+        self.transport = smbus.Transport(
+            config=self.bus,
+            logger=logging.getLogger(__name__),
+        )
+
+    def tearDown(self):
+        self.transport._executor.shutdown()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_transaction_aborts_on_first_failure(self):
+        with self.assertRaisesRegex(OSError, "no ACK from 0x40"):
+            self.loop.run_until_complete(self.transport.transaction([
+                smbus.ReadByte(0x76, 0xd0),
+                smbus.ReadByte(0x40, 0xd0),
+                smbus.ReadByte(0x77, 0xd0),
+            ]))
+
+        self.assertEqual(
+            [(device, register) for _, device, register in self.bus.reads],
+            [(0x76, 0xd0), (0x40, 0xd0)],
+        )
+
+    def test_transaction_return_exceptions(self):
+        result = self.loop.run_until_complete(self.transport.transaction(
+            [
+                smbus.ReadByte(0x76, 0xd0),
+                smbus.ReadByte(0x40, 0xd0),
+                smbus.WriteByte(0x77, 0xf4, 0x27),
+                smbus.ReadByte(0x77, 0xd0),
+            ],
+            return_exceptions=True,
+        ))
+
+        self.assertEqual(result[0], 0x60)
+        self.assertIsInstance(result[1], OSError)
+        self.assertEqual(result[2:], [None, 0x58])
+        self.assertEqual(self.bus.registers[0x77, 0xf4], 0x27)
+
+
+class TestSamplingScheduler(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.bus = FakeSMBus()
+        self.bus.registers[0x76, 0xd0] = 0x60
+        self.bus.registers[0x77, 0xd0] = 0x58
+        self.bus.failing.add(0x40)
+        self.transport = smbus.Transport(
+            config=self.bus,
+            logger=logging.getLogger(__name__),
+        )
+        self.scheduler = self.transport.scheduler
+
+    def tearDown(self):
+        tasks = [group.task for group in self.scheduler._groups.values()
+                 if group.task is not None]
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True)
+        )
+        self.transport._executor.shutdown()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _sample(self, device):
+        return self.scheduler.sample(INTERVAL, smbus.ReadByte(device, 0xd0))
+
+    def _group(self):
+        return self.scheduler._groups[INTERVAL]
+
+    def _passes(self):
+        """
+        Return the grid position of each read, in units of INTERVAL.
+        """
+        origin = self._group().origin
+        return [((t - origin) / INTERVAL, device)
+                for t, device, _ in self.bus.reads]
+
+    def assertOnGrid(self, position, index):
+        self.assertAlmostEqual(position, index, delta=SLACK)
+
+    def test_shares_passes_on_common_grid(self):
+        async def sensor(device, delay, n):
+            await asyncio.sleep(delay)
+            results = []
+            for _ in range(n):
+                _, value = await self._sample(device)
+                results.append(value)
+            return results
+
+        a, b = self.loop.run_until_complete(asyncio.gather(
+            sensor(0x76, 0, 4),
+            # joins in between two passes of the first sensor
+            sensor(0x77, 1.5 * INTERVAL, 2),
+        ))
+
+        self.assertEqual(a, [0x60] * 4)
+        self.assertEqual(b, [0x58] * 2)
+
+        passes = self._passes()
+        self.assertEqual([device for _, device in passes],
+                         [0x76, 0x76, 0x77, 0x76, 0x77, 0x76])
+        first, _ = passes[0]
+        for (position, _), index in zip(passes, [0, 1, 1, 2, 2, 3]):
+            self.assertOnGrid(position - first, index)
+
+    def test_skips_passes_missed_while_loop_busy(self):
+        async def sensor():
+            for i in range(4):
+                await self._sample(0x76)
+                if i == 1:
+                    # keep the event loop busy past the next deadline and
+                    # the one after it
+                    time.sleep(2.6 * INTERVAL)
+
+        self.loop.run_until_complete(sensor())
+
+        passes = [position for position, _ in self._passes()]
+        first = passes[0]
+        self.assertOnGrid(passes[1] - first, 1)
+        # the third pass is late; the one which was missed completely is
+        # not caught up on and the schedule returns to the grid
+        self.assertOnGrid(passes[2] - first, 3.6)
+        self.assertOnGrid(passes[3] - first, 4)
+
+    def test_skips_passes_missed_while_bus_busy(self):
+        self.bus.registers[0x50, 0xd0] = 0x01
+        self.bus.delays[0x50] = 2.6 * INTERVAL
+
+        async def sensor(device, delay, n):
+            await asyncio.sleep(delay)
+            for _ in range(n):
+                await self._sample(device)
+
+        self.loop.run_until_complete(asyncio.gather(
+            sensor(0x76, 0, 2),
+            sensor(0x50, 0, 1),
+            # requests while the slow pass is still running
+            sensor(0x77, 2 * INTERVAL, 1),
+        ))
+
+        passes = self._passes()
+        self.assertEqual([device for _, device in passes],
+                         [0x76, 0x50, 0x77, 0x76])
+        first, _ = passes[0]
+        for (position, _), index in zip(passes, [0, 0, 3, 3]):
+            self.assertOnGrid(position - first, index)
+
+    def test_failing_operation_does_not_affect_others(self):
+        async def impl():
+            return await asyncio.gather(
+                self._sample(0x76),
+                self._sample(0x40),
+                self._sample(0x77),
+                return_exceptions=True,
+            )
+
+        (ts_a, a), err, (ts_b, b) = self.loop.run_until_complete(impl())
+
+        self.assertEqual((a, b), (0x60, 0x58))
+        self.assertEqual(ts_a, ts_b)
+        self.assertIsInstance(err, OSError)
+        # all three were executed in the same pass
+        self.assertEqual([device for _, device in self._passes()],
+                         [0x76, 0x40, 0x77])
+
+    def test_cancelled_request_is_not_executed(self):
+        async def impl():
+            waiting = asyncio.ensure_future(self._sample(0x77))
+            task = asyncio.ensure_future(self._sample(0x76))
+            await asyncio.sleep(0)
+            waiting.cancel()
+            _, value = await task
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+            return value
+
+        self.assertEqual(self.loop.run_until_complete(impl()), 0x60)
+        self.assertEqual([device for _, device in self._passes()], [0x76])
+
+    def test_group_task_exits_without_requests_and_restarts(self):
+        async def impl():
+            await self._sample(0x76)
+            self.assertIsNotNone(self._group().task)
+            # the next deadline passes without any request
+            await asyncio.sleep(1.5 * INTERVAL)
+            self.assertIsNone(self._group().task)
+
+            _, value = await self._sample(0x77)
+            self.assertEqual(value, 0x58)
+            await asyncio.sleep(1.5 * INTERVAL)
+            self.assertIsNone(self._group().task)
+
+        self.loop.run_until_complete(impl())
+
+        passes = self._passes()
+        self.assertEqual([device for _, device in passes], [0x76, 0x77])
+        # the restarted task keeps to the grid of the first one
+        self.assertOnGrid(passes[1][0] - passes[0][0], 2)
+
+    def test_cancelling_only_request_stops_group_task(self):
+        async def impl():
+            waiting = asyncio.ensure_future(self._sample(0x76))
+            await asyncio.sleep(0)
+            task = self._group().task
+            waiting.cancel()
+            await asyncio.wait_for(task, 2 * INTERVAL)
+
+        self.loop.run_until_complete(impl())
+
+        self.assertIsNone(self._group().task)
+        self.assertEqual(self.bus.reads, [])
@@ -0,0 +1,63 @@
+import asyncio
+import socket
+import unittest
+
+from datetime import timedelta
+
+import metric_relay.snurl as snurl
+
+
+class FakeTransport:
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sent = []
+
+    def get_extra_info(self, name, default=None):
+        if name == "socket":
+            return self.sock
+        return default
+
+    def sendto(self, data, addr=None):
+        self.sent.append((bytes(data), addr))
+
+    def close(self):
+        self.sock.close()
+
+
+class TestProtocol(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.transport = FakeTransport()
+
+    def tearDown(self):
+        self.transport.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_gives_up_without_dacks(self):
+        protocol = snurl.Protocol(
+            1234,
+            retransmit_threshold=timedelta(seconds=0.01),
+            min_retransmit_threshold=timedelta(seconds=0.01),
+            max_retransmit_threshold=timedelta(seconds=0.02),
+            max_retransmits=3,
+        )
+
+        async def impl():
+            protocol.connection_made(self.transport)
+            for i in range(2):
+                protocol.send_frame(bytes([i]))
+            # the peer never acknowledges anything
+            await asyncio.sleep(0.3)
+
+        self.loop.run_until_complete(impl())
+
+        self.assertEqual(protocol.tx_buffer_size, 0)
+        self.assertEqual(protocol.tx_dropped, 2)
+        self.assertEqual(protocol.tx_retransmit_count, 2 * 3)
+        self.assertIsNone(protocol._retransmit_handle)
+
+        nsent = len(self.transport.sent)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(len(self.transport.sent), nsent)
@@ -0,0 +1,75 @@
+import asyncio
+import pathlib
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta
+
+import metric_relay.sbx.stream as stream
+
+
+class TestBuffer(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.directory = pathlib.Path(self._tmpdir.name)
+        self.emitted = []
+        self.buffers = []
+
+    def tearDown(self):
+        self.buffers.clear()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self._tmpdir.cleanup()
+
+    def _on_emit(self, t0, seq0, period, data, handle):
+        self.emitted.append((seq0, data, handle))
+
+    def _make_buffer(self, **kwargs):
+        buf = stream.Buffer(self.directory, self._on_emit, **kwargs)
+        buf.align(0, datetime(2020, 1, 1), timedelta(seconds=1))
+        self.buffers.append(buf)
+        return buf
+
+    def _synced_count(self):
+        header = stream.Buffer._header_v1
+        with (self.directory / "current").open("rb") as f:
+            return header.unpack(f.read(header.size))[-1]
+
+    def test_syncs_after_interval_without_submit(self):
+        buf = self._make_buffer(use_mmap=True, sync_interval=0.05)
+        buf.submit(0, [1, 2, 3])
+        self.assertEqual(buf._Buffer__unsynced, 3)
+
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+
+        self.assertEqual(buf._Buffer__unsynced, 0)
+        self.assertEqual(self._synced_count(), 3)
+
+    def test_releases_recovered_segments_gradually(self):
+        buf = self._make_buffer()
+        buf.batch_size = 2
+        buf.submit(0, range(12))
+        self.assertEqual(len(self.emitted), 6)
+        self.buffers.remove(buf)
+        del buf
+        self.emitted.clear()
+
+        self._make_buffer()
+        nmax = stream.Buffer.MAX_RECOVERED_IN_FLIGHT
+        self.assertEqual(len(self.emitted), nmax)
+
+        seq0, data, handle = self.emitted[0]
+        self.assertEqual((seq0, list(data)), (0, [0, 1]))
+        handle.close()
+        self.assertEqual(len(self.emitted), nmax + 1)
+
+        # the samples are readable until the handle is closed
+        for seq0, data, handle in self.emitted[1:]:
+            self.assertEqual(list(data), [seq0, seq0 + 1])
+            handle.close()
+        self.assertEqual(
+            [seq0 for seq0, _, _ in self.emitted],
+            [0, 2, 4, 6, 8, 10],
+        )
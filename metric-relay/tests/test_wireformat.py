@@ -0,0 +1,167 @@
+import struct
+import unittest
+
+from datetime import timedelta
+
+import hintlib.bme280
+import hintlib.sample
+
+import metric_relay.sbx.wireformat as wireformat
+
+
+# calibration values from the BME280 datasheet example
+DIG88 = struct.pack(
+    "<HhhHhhhhhhhhBB",
+    27504, 26435, -1000,
+    36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000,
+    0, 75,
+)
+DIGE1 = bytes([0x6a, 0x01, 0x00, 0x13, 0x05, 0x03, 0x1e])
+# pressure, temperature (20 bits each) and humidity (16 bits)
+READOUT = bytes([0x65, 0x5a, 0xc0, 0x7e, 0xed, 0x00, 0x6c, 0x2a])
+
+
+def bme280_message(instance=1, timestamp=1234):
+    return bytes([wireformat.MsgType.SENSOR_BME280.value]) + struct.pack(
+        "<HB26s7s8s", timestamp, instance, DIG88, DIGE1, READOUT,
+    )
+
+
+def status_message_v6():
+    return b"".join([
+        bytes([wireformat.MsgType.STATUS.value]),
+        # rtc, uptime, protocol version, status version
+        struct.pack("<LHBB", 0, 1000, 1, 6),
+        # accelerometer and compass stream state
+        struct.pack("<HHH", 1, 2, 10),
+        struct.pack("<HHH", 3, 4, 20),
+        # I2C metrics
+        struct.pack("<H", 5),
+        struct.pack("<H", 6),
+        # BME280 metrics
+        struct.pack("<BH", 0, 7),
+        struct.pack("<BH", 1, 8),
+        # TX metrics
+        struct.pack("<HHHH", 9, 10, 11, 12),
+        # CPU metrics
+        struct.pack("<" + "H" * wireformat.CPU_SLOTS,
+                    *range(100, 100 + wireformat.CPU_SLOTS)),
+    ])
+
+
+class TestDecodeSBXMessage(unittest.TestCase):
+    def test_ds18b20(self):
+        buf = b"".join([
+            bytes([wireformat.MsgType.SENSOR_DS18B20.value]),
+            struct.pack("<H", 1234),
+            struct.pack("<8sh", b"\x28\x01\x02\x03\x04\x05\x06\x07", 344),
+            struct.pack("<8sh", b"\x28\x11\x12\x13\x14\x15\x16\x17", -8),
+        ])
+
+        msg = wireformat.decode_sbx_message(buf)
+
+        self.assertIsInstance(msg, wireformat.DS18B20Message)
+        self.assertEqual(msg.type_, wireformat.MsgType.SENSOR_DS18B20)
+        self.assertEqual(msg.timestamp, 1234)
+        self.assertEqual(msg.samples, [
+            (b"\x28\x01\x02\x03\x04\x05\x06\x07", 21.5),
+            (b"\x28\x11\x12\x13\x14\x15\x16\x17", -0.5),
+        ])
+
+    def test_bme280(self):
+        msg = wireformat.decode_sbx_message(bme280_message())
+
+        calibration = hintlib.bme280.get_calibration(DIG88, DIGE1)
+        temp_raw, pressure_raw, humidity_raw = \
+            hintlib.bme280.get_readout(READOUT)
+        temperature = hintlib.bme280.compensate_temperature(
+            calibration, temp_raw,
+        )
+
+        self.assertIsInstance(msg, wireformat.BME280Message)
+        self.assertEqual(msg.timestamp, 1234)
+        self.assertEqual(msg.instance, 1)
+        self.assertEqual(msg.temperature, temperature)
+        self.assertEqual(
+            msg.pressure,
+            hintlib.bme280.compensate_pressure(
+                calibration, pressure_raw, temperature,
+            ),
+        )
+        self.assertEqual(
+            msg.humidity,
+            hintlib.bme280.compensate_humidity(
+                calibration, humidity_raw, temperature,
+            ),
+        )
+
+    def test_bme280_samples(self):
+        msg = wireformat.decode_sbx_message(bme280_message())
+
+        self.assertEqual(
+            [(s.timestamp, s.sensor, s.value) for s in msg.get_samples()],
+            [
+                (1234,
+                 hintlib.sample.SensorPath(hintlib.sample.Part.BME280, 1,
+                                           subpart),
+                 value)
+                for subpart, value in [
+                    (hintlib.sample.BME280Subpart.TEMPERATURE,
+                     msg.temperature),
+                    (hintlib.sample.BME280Subpart.PRESSURE, msg.pressure),
+                    (hintlib.sample.BME280Subpart.HUMIDITY, msg.humidity),
+                ]
+            ],
+        )
+
+    def test_bme280_rejects_too_much_data(self):
+        with self.assertRaisesRegex(ValueError, "too much data"):
+            wireformat.decode_sbx_message(bme280_message() + b"\x00")
+
+    def test_status_v6(self):
+        msg = wireformat.decode_sbx_message(status_message_v6())
+
+        self.assertIsInstance(msg, wireformat.StatusMessage)
+        self.assertEqual(msg.uptime, 1000)
+        self.assertEqual(msg.v1_accel_stream_state,
+                         (1, 2, timedelta(milliseconds=10)))
+        self.assertEqual(msg.v1_compass_stream_state,
+                         (3, 4, timedelta(milliseconds=20)))
+        self.assertEqual(
+            [metrics.transaction_overruns for metrics in msg.v2_i2c_metrics],
+            [5, 6],
+        )
+        self.assertEqual(
+            [(metrics.configure_status, metrics.timeouts)
+             for metrics in msg.v4_bme280_metrics],
+            [(0, 7), (1, 8)],
+        )
+        self.assertEqual(msg.v5_tx_metrics, (9, 10, 11, 12))
+
+        cpu = msg.v6_cpu_metrics
+        self.assertEqual(cpu.idle, 100 + wireformat.CPU_IDLE)
+        self.assertEqual(cpu.sched, 100 + wireformat.CPU_SCHED)
+        self.assertEqual(
+            len(cpu.interrupts),
+            wireformat.CPU_TASK_BASE - wireformat.CPU_INTR_BASE,
+        )
+        self.assertEqual(cpu.interrupts["intr0"],
+                         100 + wireformat.CPU_INTR_BASE)
+        self.assertEqual(
+            cpu.tasks,
+            tuple(range(100 + wireformat.CPU_TASK_BASE,
+                        100 + wireformat.CPU_SLOTS)),
+        )
+
+    def test_decodes_from_memoryview(self):
+        buf = bytearray(b"\xff" + bme280_message())
+        msg = wireformat.decode_sbx_message(memoryview(buf)[1:])
+        self.assertEqual(msg.instance, 1)
+
+    def test_unknown_type(self):
+        with self.assertRaisesRegex(ValueError, "unknown message type: 0x42"):
+            wireformat.decode_sbx_message(b"\x42\x00\x00")
+
+    def test_empty_buffer(self):
+        with self.assertRaisesRegex(ValueError, "empty message"):
+            wireformat.decode_sbx_message(b"")